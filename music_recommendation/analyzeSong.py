@@ -1,64 +1,130 @@
 import librosa
-import librosa.display
 import numpy as np
 import matplotlib.pyplot as plt
 
+import pcm_cache
+
 
 class MeasureZoomVisualizer:
+    """
+    Waveform with beats and measures; clicking a measure zooms into it, right-clicking zooms out.
+
+    A min/max envelope pyramid is computed once. Every zoom (also with the toolbar) only
+    changes the axis limits, and the waveform line is refilled with the visible window at
+    roughly one min/max pair per pixel, so redraws cost the same for any track length.
+    """
+
+    BASE_BIN = 16  # Samples per envelope bin at the finest pyramid level
+
     def __init__(self, y, sr, beat_times, measures):
         self.y = y  # Audio signal
         self.sr = sr  # Sampling rate
         self.beat_times = beat_times  # Beat timestamps
         self.measures = measures  # Measure timestamps
         self.current_zoom = None  # Current zoom state
+        self.duration = len(y) / sr
+        self.levels = self.build_envelope_pyramid(y, self.BASE_BIN)
+        self.measure_starts = np.array([measure[0] for measure in measures])
 
         # Initialize the figure and axis
         self.fig, self.ax = plt.subplots(figsize=(30, 3))
+        self.setup_plot()
         self.plot_waveform()
 
         # Connect click event
         self.cid = self.fig.canvas.mpl_connect('button_press_event', self.on_click)
         plt.show()
 
-    def plot_waveform(self, measure_idx=None):
-        """Plot the waveform and annotate measures."""
-        self.ax.clear()
-
-        # Plot full waveform
-        librosa.display.waveshow(self.y, sr=self.sr, alpha=0.6, ax=self.ax)
+    @staticmethod
+    def build_envelope_pyramid(y, base_bin):
+        """[(samples per bin, mins, maxs)], each level with bins twice as wide as the previous one"""
+        n_bins = int(np.ceil(len(y) / base_bin))
+        padded = np.pad(y, (0, n_bins * base_bin - len(y)), mode='edge') if len(y) else np.zeros(base_bin)
+        frames = padded.reshape(-1, base_bin)
+        mins, maxs = frames.min(axis=1), frames.max(axis=1)
+        levels = [(base_bin, mins, maxs)]
+        while len(mins) > 1:
+            if len(mins) % 2:
+                mins, maxs = np.append(mins, mins[-1]), np.append(maxs, maxs[-1])
+            mins = np.minimum(mins[0::2], mins[1::2])
+            maxs = np.maximum(maxs[0::2], maxs[1::2])
+            levels.append((levels[-1][0] * 2, mins, maxs))
+        return levels
+
+    def setup_plot(self):
+        """Create all artists once; later zooms only update them"""
+        self.waveform, = self.ax.plot([], [], color='tab:blue', alpha=0.6, linewidth=0.8)
+        self.ax.vlines(self.beat_times, -1, 1, color='r', alpha=0.75, label='Beats')
+        self.labels = [self.ax.text(measure[0], 1, f'M{i + 1}', color='blue', fontsize=8,
+                                    verticalalignment='bottom', clip_on=True)
+                       for i, measure in enumerate(self.measures)]
+        self.ax.set_ylim(-1.05, 1.05)
+        self.ax.set_xlabel("Time (s)")
+        self.ax.set_ylabel("Amplitude")
+        self.ax.legend(loc='upper right')
+        # Also called for toolbar zoom and pan
+        self.ax.callbacks.connect('xlim_changed', self.render_window)
+
+    def render_window(self, ax=None):
+        """Fill the waveform line with the visible window at screen resolution"""
+        start, end = self.ax.get_xlim()
+        start, end = max(start, 0.0), min(end, self.duration)
+        if end <= start:
+            self.waveform.set_data([], [])
+            return
+        width_px = max(int(self.ax.get_window_extent().width), 100)
+        samples_per_px = (end - start) * self.sr / width_px
+
+        if samples_per_px <= self.BASE_BIN:
+            # Zoomed in far enough to draw the samples themselves
+            first, last = int(start * self.sr), int(np.ceil(end * self.sr)) + 1
+            x = np.arange(first, min(last, len(self.y))) / self.sr
+            self.waveform.set_data(x, self.y[first:last])
+        else:
+            # Coarsest level that still has at least one bin per pixel
+            samples_per_bin, mins, maxs = self.levels[0]
+            for level in self.levels:
+                if level[0] > samples_per_px:
+                    break
+                samples_per_bin, mins, maxs = level
+            first = int(start * self.sr / samples_per_bin)
+            last = min(int(np.ceil(end * self.sr / samples_per_bin)) + 1, len(mins))
+            x = (np.arange(first, last) + 0.5) * samples_per_bin / self.sr
+            # One vertical min-max stroke per bin
+            self.waveform.set_data(np.repeat(x, 2), np.column_stack([mins[first:last], maxs[first:last]]).ravel())
+
+        # Only draw the measure labels inside the window, thinned out so they do not overlap
+        first, last = np.searchsorted(self.measure_starts, [start, end])
+        step = max(1, int(np.ceil((last - first) / (width_px / 40))))
+        for i, label in enumerate(self.labels):
+            label.set_visible(first <= i < last and (i - first) % step == 0)
 
-        # Highlight specific measure if zoomed in
+    def plot_waveform(self, measure_idx=None):
+        """Show the whole track, or zoom into one measure; only the axis limits change."""
         if measure_idx is not None:
             measure_start = self.measures[measure_idx][0]
             measure_end = self.measures[measure_idx][-1]
             self.ax.set_xlim(measure_start, measure_end)
             self.ax.set_title(f"Zoomed into Measure {measure_idx + 1}")
         else:
+            self.ax.set_xlim(0, self.duration)
             self.ax.set_title("Waveform with Detected Beats and Measures")
-
-        # Plot beats and annotate measures
-        self.ax.vlines(self.beat_times, -1, 1, color='r', alpha=0.75, label='Beats')
-        for i, measure in enumerate(self.measures):
-            self.ax.text(measure[0], 1, f'M{i + 1}', color='blue', fontsize=8, verticalalignment='bottom')
-
-        self.ax.set_xlabel("Time (s)")
-        self.ax.set_ylabel("Amplitude")
-        self.ax.legend(loc='upper right')
-        self.fig.canvas.draw()
+        self.current_zoom = measure_idx
+        self.fig.canvas.draw_idle()
 
     def on_click(self, event):
         """Handle click events on the plot."""
-        if event.inaxes != self.ax:
+        if event.inaxes != self.ax or event.xdata is None:
+            return
+        if event.button == 3:
+            self.plot_waveform()
             return
 
-        # Check if a measure was clicked
-        for i, measure in enumerate(self.measures):
-            measure_start = measure[0]
-            measure_end = measure[-1]
-            if measure_start <= event.xdata <= measure_end:
-                print(f"Clicked on Measure {i + 1}")
-                self.plot_waveform(measure_idx=i)
-                return
+        # Check if a measure was clicked (the last measure starting before the click)
+        i = int(np.searchsorted(self.measure_starts, event.xdata, side='right')) - 1
+        if i >= 0 and event.xdata <= self.measures[i][-1]:
+            print(f"Clicked on Measure {i + 1}")
+            self.plot_waveform(measure_idx=i)
 
 
 def analyze_track(file_path):
@@ -68,7 +134,7 @@ def analyze_track(file_path):
     """
     # Step 1: Load the audio file
     print("Loading audio file...")
-    y, sr = librosa.load(file_path, sr=None)  # Use original sampling rate
+    y, sr = pcm_cache.load(file_path, sr=None)  # Use original sampling rate
 
     # Step 2: Estimate Tempo and Beat Positions
     print("Estimating tempo and beats...")
@@ -1,56 +1,187 @@
+#!/usr/bin/env python3
+"""
+Mark strong onsets in audio files (e.g. separated stems) with an audible click.
+
+Every file is processed in a worker process: the onset strength envelope is computed
+once and used both for onset detection and for the strong-onset threshold, and the
+click track is rendered with a single overlap-add. For each input <name>.wav the
+output directory gets <name>_with_strong_onsets.wav and <name>_onsets.txt (onset times
+in seconds), mirroring the input's sub-directories. A timing line per file is printed
+and appended to summary.jsonl as soon as the file is done.
+
+Usage:
+    python beatExtraction.py output/htdemucs_6s --output-dir onsets --workers 4
+    python beatExtraction.py output/audio_07/other.wav
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
 import librosa
 import soundfile as sf
 
-# Load the audio file
-audio_path = 'output/audio_07/other.wav'
-y, sr = librosa.load(audio_path, sr=None)
-
-# Compute the onset strength envelope
-onset_env = librosa.onset.onset_strength(y=y, sr=sr)
-
-# Set a threshold for strong onsets. 
-# Adjust the multiplier (e.g., 1.5) to control sensitivity.
-threshold = 1.5 * np.median(onset_env)
-
-# Detect onsets using the customized threshold. 
-# This ensures that only onsets with a strength significantly above the median are detected.
-onset_times = librosa.onset.onset_detect(
-    y=y, 
-        sr=sr, 
-        units="time", 
-        pre_max=3, 
-        post_max=3, 
-        pre_avg=3, 
-        post_avg=5, 
-        delta=0.25, 
+import pcm_cache
+
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3', '.ogg', '.opus')
+OUTPUT_SUFFIX = '_with_strong_onsets'
+
+
+def detect_strong_onsets(y, sr, threshold_factor=1.5):
+    """
+    Onset times (seconds) whose strength is significantly above the median strength.
+
+    Args:
+        y (np.ndarray): Mono audio signal
+        sr (int): Sample rate
+        threshold_factor (float): Onsets weaker than threshold_factor * median(onset strength) are dropped.
+            Adjust it (e.g. 1.5) to control sensitivity.
+    """
+    # Compute the onset strength envelope once; onset_detect would otherwise compute it again
+    onset_env = librosa.onset.onset_strength(y=y, sr=sr)
+
+    onset_frames = librosa.onset.onset_detect(
+        onset_envelope=onset_env,
+        sr=sr,
+        units='frames',
+        pre_max=3,
+        post_max=3,
+        pre_avg=3,
+        post_avg=5,
+        delta=0.25,
         wait=0.1
-)
-
-print("Detected strong onsets (in seconds):")
-print(onset_times)
-
-# Optional: Generate a beep sound (1 kHz, 50 ms) to mark the detected onsets
-duration_beep = 0.05  # seconds
-t = np.linspace(0, duration_beep, int(sr * duration_beep), endpoint=False)
-beep = 0.5 * np.sin(2 * np.pi * 1000 * t)  # 1 kHz sine wave, amplitude 0.5
-
-# Mix the beep into the original audio at each detected onset
-y_out = y.copy()
-onset_samples = (onset_times * sr).astype(int)
-for sample in onset_samples:
-    end_sample = sample + len(beep)
-    if end_sample < len(y_out):
-        y_out[sample:end_sample] += beep
-    else:
-        y_out[sample:] += beep[:len(y_out) - sample]
-
-# Normalize to avoid clipping if necessary
-max_val = np.max(np.abs(y_out))
-if max_val > 1:
-    y_out = y_out / max_val
-
-# Save the new audio file with audible onset markers
-output_file = 'other_with_strong_onsets.wav'
-sf.write(output_file, y_out, sr)
-print(f"Processed audio saved as '{output_file}'.")
+    )
+
+    # Only keep onsets with a strength significantly above the median
+    threshold = threshold_factor * np.median(onset_env)
+    onset_frames = onset_frames[onset_env[onset_frames] > threshold]
+    return librosa.frames_to_time(onset_frames, sr=sr)
+
+
+def make_click(sr, frequency=1000, duration=0.05, amplitude=0.5):
+    """Sine beep (default 1 kHz, 50 ms) used to mark onsets"""
+    t = np.arange(int(sr * duration)) / sr
+    return (amplitude * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+
+
+def render_clicks(n_samples, onset_samples, click):
+    """Click track of n_samples with the click starting at every onset, overlapping clicks summed"""
+    onset_samples = np.asarray(onset_samples, dtype=np.int64)
+    if len(onset_samples) == 0:
+        return np.zeros(n_samples, dtype=np.float32)
+    # Sample index of every click sample at every onset; clicks running past the end are cut off
+    positions = onset_samples[:, None] + np.arange(len(click))[None, :]
+    inside = (positions >= 0) & (positions < n_samples)
+    values = np.broadcast_to(click, positions.shape)
+    track = np.bincount(positions[inside], weights=values[inside], minlength=n_samples)
+    return track.astype(np.float32)
+
+
+def mark_onsets(input_path, output_dir, relative_path, threshold_factor=1.5, click_frequency=1000,
+                click_duration=0.05):
+    """Detect strong onsets of one file and write the marked audio and onset times; returns a timing summary"""
+    timings = {}
+    start = time.perf_counter()
+    y, sr = pcm_cache.load(input_path, sr=None)
+    timings['load'] = time.perf_counter() - start
+
+    step = time.perf_counter()
+    onset_times = detect_strong_onsets(y, sr, threshold_factor)
+    timings['onsets'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    click = make_click(sr, click_frequency, click_duration)
+    y_out = y + render_clicks(len(y), (onset_times * sr).astype(int), click)
+    # Normalize to avoid clipping if necessary
+    max_val = np.max(np.abs(y_out)) if len(y_out) else 0
+    if max_val > 1:
+        y_out = y_out / max_val
+    timings['render'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    base = os.path.join(output_dir, os.path.splitext(relative_path)[0])
+    os.makedirs(os.path.dirname(base) or '.', exist_ok=True)
+    output_file = f"{base}{OUTPUT_SUFFIX}.wav"
+    sf.write(output_file, y_out, sr)
+    np.savetxt(f"{base}_onsets.txt", onset_times, fmt='%.3f')
+    timings['write'] = time.perf_counter() - step
+
+    return {
+        'input': input_path,
+        'output': output_file,
+        'duration': round(len(y) / sr, 2),
+        'onsets': len(onset_times),
+        'seconds': {name: round(value, 3) for name, value in timings.items()},
+        'total': round(time.perf_counter() - start, 3)
+    }
+
+
+def find_audio_files(inputs, output_dir):
+    """(path, path relative to its input root) for every audio file in the given files and directories"""
+    output_dir = os.path.abspath(output_dir)
+    files = []
+    for entry in inputs:
+        if os.path.isfile(entry):
+            files.append((entry, os.path.basename(entry)))
+            continue
+        for root, _, names in os.walk(entry):
+            # Do not pick up our own results when the output directory is inside an input directory
+            if os.path.commonpath([os.path.abspath(root), output_dir]) == output_dir:
+                continue
+            for name in sorted(names):
+                if name.lower().endswith(AUDIO_EXTENSIONS) and OUTPUT_SUFFIX not in name:
+                    path = os.path.join(root, name)
+                    files.append((path, os.path.relpath(path, entry)))
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mark strong onsets in audio files with clicks')
+    parser.add_argument('inputs', nargs='+', help='Audio files and/or directories of stems')
+    parser.add_argument('--output-dir', default='onsets', help='Directory for the marked files (default: onsets)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='Keep onsets stronger than this multiple of the median onset strength')
+    parser.add_argument('--click-frequency', type=float, default=1000, help='Click frequency in Hz')
+    parser.add_argument('--click-duration', type=float, default=0.05, help='Click length in seconds')
+    args = parser.parse_args()
+
+    files = find_audio_files(args.inputs, args.output_dir)
+    if not files:
+        print("No audio files found")
+        return
+    os.makedirs(args.output_dir, exist_ok=True)
+    summary_path = os.path.join(args.output_dir, 'summary.jsonl')
+    print(f"Processing {len(files)} files with {args.workers} workers")
+
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor, open(summary_path, 'a') as summary:
+        futures = {executor.submit(mark_onsets, path, args.output_dir, relative_path, args.threshold,
+                                   args.click_frequency, args.click_duration): path
+                   for path, relative_path in files}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error processing {futures[future]}: {e}")
+                continue
+            results.append(result)
+            summary.write(json.dumps(result) + '\n')
+            summary.flush()
+            seconds = result['seconds']
+            print(f"{result['input']}: {result['onsets']} onsets in {result['duration']}s of audio, "
+                  f"{result['total']:.2f}s (load {seconds['load']:.2f}, onsets {seconds['onsets']:.2f}, "
+                  f"render {seconds['render']:.3f}, write {seconds['write']:.2f})")
+
+    elapsed = time.perf_counter() - start
+    audio_seconds = sum(result['duration'] for result in results)
+    print(f"\nProcessed {len(results)}/{len(files)} files ({audio_seconds:.0f}s of audio) in {elapsed:.1f}s, "
+          f"{audio_seconds / elapsed:.1f}x real time. Summary: {summary_path}")
+
+
+if __name__ == '__main__':
+    main()
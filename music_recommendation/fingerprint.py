@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Landmark audio fingerprints to recognize the same song across encodings, bitrates and trims.
+
+A fingerprint is a set of hashes of spectrogram peak pairs (frequency of the anchor
+peak, frequency of a later peak, and their time distance), each with the anchor's
+time. These survive lossy re-encoding and do not depend on where the file starts.
+
+The index keeps all hashes of all songs sorted in flat arrays. A lookup finds the
+matching entries of every query hash with searchsorted and counts, per song, how many
+of them agree on the same time offset; a re-encoded or trimmed copy has many hashes
+at one offset, other songs only scattered coincidences. The snapshot arrays are
+memory-mapped, so a library of tens of thousands of songs does not have to fit in RAM
+and a lookup only touches the pages it needs.
+
+Usage:
+    python fingerprint.py add --index fingerprints input/
+    python fingerprint.py match --index fingerprints "some rip of Clocks.mp3"
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import time
+import uuid
+
+import numpy as np
+
+SAMPLE_RATE = 8000
+N_FFT = 1024
+HOP_LENGTH = 256  # 32 ms frames
+PEAK_NEIGHBORHOOD = (15, 11)  # Frequency bins x frames a peak must dominate
+PEAKS_PER_SECOND = 10
+FAN_OUT = 3  # Later peaks each anchor is paired with
+TARGET_FRAMES = (1, 63)  # Time distance of paired peaks (6 bits)
+TARGET_BINS = 128  # Maximum frequency distance of paired peaks
+
+MIN_ALIGNED = 20  # Hashes that must agree on one offset
+MIN_CONFIDENCE = 0.05  # Fraction of the query's hashes that must agree
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3', '.ogg', '.opus')
+
+
+def find_peaks(y, sr=SAMPLE_RATE):
+    """Spectrogram peaks as (frame, frequency bin) arrays, thinned to about PEAKS_PER_SECOND"""
+    import librosa
+    from scipy.ndimage import maximum_filter
+
+    spectrum = np.log1p(np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH)))
+    local_max = (spectrum == maximum_filter(spectrum, size=PEAK_NEIGHBORHOOD)) & (spectrum > spectrum.mean())
+    bins, frames = np.nonzero(local_max)
+    if len(frames) == 0:
+        return frames, bins
+
+    # Keep the strongest peaks, spread evenly over time (per 1-second block)
+    strength = spectrum[bins, frames]
+    frames_per_second = sr / HOP_LENGTH
+    block = (frames / frames_per_second).astype(np.int64)
+    order = np.lexsort((-strength, block))
+    block_sorted = block[order]
+    rank = np.arange(len(order)) - np.searchsorted(block_sorted, block_sorted)
+    keep = order[rank < PEAKS_PER_SECOND]
+    keep = keep[np.lexsort((bins[keep], frames[keep]))]
+    return frames[keep], bins[keep]
+
+
+def landmark_hashes(frames, bins):
+    """Hashes of peak pairs (anchor bin, target bin, frame distance) and anchor frames"""
+    n = len(frames)
+    if n < 2:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int32)
+    anchors, targets = [], []
+    # Candidate targets are the next peaks in time; pair each anchor with the first FAN_OUT in its zone
+    window = FAN_OUT * 4
+    for shift in range(1, window + 1):
+        a = np.arange(n - shift)
+        t = a + shift
+        dt = frames[t] - frames[a]
+        valid = (dt >= TARGET_FRAMES[0]) & (dt <= TARGET_FRAMES[1]) & (np.abs(bins[t] - bins[a]) < TARGET_BINS)
+        anchors.append(a[valid])
+        targets.append(t[valid])
+    anchors = np.concatenate(anchors)
+    targets = np.concatenate(targets)
+    order = np.lexsort((targets, anchors))
+    anchors, targets = anchors[order], targets[order]
+    rank = np.arange(len(anchors)) - np.searchsorted(anchors, anchors)
+    anchors, targets = anchors[rank < FAN_OUT], targets[rank < FAN_OUT]
+
+    dt = (frames[targets] - frames[anchors]).astype(np.uint32)
+    hashes = (bins[anchors].astype(np.uint32) << 16) | (bins[targets].astype(np.uint32) << 6) | dt
+    return hashes, frames[anchors].astype(np.int32)
+
+
+def fingerprint_signal(y, sr):
+    """(hashes, anchor frames) of a mono signal"""
+    if sr != SAMPLE_RATE:
+        import librosa
+        y = librosa.resample(y, orig_sr=sr, target_sr=SAMPLE_RATE)
+    return landmark_hashes(*find_peaks(y))
+
+
+def fingerprint_file(path):
+    import pcm_cache
+    y, _ = pcm_cache.load(path, sr=SAMPLE_RATE, mono=True)
+    hashes, times = landmark_hashes(*find_peaks(y))
+    return hashes, times, len(y) / SAMPLE_RATE
+
+
+class FingerprintIndex:
+    """
+    Inverted hash index: sorted hash array with parallel song and time arrays.
+
+    Songs are added to small pending files (readable by other processes after refresh());
+    save() merges them into the sorted, memory-mapped snapshot, which add() does by
+    itself once MERGE_PENDING songs are pending.
+    """
+
+    MERGE_PENDING = 200
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pending_directory = os.path.join(directory, 'pending')
+        os.makedirs(self.pending_directory, exist_ok=True)
+        self.songs = []  # song ids by number
+        self.number = {}
+        self._pending_loaded = set()
+        self._version = None
+        self._load_snapshot()
+        self.refresh()
+
+    def __len__(self):
+        return len(self.songs)
+
+    def __contains__(self, song_id):
+        return song_id in self.number
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load_snapshot(self):
+        self.songs, self.number, self._pending_loaded = [], {}, set()
+        empty = np.zeros(0, dtype=np.uint32)
+        self.hashes, self.song_numbers, self.times = empty, empty.astype(np.int32), empty.astype(np.int32)
+        self._pending = ([], [], [])
+        self._pending_sorted = None
+        try:
+            self._version = os.stat(self._path('songs.json')).st_mtime_ns
+        except FileNotFoundError:
+            self._version = None
+            return
+        with open(self._path('songs.json'), 'r') as f:
+            self.songs = json.load(f)
+        self.number = {song_id: i for i, song_id in enumerate(self.songs)}
+        self.hashes = np.load(self._path('hashes.npy'), mmap_mode='r')
+        self.song_numbers = np.load(self._path('songs.npy'), mmap_mode='r')
+        self.times = np.load(self._path('times.npy'), mmap_mode='r')
+
+    def refresh(self):
+        """Load songs added (also by other processes) since the last refresh"""
+        try:
+            version = os.stat(self._path('songs.json')).st_mtime_ns
+        except FileNotFoundError:
+            version = None
+        if version != self._version:
+            self._load_snapshot()
+        for name in sorted(os.listdir(self.pending_directory)):
+            if not name.endswith('.npz') or name in self._pending_loaded:
+                continue
+            try:
+                with np.load(os.path.join(self.pending_directory, name)) as data:
+                    song_id = str(data['song_id'])
+                    hashes, times = data['hashes'], data['times']
+            except (OSError, ValueError, KeyError):
+                continue  # Removed by a concurrent save() or still being written
+            self._pending_loaded.add(name)
+            if song_id in self.number:
+                continue
+            self.number[song_id] = len(self.songs)
+            self.songs.append(song_id)
+            self._pending[0].append(hashes)
+            self._pending[1].append(np.full(len(hashes), self.number[song_id], dtype=np.int32))
+            self._pending[2].append(times)
+            self._pending_sorted = None
+
+    def _sorted_pending(self):
+        """Pending songs' (hashes, song numbers, times) sorted by hash; rebuilt only after refresh() loaded new songs"""
+        if self._pending_sorted is None:
+            hashes = np.concatenate(self._pending[0])
+            order = np.argsort(hashes, kind='stable')
+            self._pending_sorted = (hashes[order], np.concatenate(self._pending[1])[order],
+                                    np.concatenate(self._pending[2])[order])
+        return self._pending_sorted
+
+    def add(self, song_id, hashes, times):
+        """Add a song's fingerprint; visible to other processes after their next refresh()"""
+        if song_id in self.number:
+            return
+        tmp_path = os.path.join(self.pending_directory, f".{uuid.uuid4().hex}.tmp.npz")
+        np.savez(tmp_path, song_id=song_id, hashes=hashes.astype(np.uint32), times=times.astype(np.int32))
+        os.replace(tmp_path, os.path.join(self.pending_directory, f"{uuid.uuid4().hex}.npz"))
+        self.refresh()
+        if len(self._pending_loaded) >= self.MERGE_PENDING:
+            self.save()
+
+    def save(self):
+        """Merge pending songs into the sorted snapshot; one process at a time"""
+        with open(self._path('save.lock'), 'w') as lock_file:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX)
+            self._save()
+
+    def _save(self):
+        self.refresh()
+        pending_files = set(self._pending_loaded)
+        hashes = np.concatenate([np.asarray(self.hashes)] + self._pending[0])
+        song_numbers = np.concatenate([np.asarray(self.song_numbers)] + self._pending[1])
+        times = np.concatenate([np.asarray(self.times)] + self._pending[2])
+        order = np.argsort(hashes, kind='stable')
+        for name, array in (('hashes', hashes), ('songs', song_numbers), ('times', times)):
+            np.save(self._path(f"{name}.tmp.npy"), array[order])
+            os.replace(self._path(f"{name}.tmp.npy"), self._path(f"{name}.npy"))
+        with open(self._path('songs.tmp.json'), 'w') as f:
+            json.dump(self.songs, f)
+        os.replace(self._path('songs.tmp.json'), self._path('songs.json'))
+        for name in pending_files:
+            try:
+                os.remove(os.path.join(self.pending_directory, name))
+            except FileNotFoundError:
+                pass
+        self._load_snapshot()
+        self.refresh()
+
+    def _candidates(self, hashes, times):
+        """(song numbers, time offsets) of every index entry sharing a hash with the query"""
+        song_parts, offset_parts = [], []
+        sources = [(self.hashes, self.song_numbers, self.times)]
+        if self._pending[0]:
+            sources.append(self._sorted_pending())
+        for index_hashes, index_songs, index_times in sources:
+            if len(index_hashes) == 0:
+                continue
+            left = np.searchsorted(index_hashes, hashes, side='left')
+            right = np.searchsorted(index_hashes, hashes, side='right')
+            counts = right - left
+            if counts.sum() == 0:
+                continue
+            # Flat positions of all matching entries without a Python loop
+            query_index = np.repeat(np.arange(len(hashes)), counts)
+            positions = np.repeat(left - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            song_parts.append(np.asarray(index_songs[positions]))
+            offset_parts.append(np.asarray(index_times[positions]) - times[query_index])
+        if not song_parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(song_parts).astype(np.int64), np.concatenate(offset_parts).astype(np.int64)
+
+    def match(self, hashes, times, top=5):
+        """
+        Songs sharing aligned hashes with a query, best first:
+        [{'song_id', 'aligned', 'confidence', 'offset' (seconds the query starts later in the song)}]
+        """
+        if len(hashes) == 0:
+            return []
+        songs, offsets = self._candidates(np.asarray(hashes, dtype=np.uint32), np.asarray(times, dtype=np.int64))
+        if len(songs) == 0:
+            return []
+        # Count (song, offset) pairs; the best offset of each song is its score
+        keys = songs << 32 | (offsets + (1 << 31))
+        unique, counts = np.unique(keys, return_counts=True)
+        key_songs = unique >> 32
+        order = np.lexsort((-counts, key_songs))
+        first = order[np.r_[True, key_songs[order][1:] != key_songs[order][:-1]]]
+        first = first[np.argsort(-counts[first])][:top]
+        return [{'song_id': self.songs[int(key_songs[i])],
+                 'aligned': int(counts[i]),
+                 'confidence': round(float(counts[i]) / len(hashes), 4),
+                 'offset': round(float((int(unique[i]) & 0xFFFFFFFF) - (1 << 31)) * HOP_LENGTH / SAMPLE_RATE, 3)}
+                for i in first]
+
+    def identify(self, hashes, times, min_aligned=MIN_ALIGNED, min_confidence=MIN_CONFIDENCE):
+        """The best match if it is confident enough to be the same recording, else None"""
+        matches = self.match(hashes, times, top=1)
+        if matches and matches[0]['aligned'] >= min_aligned and matches[0]['confidence'] >= min_confidence:
+            return matches[0]
+        return None
+
+
+def find_audio_files(inputs):
+    files = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            files.extend(sorted(os.path.join(entry, name) for name in os.listdir(entry)
+                                if name.lower().endswith(AUDIO_EXTENSIONS)))
+        else:
+            files.append(entry)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Audio fingerprint index')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help='Fingerprint audio files into the index')
+    add_parser.add_argument('audio', nargs='+', help='Audio files or directories')
+    add_parser.add_argument('--index', default='fingerprints')
+    match_parser = subparsers.add_parser('match', help='Find the songs an audio file is a copy of')
+    match_parser.add_argument('audio', nargs='+')
+    match_parser.add_argument('--index', default='fingerprints')
+    args = parser.parse_args()
+
+    index = FingerprintIndex(args.index)
+    if args.command == 'add':
+        for path in find_audio_files(args.audio):
+            start = time.perf_counter()
+            hashes, times, duration = fingerprint_file(path)
+            index.add(os.path.abspath(path), hashes, times)
+            print(f"{path}: {len(hashes)} hashes for {duration:.0f}s in {time.perf_counter() - start:.2f}s")
+        index.save()
+        print(f"{len(index)} songs, {len(index.hashes)} hashes in {args.index}")
+    else:
+        for path in find_audio_files(args.audio):
+            hashes, times, _ = fingerprint_file(path)
+            start = time.perf_counter()
+            matches = index.match(hashes, times)
+            elapsed = (time.perf_counter() - start) * 1000
+            best = index.identify(hashes, times)
+            print(f"{path} ({len(hashes)} hashes, lookup {elapsed:.1f} ms): "
+                  f"{'same as ' + best['song_id'] if best else 'no confident match'}")
+            for match in matches:
+                print(f"    {match['aligned']:>6} aligned  {match['confidence']:.3f}  offset {match['offset']:+.2f}s  "
+                      f"{match['song_id']}")
+
+
+if __name__ == '__main__':
+    main()
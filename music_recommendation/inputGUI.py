@@ -1,12 +1,40 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, Listbox
 import os
+import queue
 import subprocess
+import threading
+import time
 import pygame
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import numpy as np
-import wave
+import soundfile as sf
+
+WAVEFORM_POINTS = 2000  # Min/max pairs plotted per waveform, about the width of the plot in pixels
+BLOCK_BINS = 256  # Envelope bins read from the file per block
+
+
+def waveform_envelope(path, points=WAVEFORM_POINTS):
+    """
+    Min/max envelope of an audio file of any sample format (int16/24/32, float), read in blocks
+    and down-mixed to mono. Returns (bin start times, mins, maxs, duration).
+    """
+    with sf.SoundFile(path) as f:
+        frames, samplerate = f.frames, f.samplerate
+        bin_size = max(1, int(np.ceil(frames / points)))
+        mins, maxs = [], []
+        for block in f.blocks(blocksize=bin_size * BLOCK_BINS, dtype='float32', always_2d=True):
+            mono = block.mean(axis=1)
+            n_bins = int(np.ceil(len(mono) / bin_size))
+            # Pad the last, partial bin with its own last sample
+            mono = np.pad(mono, (0, n_bins * bin_size - len(mono)), mode='edge').reshape(n_bins, bin_size)
+            mins.append(mono.min(axis=1))
+            maxs.append(mono.max(axis=1))
+    mins = np.concatenate(mins) if mins else np.zeros(0, dtype=np.float32)
+    maxs = np.concatenate(maxs) if maxs else np.zeros(0, dtype=np.float32)
+    times = np.arange(len(mins)) * bin_size / samplerate
+    return times, mins, maxs, frames / samplerate
 
 
 class SongSeparatorApp:
@@ -34,7 +62,8 @@ class SongSeparatorApp:
         tk.Button(root, text="Choose Folder", command=self.select_output_folder).pack(pady=5)
 
         # Process button
-        tk.Button(root, text="Separate Tracks", command=self.separate_tracks, bg="green", fg="white").pack(pady=20)
+        self.separate_button = tk.Button(root, text="Separate Tracks", command=self.separate_tracks, bg="green", fg="white")
+        self.separate_button.pack(pady=20)
 
         # Status message
         self.status_label = tk.Label(root, text="", font=("Arial", 10), fg="blue")
@@ -60,6 +89,11 @@ class SongSeparatorApp:
         self.output_folder = None
         self.separated_files = []
 
+        # Events of the separation worker thread, handled on the Tk main thread
+        self.events = queue.Queue()
+        self.worker = None
+        self.separation_started = None
+
     def select_song(self):
         """Select a song file from the library."""
         self.song_path = filedialog.askopenfilename(filetypes=[("Audio Files", "*.mp3 *.wav *.flac")])
@@ -79,31 +113,70 @@ class SongSeparatorApp:
             self.output_folder_entry.config(state='readonly')
 
     def separate_tracks(self):
-        """Run Spleeter to separate the tracks of the selected song."""
+        """Run Spleeter in a background thread to separate the tracks of the selected song."""
         if not self.song_path or not self.output_folder:
             messagebox.showerror("Error", "Please select both a song and an output folder.")
             return
+        if self.worker and self.worker.is_alive():
+            return
 
         self.status_label.config(text="Processing... Please wait.", fg="blue")
-        self.root.update()
-
-        # Run Spleeter separation
+        self.separate_button.config(state='disabled')
+        self.separation_started = time.time()
+        self.worker = threading.Thread(target=self.run_separation, args=(self.song_path, self.output_folder),
+                                       daemon=True)
+        self.worker.start()
+        self.root.after(100, self.poll_events)
+
+    def run_separation(self, song_path, output_folder):
+        """Worker thread: run Spleeter and report its output lines as progress; never touches Tk widgets"""
         try:
             spleeter_command = [
                 "spleeter", "separate",
                 "-p", "spleeter:2stems",  # 2 stems: vocals + accompaniment
-                "-o", self.output_folder,
-                self.song_path
+                "-o", output_folder,
+                song_path
             ]
-            subprocess.run(spleeter_command, check=True)
-
-            # Update status and display separated tracks
-            self.status_label.config(text="Tracks separated successfully!", fg="green")
-            messagebox.showinfo("Success", "The tracks were separated successfully.")
-            self.display_separated_files()
+            process = subprocess.Popen(spleeter_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            for line in process.stdout:
+                if line.strip():
+                    self.events.put(('progress', line.strip()))
+            if process.wait() != 0:
+                raise RuntimeError(f"spleeter exited with status {process.returncode}")
+            self.events.put(('done', None))
         except Exception as e:
-            self.status_label.config(text="Error during separation.", fg="red")
-            messagebox.showerror("Error", f"An error occurred: {e}")
+            self.events.put(('error', e))
+
+    def poll_events(self):
+        """Tk event loop: apply the worker's progress to the GUI"""
+        finished = False
+        try:
+            while True:
+                kind, value = self.events.get_nowait()
+                elapsed = time.time() - self.separation_started
+                if kind == 'progress':
+                    self.on_progress(value, elapsed)
+                elif kind == 'done':
+                    finished = True
+                    # Update status and display separated tracks
+                    self.status_label.config(text=f"Tracks separated successfully in {elapsed:.0f}s!", fg="green")
+                    self.display_separated_files()
+                    messagebox.showinfo("Success", "The tracks were separated successfully.")
+                else:
+                    finished = True
+                    self.status_label.config(text="Error during separation.", fg="red")
+                    messagebox.showerror("Error", f"An error occurred: {value}")
+        except queue.Empty:
+            pass
+
+        if finished:
+            self.separate_button.config(state='normal')
+        else:
+            self.root.after(100, self.poll_events)
+
+    def on_progress(self, message, elapsed):
+        """Progress callback, called on the Tk main thread"""
+        self.status_label.config(text=f"Processing ({elapsed:.0f}s)... {message[:80]}", fg="blue")
 
     def display_separated_files(self):
         """Display the separated tracks in the listbox."""
@@ -142,31 +215,16 @@ class SongSeparatorApp:
 
         selected_file = self.separated_files[selected_index[0]]
         try:
-            with wave.open(selected_file, 'r') as wav_file:
-                # Read audio properties
-                n_frames = wav_file.getnframes()
-                n_channels = wav_file.getnchannels()
-                framerate = wav_file.getframerate()
-                duration = n_frames / framerate
-
-                # Read frames and convert to numpy array
-                frames = wav_file.readframes(n_frames)
-                audio_data = np.frombuffer(frames, dtype=np.int16)
-
-                # Handle stereo audio by averaging channels (down-mix to mono)
-                if n_channels == 2:
-                    audio_data = audio_data.reshape(-1, 2).mean(axis=1)
-
-                # Create time array
-                time = np.linspace(0, duration, num=len(audio_data))
-
-                # Plot waveform
-                self.ax.clear()
-                self.ax.plot(time, audio_data, color='blue')
-                self.ax.set_title(f"Waveform of {os.path.basename(selected_file)}")
-                self.ax.set_xlabel("Time (s)")
-                self.ax.set_ylabel("Amplitude")
-                self.canvas.draw()
+            times, mins, maxs, duration = waveform_envelope(selected_file)
+
+            # Plot the min/max envelope instead of every sample
+            self.ax.clear()
+            self.ax.fill_between(times, mins, maxs, color='blue', linewidth=0, step='post')
+            self.ax.set_xlim(0, duration)
+            self.ax.set_title(f"Waveform of {os.path.basename(selected_file)}")
+            self.ax.set_xlabel("Time (s)")
+            self.ax.set_ylabel("Amplitude")
+            self.canvas.draw()
         except Exception as e:
             messagebox.showerror("Error", f"An error occurred while displaying the waveform: {e}")
 
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Incremental ingestion of a music library directory.
+
+A manifest records every audio file of the library with its size, modification time
+and content hash, and for every content hash the version of each pipeline stage
+(analysis, separation) that has processed it. A run walks the library and:
+
+- skips a file whose size and mtime match its manifest entry and whose stages are at
+  the current version after a single stat, without opening it;
+- hashes only new or changed files (a file that was only touched keeps its results);
+- schedules only the missing or outdated stages, once per content hash, so renamed,
+  moved and duplicate files are not processed again.
+
+Analyses run in a process pool, separations (memory-hungry Demucs runs) in a separate,
+smaller one. Every finished stage is appended to the manifest journal immediately, so an
+interrupted run continues where it stopped; the journal is folded into manifest.json at
+the end of the run. Bump a stage in STAGE_VERSIONS when its output changes and the next
+run redoes only that stage.
+
+Usage:
+    python library_ingest.py "../music library" --output library
+    python library_ingest.py "../music library" --output library --separate --workers 4
+    python library_ingest.py "../music library" --output library --dry-run
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3', '.ogg', '.opus')
+DEFAULT_LIBRARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'music library')
+STAGE_VERSIONS = {'analysis': 1, 'separation': 1}
+ANALYSIS_SAMPLE_RATE = 22050
+
+
+def content_hash(path, block_size=1024 * 1024):
+    """First 32 hex digits of the file's SHA-256, the same content id the web app uses for uploads"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()[:32]
+
+
+class LibraryManifest:
+    """
+    manifest.json snapshot plus an append-only manifest.jsonl journal of the changes since.
+
+    files:   path relative to the library -> {'size', 'mtime_ns', 'content_id'}
+    content: content id -> {stage: {'version', 'output', 'seconds'}}
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, 'manifest.json')
+        self.journal_path = os.path.join(directory, 'manifest.jsonl')
+        self.files = {}
+        self.content = {}
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+            self.files, self.content = snapshot['files'], snapshot['content']
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        pass  # Last line of an interrupted run
+        self._journal = open(self.journal_path, 'a')
+
+    def _apply(self, change):
+        if 'removed' in change:
+            self.files.pop(change['removed'], None)
+        elif 'file' in change:
+            self.files[change['file']] = {key: change[key] for key in ('size', 'mtime_ns', 'content_id')}
+        else:
+            self.content.setdefault(change['content_id'], {})[change['stage']] = change['result']
+
+    def _record(self, change):
+        self._apply(change)
+        self._journal.write(json.dumps(change) + '\n')
+        self._journal.flush()
+
+    def record_file(self, path, size, mtime_ns, content_id):
+        self._record({'file': path, 'size': size, 'mtime_ns': mtime_ns, 'content_id': content_id})
+
+    def record_stage(self, content_id, stage, result):
+        self._record({'content_id': content_id, 'stage': stage, 'result': result})
+
+    def remove_file(self, path):
+        self._record({'removed': path})
+
+    def missing_stages(self, content_id, stages):
+        done = self.content.get(content_id, {})
+        return [stage for stage in stages if done.get(stage, {}).get('version') != STAGE_VERSIONS[stage]]
+
+    def save(self):
+        """Fold the journal into the snapshot"""
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'files': self.files, 'content': self.content}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.snapshot_path)
+        self._journal.close()
+        open(self.journal_path, 'w').close()
+        self._journal = open(self.journal_path, 'a')
+
+    def close(self):
+        self._journal.close()
+
+
+def scan_library(library, manifest, stages, output_dir):
+    """
+    Compare the library with the manifest.
+
+    Returns:
+        tuple: (jobs, counts) where jobs maps (content id, stage) to the path of a file
+            with that content, and counts has the number of unchanged, touched, new,
+            changed and removed files
+    """
+    counts = {'unchanged': 0, 'touched': 0, 'new': 0, 'changed': 0, 'removed': 0}
+    jobs = {}
+    seen = set()
+    output_dir = os.path.abspath(output_dir)
+    for root, dirs, names in os.walk(library):
+        # Do not pick up our own results when the output directory is inside the library
+        dirs[:] = sorted(d for d in dirs
+                         if os.path.commonpath([os.path.abspath(os.path.join(root, d)), output_dir]) != output_dir)
+        for name in sorted(names):
+            if not name.lower().endswith(AUDIO_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            relative_path = os.path.relpath(path, library)
+            seen.add(relative_path)
+            stat = os.stat(path)
+            entry = manifest.files.get(relative_path)
+            if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                content_id = entry['content_id']
+                counts['unchanged'] += 1
+            else:
+                content_id = content_hash(path)
+                if entry is None:
+                    counts['new'] += 1
+                elif entry['content_id'] == content_id:
+                    counts['touched'] += 1
+                else:
+                    counts['changed'] += 1
+                manifest.record_file(relative_path, stat.st_size, stat.st_mtime_ns, content_id)
+            for stage in manifest.missing_stages(content_id, stages):
+                jobs.setdefault((content_id, stage), path)
+
+    for relative_path in [path for path in manifest.files if path not in seen]:
+        manifest.remove_file(relative_path)
+        counts['removed'] += 1
+    return jobs, counts
+
+
+def run_analysis(path, content_id, output_dir):
+    """Beats, tempo and mix metrics of one song, written to analysis/<content id>.json"""
+    import librosa
+    import numpy as np
+    import pcm_cache
+    from trackEvaluation import evaluate_signal
+
+    start = time.perf_counter()
+    y, sr = pcm_cache.load(path, sr=ANALYSIS_SAMPLE_RATE, mono=True)
+    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
+    analysis = {
+        'content_id': content_id,
+        'duration': round(len(y) / sr, 2),
+        'tempo': round(float(np.atleast_1d(tempo)[0]), 2),
+        'beats': [round(float(t), 3) for t in librosa.frames_to_time(beat_frames, sr=sr)],
+        'metrics': evaluate_signal(y, sr),
+    }
+    output = os.path.join(output_dir, 'analysis', f"{content_id}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(analysis, f)
+    return {'output': output, 'seconds': round(time.perf_counter() - start, 2)}
+
+
+def run_separation(path, content_id, output_dir):
+    """Demucs stems of one song under stems/<content id>/"""
+    from separate_tracks import separate_audio
+    from trackEvaluation import find_stems
+
+    start = time.perf_counter()
+    stem_root = os.path.join(output_dir, 'stems', content_id)
+    separate_audio(path, output_dir=stem_root)
+    # separate_audio reports errors by printing them; Demucs names the folder after the input file
+    stem_dir = None
+    for root, _, names in os.walk(stem_root):
+        if find_stems(root):
+            stem_dir = root
+            break
+    if stem_dir is None:
+        raise RuntimeError(f"no stems were written to {stem_root}")
+    return {'output': stem_dir, 'seconds': round(time.perf_counter() - start, 2)}
+
+
+STAGES = {'analysis': run_analysis, 'separation': run_separation}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incrementally analyze and separate a music library')
+    parser.add_argument('library', nargs='?', default=DEFAULT_LIBRARY, help='Library directory')
+    parser.add_argument('--output', default='library', help='Directory for the manifest and results')
+    parser.add_argument('--separate', action='store_true', help='Also separate every song into stems')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Analysis worker processes')
+    parser.add_argument('--separation-workers', type=int, default=1,
+                        help='Concurrent Demucs runs (each plans its own threads and memory)')
+    parser.add_argument('--dry-run', action='store_true', help='Only show what would be processed')
+    args = parser.parse_args()
+
+    stages = ['analysis'] + (['separation'] if args.separate else [])
+    manifest = LibraryManifest(args.output)
+    start = time.perf_counter()
+    jobs, counts = scan_library(args.library, manifest, stages, args.output)
+    scan_seconds = time.perf_counter() - start
+    print(f"Scanned {sum(counts.values()) - counts['removed']} files in {scan_seconds:.2f}s: "
+          + ', '.join(f"{count} {name}" for name, count in counts.items()))
+    print(f"Scheduled: " + ', '.join(f"{sum(1 for _, s in jobs if s == stage)} {stage}" for stage in stages))
+
+    if args.dry_run:
+        for (content_id, stage), path in sorted(jobs.items(), key=lambda job: job[1]):
+            print(f"  {stage:<11} {path}")
+        manifest.close()
+        return
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as analysis_pool, \
+            ProcessPoolExecutor(max_workers=args.separation_workers) as separation_pool:
+        futures = {}
+        for (content_id, stage), path in jobs.items():
+            pool = separation_pool if stage == 'separation' else analysis_pool
+            futures[pool.submit(STAGES[stage], path, content_id, args.output)] = (content_id, stage, path)
+        for future in as_completed(futures):
+            content_id, stage, path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # Not recorded, so the next run retries it
+                print(f"Error in {stage} of {path}: {e}")
+                failed += 1
+                continue
+            result['version'] = STAGE_VERSIONS[stage]
+            manifest.record_stage(content_id, stage, result)
+            print(f"{stage} of {path} done in {result['seconds']:.1f}s")
+
+    manifest.save()
+    manifest.close()
+    print(f"\nDone in {time.perf_counter() - start:.1f}s: {len(jobs) - failed} stages completed, {failed} failed. "
+          f"Manifest: {manifest.snapshot_path}")
+
+
+if __name__ == '__main__':
+    main()
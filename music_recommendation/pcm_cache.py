@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Decoded-audio cache shared by the analysis scripts and the web app.
+
+load() takes the arguments of librosa.load (path, sr, mono) and returns the same float32
+signal, but a file is only decoded once per (content, sample rate, channels): the samples
+are stored as an .npy file in the cache directory, and every later load, also by another
+process or tool, memory-maps that file read-only instead of decoding again. The pages
+come from the OS page cache, so several processes analyzing the same song share one copy.
+
+Files are identified by their content (the SHA-256 prefix the web app and
+library_ingest.py use), so a renamed or re-uploaded file hits the cache. A record per path
+of its size and mtime avoids hashing unchanged files again. The cache is kept below
+PCM_CACHE_MAX_MB (default 4096), dropping the least recently used signals first. Set
+PCM_CACHE_DIR to move it (default: pcm_cache/ next to this file).
+
+The returned arrays are read-only; copy one before modifying it in place.
+
+Usage:
+    python pcm_cache.py warm input/ --sr 44100 22050
+    python pcm_cache.py stats
+    python pcm_cache.py clear
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+import uuid
+
+import numpy as np
+
+from library_ingest import AUDIO_EXTENSIONS, content_hash
+
+CACHE_DIR = os.environ.get('PCM_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pcm_cache'))
+MAX_BYTES = float(os.environ.get('PCM_CACHE_MAX_MB', 4096)) * 1024 * 1024
+
+
+def _write_atomic(path, write):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def file_id(path, cache_dir=None):
+    """Content id of a file; only hashed again when its size or mtime changed"""
+    cache_dir = cache_dir or CACHE_DIR
+    stat = os.stat(path)
+    record_path = os.path.join(cache_dir, 'paths',
+                               hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:20] + '.json')
+    try:
+        with open(record_path, 'r') as f:
+            record = json.load(f)
+        if record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+            return record['content_id']
+    except (OSError, ValueError, KeyError):
+        pass
+    content_id = content_hash(path)
+    os.makedirs(os.path.dirname(record_path), exist_ok=True)
+    record = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+              'content_id': content_id}
+    _write_atomic(record_path, lambda f: f.write(json.dumps(record).encode()))
+    return content_id
+
+
+def load(path, sr=22050, mono=True, cache_dir=None):
+    """
+    Decoded signal of an audio file, like librosa.load, from the cache when possible.
+
+    Args:
+        path (str): Audio file
+        sr (int): Sample rate to resample to (None keeps the native rate)
+        mono (bool): Mix down to mono; otherwise the signal is shaped (channels, samples)
+        cache_dir (str): Cache directory (default: CACHE_DIR)
+
+    Returns:
+        tuple: (read-only float32 signal, sample rate)
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    name = f"{file_id(path, cache_dir)}_{sr or 'native'}_{'mono' if mono else 'multi'}"
+    array_path = os.path.join(cache_dir, f"{name}.npy")
+    meta_path = os.path.join(cache_dir, f"{name}.json")
+    try:
+        y = np.load(array_path, mmap_mode='r')
+        with open(meta_path, 'r') as f:
+            rate = json.load(f)['sr']
+        os.utime(array_path)  # Most recently used
+        return y, rate
+    except (OSError, ValueError, KeyError):
+        pass
+
+    import librosa
+    y, rate = librosa.load(path, sr=sr, mono=mono)
+    y = np.ascontiguousarray(y, dtype=np.float32)
+    # The metadata is written first, so an existing .npy always has it
+    _write_atomic(meta_path, lambda f: f.write(json.dumps({'sr': rate, 'source': os.path.abspath(path)}).encode()))
+    _write_atomic(array_path, lambda f: np.save(f, y))
+    prune(cache_dir)
+    try:
+        return np.load(array_path, mmap_mode='r'), rate
+    except (OSError, ValueError):
+        return y, rate  # Empty signals cannot be memory-mapped (or it was pruned right away)
+
+
+def entries(cache_dir=None):
+    """(last use, bytes, name) of the cached signals, least recently used first"""
+    cache_dir = cache_dir or CACHE_DIR
+    found = []
+    if not os.path.isdir(cache_dir):
+        return found
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.npy'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            found.append((stat.st_mtime, stat.st_size, entry.name[:-4]))
+    return sorted(found)
+
+
+def prune(cache_dir=None, max_bytes=MAX_BYTES):
+    """Remove the least recently used signals until the cache fits max_bytes"""
+    cache_dir = cache_dir or CACHE_DIR
+    found = entries(cache_dir)
+    total = sum(size for _, size, _ in found)
+    for _, size, name in found:
+        if total <= max_bytes:
+            break
+        for extension in ('.npy', '.json'):
+            try:
+                os.remove(os.path.join(cache_dir, name + extension))
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decoded-audio cache')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    warm = subparsers.add_parser('warm', help='Decode files into the cache')
+    warm.add_argument('inputs', nargs='+', help='Audio files and/or directories')
+    warm.add_argument('--sr', type=int, nargs='+', default=[22050], help='Sample rates to cache')
+    warm.add_argument('--stereo', action='store_true', help='Cache the multi-channel signals instead of mono')
+    subparsers.add_parser('stats', help='Show the size of the cache')
+    subparsers.add_parser('clear', help='Remove all cached signals')
+    args = parser.parse_args()
+
+    if args.command == 'warm':
+        paths = []
+        for entry in args.inputs:
+            if os.path.isfile(entry):
+                paths.append(entry)
+            for root, _, names in os.walk(entry):
+                paths.extend(os.path.join(root, name) for name in sorted(names)
+                             if name.lower().endswith(AUDIO_EXTENSIONS))
+        for path in paths:
+            for sr in args.sr:
+                start = time.perf_counter()
+                y, _ = load(path, sr=sr, mono=not args.stereo)
+                print(f"{path} at {sr} Hz: {y.shape[-1] / sr:.1f}s of audio in {time.perf_counter() - start:.2f}s")
+    elif args.command == 'stats':
+        found = entries()
+        print(f"{len(found)} signals, {sum(size for _, size, _ in found) / 1024 ** 2:.1f} MB "
+              f"of {MAX_BYTES / 1024 ** 2:.0f} MB in {CACHE_DIR}")
+    elif args.command == 'clear':
+        prune(max_bytes=0)
+        print(f"Cleared {CACHE_DIR}")
+
+
+if __name__ == '__main__':
+    main()
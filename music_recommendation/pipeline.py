@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Batch pipeline: decode -> separate -> per-stem features -> beat analysis, for many songs.
+
+Every song is a small DAG of tasks:
+
+    decode (mix) ------------------------------------------+
+    separate (Demucs) -> stem_features (one per stem) ----> beats
+
+decode and stem_features decode their audio once and keep it as a .npy array that later
+tasks load instead of decoding again. Demucs reads the source file itself, so separation
+does not wait for decode. beats ranks the stems by rhythmic clarity with the web app's
+ranking (trackEvaluation.rank_by_clarity on metrics at RANKING_SAMPLE_RATE), and beat-tracks the best stem and the mix.
+
+Each task's artifact is cached under <cache>/<stage>/<key>/, where the key hashes the
+stage version, its parameters, the song's content hash and the keys of its inputs. A
+task writes into a temporary directory that is renamed into place together with its
+result.json, so a killed run leaves no half-written artifacts and a re-run only executes
+what is missing. Changing a parameter re-runs only the tasks that depend on it.
+
+Ready tasks are started longest-remaining-path first, as long as their CPU, memory and
+GPU estimates fit the budget; a Demucs run reserves the threads and the peak memory
+predicted by resource_planner.
+
+Usage:
+    python pipeline.py input/ --cache pipeline_cache
+    python pipeline.py input/ --cache pipeline_cache --cpus 16 --memory-budget 32000 --separation-threads 4
+    python pipeline.py input/audio_example.mp3 --no-separate
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+import resource_planner
+from library_ingest import content_hash
+
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3', '.ogg', '.opus')
+ANALYSIS_SAMPLE_RATE = 22050
+STEMS = {
+    'htdemucs_6s': ['vocals', 'drums', 'bass', 'other', 'guitar', 'piano'],
+    'htdemucs': ['vocals', 'drums', 'bass', 'other'],
+}
+
+# Bump a stage's version when its output changes; its cached artifacts (and those of the
+# stages depending on it) are then recomputed
+STAGE_VERSIONS = {'decode': 1, 'separate': 1, 'stem_features': 2, 'beats': 2}
+# Rough estimates for scheduling: memory in MB, and seconds per second of audio
+STAGE_MEMORY_MB = {'decode': 400, 'stem_features': 800, 'beats': 600}
+STAGE_SECONDS_PER_AUDIO_SECOND = {'decode': 0.02, 'stem_features': 0.05, 'beats': 0.05}
+# Parameters that do not change an artifact (the source is identified by its content hash, and
+# the planner's choices depend on the machine's load), so they are left out of the cache keys
+RUNTIME_PARAMS = {'source', 'device', 'threads', 'segment'}
+
+
+# Stage functions run in worker processes. Each gets the directory to write its artifact
+# to and the artifact directories of its inputs, and returns a JSON-serializable result.
+
+def stage_decode(directory, inputs, source, sr):
+    import librosa
+    y, sr = librosa.load(source, sr=sr, mono=True)
+    np.save(os.path.join(directory, 'audio.npy'), y.astype(np.float32))
+    return {'duration': round(len(y) / sr, 2), 'sr': sr}
+
+
+def stage_separate(directory, inputs, source, model, shifts, device, threads, segment):
+    from separate_tracks import separate_audio
+    from trackEvaluation import find_stems
+    demucs_dir = os.path.join(directory, 'demucs')
+    separate_audio(source, output_dir=demucs_dir, model=model, segment=segment, shifts=shifts,
+                   device=device, threads=threads, transcode=False)
+    # separate_audio reports errors by printing them; Demucs names the folder after the input file
+    stems = []
+    for root, _, _ in os.walk(demucs_dir):
+        stems = find_stems(root)
+        if stems:
+            break
+    if not stems:
+        raise RuntimeError(f"Demucs wrote no stems for {source}")
+    names = []
+    for path in stems:
+        os.replace(path, os.path.join(directory, os.path.basename(path)))
+        names.append(os.path.splitext(os.path.basename(path))[0])
+    shutil.rmtree(demucs_dir)
+    return {'stems': sorted(names)}
+
+
+def stage_stem_features(directory, inputs, stem, sr):
+    import librosa
+    from trackEvaluation import RANKING_METRICS, RANKING_SAMPLE_RATE, evaluate_file, evaluate_signal, find_stems
+    paths = [path for path in find_stems(inputs['separate'])
+             if os.path.splitext(os.path.basename(path))[0] == stem]
+    if not paths:
+        raise RuntimeError(f"stem {stem} is missing in {inputs['separate']}")
+    y, sr = librosa.load(paths[0], sr=sr, mono=True)
+    np.save(os.path.join(directory, 'audio.npy'), y.astype(np.float32))
+    # The ranking metrics are computed from the stem file at the web app's ranking rate
+    return {'stem': stem, 'metrics': evaluate_signal(y, sr),
+            'ranking_metrics': evaluate_file(paths[0], sr=RANKING_SAMPLE_RATE, metrics=RANKING_METRICS)}
+
+
+def track_beats(y, sr):
+    import librosa
+    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
+    return (round(float(np.atleast_1d(tempo)[0]), 2),
+            [round(float(t), 3) for t in librosa.frames_to_time(beat_frames, sr=sr)])
+
+
+def stage_beats(directory, inputs, sr):
+    from trackEvaluation import rank_by_clarity
+    result = {}
+    stem_results = [read_result(path) for name, path in sorted(inputs.items()) if name.startswith('stem:')]
+    if stem_results:
+        # Same ranking as the web app (utils/stems.rank_stems)
+        ranking = [{'stem': row['stem'], 'score': row['score']}
+                   for row in rank_by_clarity([dict(row['ranking_metrics'], stem=row['stem']) for row in stem_results])]
+        best = ranking[0]['stem']
+        y = np.load(os.path.join(inputs[f"stem:{best}"], 'audio.npy'))
+        result['ranking'] = ranking
+        result['best_stem'] = best
+        result['stem_tempo'], result['stem_beats'] = track_beats(y, sr)
+    y = np.load(os.path.join(inputs['decode'], 'audio.npy'))
+    result['tempo'], result['beats'] = track_beats(y, sr)
+    with open(os.path.join(directory, 'beats.json'), 'w') as f:
+        json.dump(result, f)
+    return {key: value for key, value in result.items() if 'beats' not in key}
+
+
+STAGE_FUNCTIONS = {'decode': stage_decode, 'separate': stage_separate,
+                   'stem_features': stage_stem_features, 'beats': stage_beats}
+
+
+def read_result(artifact_dir):
+    with open(os.path.join(artifact_dir, 'result.json'), 'r') as f:
+        return json.load(f)
+
+
+def execute_task(stage, artifact_dir, inputs, params):
+    """Run one stage in a worker process and move its artifact into place"""
+    start = time.perf_counter()
+    tmp_dir = f"{artifact_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        result = STAGE_FUNCTIONS[stage](tmp_dir, inputs, **params)
+        result['seconds'] = round(time.perf_counter() - start, 2)
+        with open(os.path.join(tmp_dir, 'result.json'), 'w') as f:
+            json.dump(result, f)
+        try:
+            os.replace(tmp_dir, artifact_dir)
+        except OSError:
+            # Another run computed the same artifact meanwhile; keep the complete one
+            if not os.path.exists(os.path.join(artifact_dir, 'result.json')):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return result
+
+
+class Task:
+    def __init__(self, song, stage, name, params, deps, resources, estimate):
+        self.song = song
+        self.stage = stage
+        self.name = name  # Input name for the dependent tasks
+        self.params = params
+        self.deps = deps
+        self.resources = resources  # {'cpus', 'memory_mb', 'gpus'}
+        self.estimate = estimate  # Predicted seconds
+        self.dependents = []
+        self.priority = 0.0  # Predicted seconds of the longest path starting here
+        key_source = json.dumps({'stage': stage, 'version': STAGE_VERSIONS[stage], 'content_id': song['content_id'],
+                                 'params': {k: v for k, v in params.items() if k not in RUNTIME_PARAMS},
+                                 'inputs': sorted((dep.name, dep.key) for dep in deps)}, sort_keys=True)
+        self.key = hashlib.sha256(key_source.encode()).hexdigest()[:24]
+
+    def artifact_dir(self, cache_dir):
+        return os.path.join(cache_dir, self.stage, self.key)
+
+
+def song_tasks(path, args, separation_plan):
+    """Tasks of one song, the beats task last"""
+    song = {'path': path, 'content_id': content_hash(path)}
+    duration = resource_planner.get_audio_duration(path)
+
+    def estimate(stage):
+        return STAGE_SECONDS_PER_AUDIO_SECOND[stage] * duration
+
+    light = lambda stage: {'cpus': 1, 'memory_mb': STAGE_MEMORY_MB[stage], 'gpus': 0}
+    decode = Task(song, 'decode', 'decode', {'source': path, 'sr': ANALYSIS_SAMPLE_RATE}, [], light('decode'),
+                  estimate('decode'))
+    tasks = [decode]
+    beat_inputs = [decode]
+    if separation_plan:
+        plan = separation_plan(path)
+        separate = Task(song, 'separate', 'separate',
+                        {'source': path, 'model': args.model, 'shifts': args.shifts, 'device': plan['device'],
+                         'threads': plan['threads'], 'segment': plan['segment']},
+                        [], {'cpus': 1 if plan['device'] == 'cuda' else plan['threads'],
+                             'memory_mb': plan['predicted_peak_mb'], 'gpus': 1 if plan['device'] == 'cuda' else 0},
+                        plan['predicted_seconds'])
+        tasks.append(separate)
+        for stem in STEMS[args.model]:
+            features = Task(song, 'stem_features', f"stem:{stem}", {'stem': stem, 'sr': ANALYSIS_SAMPLE_RATE},
+                            [separate], light('stem_features'), estimate('stem_features'))
+            tasks.append(features)
+            beat_inputs.append(features)
+    tasks.append(Task(song, 'beats', 'beats', {'sr': ANALYSIS_SAMPLE_RATE}, beat_inputs, light('beats'),
+                      estimate('beats')))
+    return tasks
+
+
+def dedupe_tasks(songs):
+    """
+    Unique tasks of all songs. Copies of a song (same content under another name) get the
+    same keys, so they share the tasks of its first copy instead of computing every artifact twice.
+    """
+    unique = {}
+    for song in songs:
+        for i, task in enumerate(song):
+            # Dependencies come first in a song's list, so they are already replaced
+            task.deps = [unique[dep.key] for dep in task.deps]
+            song[i] = unique.setdefault(task.key, task)
+    return list(unique.values())
+
+
+def set_priorities(tasks):
+    for task in tasks:
+        for dep in task.deps:
+            dep.dependents.append(task)
+
+    def longest_path(task):
+        if not task.priority:
+            task.priority = task.estimate + max((longest_path(child) for child in task.dependents), default=0.0)
+        return task.priority
+
+    for task in tasks:
+        longest_path(task)
+
+
+def run_tasks(tasks, cache_dir, budget):
+    """
+    Run all tasks whose artifact is not cached, respecting dependencies and the budget.
+    Returns (completed, cached, failed, skipped) counts and the busy CPU-seconds.
+    """
+    set_priorities(tasks)
+    done = {task for task in tasks if os.path.exists(os.path.join(task.artifact_dir(cache_dir), 'result.json'))}
+    # Leftovers of tasks that were running when a previous run was killed
+    for stage in STAGE_VERSIONS:
+        stage_dir = os.path.join(cache_dir, stage)
+        if os.path.isdir(stage_dir):
+            for name in os.listdir(stage_dir):
+                if '.tmp-' in name:
+                    shutil.rmtree(os.path.join(stage_dir, name), ignore_errors=True)
+
+    counts = {'completed': 0, 'cached': len(done), 'failed': 0, 'skipped': 0}
+    pending = [task for task in tasks if task not in done]
+    running = {}
+    in_use = {'cpus': 0, 'memory_mb': 0, 'gpus': 0}
+    busy_cpu_seconds = 0.0
+
+    def fits(task):
+        if not running:
+            return True  # A task larger than the whole budget still runs, alone
+        return all(in_use[name] + task.resources[name] <= budget[name] for name in in_use)
+
+    with ProcessPoolExecutor(max_workers=max(1, budget['cpus'])) as executor:
+        while pending or running:
+            ready = sorted((task for task in pending if all(dep in done for dep in task.deps)),
+                           key=lambda task: task.priority, reverse=True)
+            for task in ready:
+                if not fits(task):
+                    continue
+                inputs = {dep.name: dep.artifact_dir(cache_dir) for dep in task.deps}
+                future = executor.submit(execute_task, task.stage, task.artifact_dir(cache_dir), inputs, task.params)
+                running[future] = (task, time.perf_counter())
+                pending.remove(task)
+                for name in in_use:
+                    in_use[name] += task.resources[name]
+            if not running:
+                break  # Only tasks whose inputs failed are left
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task, started = running.pop(future)
+                for name in in_use:
+                    in_use[name] -= task.resources[name]
+                busy_cpu_seconds += task.resources['cpus'] * (time.perf_counter() - started)
+                label = f"{task.stage} {task.name if task.stage == 'stem_features' else ''}".strip()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"[{resource_planner.timestamp()}] {label} of {task.song['path']} failed: {e}")
+                    counts['failed'] += 1
+                    continue
+                done.add(task)
+                counts['completed'] += 1
+                print(f"[{resource_planner.timestamp()}] {label} of {task.song['path']} done in {result['seconds']:.1f}s")
+
+    counts['skipped'] = len(pending)
+    return counts, busy_cpu_seconds
+
+
+def find_audio_files(inputs):
+    files = []
+    for entry in inputs:
+        if os.path.isfile(entry):
+            files.append(entry)
+            continue
+        for root, _, names in os.walk(entry):
+            files.extend(os.path.join(root, name) for name in sorted(names) if name.lower().endswith(AUDIO_EXTENSIONS))
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Separate, evaluate and beat-track a batch of songs with cached stages')
+    parser.add_argument('inputs', nargs='+', help='Audio files and/or directories')
+    parser.add_argument('--cache', default='pipeline_cache', help='Artifact cache directory')
+    parser.add_argument('--results', default=None, help='Result per song as JSON lines (default: <cache>/results.jsonl)')
+    parser.add_argument('--cpus', type=int, default=resource_planner.available_threads(), help='CPU budget')
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help='Memory budget in MB (default: available memory)')
+    parser.add_argument('--no-separate', action='store_true', help='Only decode and beat-track the mixes')
+    parser.add_argument('-m', '--model', default='htdemucs_6s', choices=sorted(STEMS), help='Demucs model')
+    parser.add_argument('--shifts', type=int, default=2, help='Demucs random shifts')
+    parser.add_argument('--separation-threads', type=int, default=2,
+                        help='Threads per Demucs run on CPU; several runs share the CPU budget')
+    args = parser.parse_args()
+
+    memory_budget = args.memory_budget or resource_planner.available_memory_mb('cpu') or 4096
+    budget = {'cpus': args.cpus, 'memory_mb': memory_budget,
+              'gpus': 1 if not args.no_separate and resource_planner.cuda_available() else 0}
+
+    def separation_plan(path):
+        return resource_planner.plan_separation(path, args.model, args.shifts, memory_budget,
+                                                threads=min(args.separation_threads, args.cpus))
+
+    files = find_audio_files(args.inputs)
+    if not files:
+        print("No audio files found")
+        return
+    start = time.perf_counter()
+    songs = [song_tasks(path, args, None if args.no_separate else separation_plan) for path in files]
+    tasks = dedupe_tasks(songs)
+    print(f"[{resource_planner.timestamp()}] {len(files)} songs, {len(tasks)} tasks, budget {budget['cpus']} CPUs, "
+          f"{budget['memory_mb']:.0f} MB, {budget['gpus']} GPU")
+
+    counts, busy_cpu_seconds = run_tasks(tasks, args.cache, budget)
+    elapsed = time.perf_counter() - start
+
+    results_path = args.results or os.path.join(args.cache, 'results.jsonl')
+    os.makedirs(os.path.dirname(results_path) or '.', exist_ok=True)
+    with open(results_path, 'a') as f:
+        for path, song in zip(files, songs):
+            beats = song[-1]
+            beats_dir = beats.artifact_dir(args.cache)
+            if not os.path.exists(os.path.join(beats_dir, 'result.json')):
+                continue
+            row = {'path': path, 'content_id': beats.song['content_id'],
+                   'artifacts': {task.name: task.artifact_dir(args.cache) for task in song}}
+            row.update(read_result(beats_dir))
+            f.write(json.dumps(row) + '\n')
+
+    print(f"\n{counts['completed']} tasks run, {counts['cached']} cached, {counts['failed']} failed, "
+          f"{counts['skipped']} skipped (failed inputs) in {elapsed:.1f}s; "
+          f"CPU utilization {busy_cpu_seconds / (budget['cpus'] * elapsed):.0%} of the budget. Results: {results_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Calibrated cost model and resource planner for Demucs separation.
+
+Every Demucs run (calibration runs and real separations from separate_tracks.py)
+is recorded in a calibration file with its audio length, wall time and peak
+memory. The planner fits a small linear model per (model, device) from those
+runs and uses it to pick a device, thread count and segment length that fit a
+memory budget, and to predict how long a file will take from its audio length.
+
+Usage:
+    python resource_planner.py calibrate input/audio_example.mp3 --devices cpu cuda --segments 3 5 7
+    python resource_planner.py plan "input/Coldplay - Clocks.mp3" --memory-budget 8000
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'demucs_calibration.json')
+MAX_RECORDED_RUNS = 500
+
+# Transformer models cannot use segments longer than 7.8 seconds
+MAX_SEGMENT = {
+    'htdemucs': 7,
+    'htdemucs_6s': 7,
+    'htdemucs_ft': 7,
+}
+DEFAULT_MAX_SEGMENT = 30
+
+# Fallbacks used until a (model, device) pair has been calibrated.
+# Realtime factor = processing seconds per second of audio for a single shift.
+DEFAULT_REALTIME_FACTOR = {
+    'cuda': 0.08,
+    'cpu': 1.2,
+}
+# htdemucs_ft is a bag of four models, so it costs roughly four times as much
+MODEL_COST_MULTIPLIER = {
+    'htdemucs_ft': 4.0,
+    'htdemucs_6s': 1.2,
+}
+# Peak memory (MB) = base + per_second * segment + per_audio_second * audio seconds;
+# the audio term covers the input, the per-source output and the overlap-add buffers,
+# which Demucs holds for the whole track
+DEFAULT_MEMORY_MODEL = {
+    'cuda': (1500.0, 350.0, 3.0),
+    'cpu': (1200.0, 450.0, 4.0),
+}
+
+
+def timestamp():
+    return time.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def get_audio_duration(input_file):
+    """Return the length of an audio file in seconds without decoding all of it if possible."""
+    try:
+        import soundfile as sf
+        return float(sf.info(input_file).duration)
+    except Exception:
+        import librosa
+        return float(librosa.get_duration(path=input_file))
+
+
+def cuda_available():
+    """Check whether a CUDA device can be used by Demucs."""
+    try:
+        import torch
+        return bool(torch.cuda.is_available())
+    except ImportError:
+        try:
+            subprocess.run(['nvidia-smi'], check=True, capture_output=True)
+            return True
+        except (OSError, subprocess.CalledProcessError):
+            return False
+
+
+def available_threads():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory_mb(device):
+    """Memory that a new Demucs run could use on the given device."""
+    if device == 'cuda':
+        try:
+            result = subprocess.run(
+                ['nvidia-smi', '--query-gpu=memory.total,memory.used', '--format=csv,noheader,nounits'],
+                check=True, capture_output=True, text=True)
+            total, used = [float(v) for v in result.stdout.strip().splitlines()[0].split(',')]
+            return total - used
+        except (OSError, subprocess.CalledProcessError, ValueError, IndexError):
+            return None
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def load_calibration(path=CALIBRATION_FILE):
+    if not os.path.exists(path):
+        return {'runs': []}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def record_run(run, path=CALIBRATION_FILE):
+    """Append one measured Demucs run to the calibration file (safe for parallel runs)."""
+    with open(f"{path}.lock", 'a+') as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        calibration = load_calibration(path)
+        calibration['runs'].append(run)
+        calibration['runs'] = calibration['runs'][-MAX_RECORDED_RUNS:]
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(calibration, f, indent=2)
+        os.replace(tmp_path, path)
+
+
+class _GpuMemorySampler(threading.Thread):
+    """Polls nvidia-smi for the memory used by one process while it runs."""
+
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                result = subprocess.run(
+                    ['nvidia-smi', '--query-compute-apps=pid,used_memory', '--format=csv,noheader,nounits'],
+                    capture_output=True, text=True, timeout=5)
+                for line in result.stdout.strip().splitlines():
+                    pid, used = [v.strip() for v in line.split(',')]
+                    if int(pid) == self.pid:
+                        self.peak_mb = max(self.peak_mb, float(used))
+            except (OSError, ValueError, subprocess.TimeoutExpired):
+                return
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def wait_with_rusage(process):
+    """Wait for a Popen process and return its peak resident memory in MB."""
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is reported in kilobytes on Linux
+    return rusage.ru_maxrss / 1024
+
+
+def start_gpu_sampler(process, device):
+    if device != 'cuda':
+        return None
+    sampler = _GpuMemorySampler(process.pid)
+    sampler.start()
+    return sampler
+
+
+def make_run_record(model, device, shifts, segment, threads, audio_seconds, elapsed, peak_rss_mb, peak_gpu_mb=None):
+    return {
+        'model': model,
+        'device': device,
+        'shifts': int(shifts),
+        'segment': int(segment),
+        'threads': int(threads),
+        'audio_seconds': round(float(audio_seconds), 3),
+        'elapsed': round(float(elapsed), 3),
+        'peak_rss_mb': round(float(peak_rss_mb), 1),
+        'peak_gpu_mb': round(float(peak_gpu_mb), 1) if peak_gpu_mb else None,
+        'timestamp': time.time(),
+    }
+
+
+class CostModel:
+    """Linear time and memory model fitted from recorded Demucs runs."""
+
+    def __init__(self, runs):
+        self.runs = runs
+
+    def _runs_for(self, model, device, threads=None):
+        runs = [r for r in self.runs if r['model'] == model and r['device'] == device]
+        if threads is not None:
+            same_threads = [r for r in runs if r.get('threads') == threads]
+            if same_threads:
+                return same_threads
+        return runs
+
+    def is_calibrated(self, model, device):
+        return bool(self._runs_for(model, device))
+
+    def time_model(self, model, device, threads=None):
+        """Return (overhead seconds, seconds per audio second per shift)."""
+        runs = self._runs_for(model, device, threads)
+        if not runs:
+            rtf = DEFAULT_REALTIME_FACTOR[device] * MODEL_COST_MULTIPLIER.get(model, 1.0)
+            return 5.0, rtf
+
+        # elapsed = overhead + rtf * audio_seconds * shifts
+        work = np.array([r['audio_seconds'] * max(r['shifts'], 1) for r in runs])
+        elapsed = np.array([r['elapsed'] for r in runs])
+        if len(np.unique(work)) >= 2:
+            rtf, overhead = np.polyfit(work, elapsed, 1)
+            if rtf > 0:
+                return max(0.0, float(overhead)), float(rtf)
+        return 0.0, float(np.sum(elapsed) / np.sum(work))
+
+    def memory_model(self, model, device):
+        """Return (base MB, MB per second of segment, MB per second of audio) for the peak memory of one run."""
+        key = 'peak_gpu_mb' if device == 'cuda' else 'peak_rss_mb'
+        runs = [r for r in self._runs_for(model, device) if r.get(key)]
+        if not runs:
+            return DEFAULT_MEMORY_MODEL[device]
+
+        default = DEFAULT_MEMORY_MODEL[device]
+        terms = [np.array([r['segment'] for r in runs], dtype=float),
+                 np.array([r['audio_seconds'] for r in runs], dtype=float)]
+        peaks = np.array([r[key] for r in runs], dtype=float)
+        # Fit the terms that vary over the runs; the others keep their default slope
+        varying = [i for i, values in enumerate(terms) if len(np.unique(values)) >= 2]
+        if varying and len(runs) > len(varying):
+            fixed = sum(default[i + 1] * terms[i] for i in range(len(terms)) if i not in varying)
+            design = np.column_stack([np.ones(len(runs))] + [terms[i] for i in varying])
+            coefficients = np.linalg.lstsq(design, peaks - fixed, rcond=None)[0]
+            if np.all(coefficients[1:] > 0):
+                model_terms = list(default)
+                model_terms[0] = max(0.0, float(coefficients[0]))
+                for i, coefficient in zip(varying, coefficients[1:]):
+                    model_terms[i + 1] = float(coefficient)
+                return tuple(model_terms)
+        # Too few distinct runs to separate the terms: keep the default split, scaled to the largest peak
+        predicted = default[0] + default[1] * np.mean(terms[0]) + default[2] * np.mean(terms[1])
+        scale = float(np.max(peaks) / predicted)
+        return tuple(value * scale for value in default)
+
+    def predict_seconds(self, model, device, shifts, audio_seconds, threads=None):
+        overhead, rtf = self.time_model(model, device, threads)
+        return overhead + rtf * audio_seconds * max(int(shifts), 1)
+
+    def predict_peak_mb(self, model, device, segment, audio_seconds):
+        base, per_second, per_audio_second = self.memory_model(model, device)
+        return base + per_second * segment + per_audio_second * audio_seconds
+
+
+def plan_separation(input_file, model='htdemucs_6s', shifts=2, memory_budget_mb=None, device=None,
+                    segment=None, threads=None, calibration_path=CALIBRATION_FILE):
+    """
+    Choose device, thread count and segment length for a separation run.
+
+    Args:
+        input_file (str): Audio file to separate
+        model (str): Demucs model name
+        shifts (int): Number of random shifts
+        memory_budget_mb (float): Peak memory allowed for the run; defaults to what is free on the device
+        device (str): Force 'cuda' or 'cpu' instead of choosing
+        segment (int): Force a segment length instead of choosing
+        threads (int): Force a thread count instead of using all available cores
+
+    Returns:
+        dict with the chosen settings and the predicted duration and peak memory
+    """
+    cost_model = CostModel(load_calibration(calibration_path)['runs'])
+    audio_seconds = get_audio_duration(input_file)
+    max_segment = MAX_SEGMENT.get(model, DEFAULT_MAX_SEGMENT)
+
+    if device:
+        devices = [device]
+    else:
+        devices = ['cuda', 'cpu'] if cuda_available() else ['cpu']
+
+    candidates = []
+    for candidate_device in devices:
+        budget = memory_budget_mb or available_memory_mb(candidate_device)
+        candidate_threads = threads or (available_threads() if candidate_device == 'cpu' else min(4, available_threads()))
+
+        if segment:
+            segment_options = [int(segment)]
+        else:
+            segment_options = list(range(max_segment, 0, -1))
+
+        chosen_segment = None
+        for option in segment_options:
+            if budget is None or cost_model.predict_peak_mb(model, candidate_device, option, audio_seconds) <= budget:
+                chosen_segment = option
+                break
+        if chosen_segment is None:
+            continue
+
+        candidates.append({
+            'device': candidate_device,
+            'threads': candidate_threads,
+            'segment': chosen_segment,
+            'audio_seconds': round(audio_seconds, 2),
+            'predicted_seconds': round(cost_model.predict_seconds(
+                model, candidate_device, shifts, audio_seconds, candidate_threads), 1),
+            'predicted_peak_mb': round(cost_model.predict_peak_mb(model, candidate_device, chosen_segment, audio_seconds)),
+            'memory_budget_mb': round(budget) if budget else None,
+            'calibrated': cost_model.is_calibrated(model, candidate_device),
+        })
+
+    if not candidates:
+        # Nothing fits the budget: fall back to the smallest segment on CPU and let the caller decide
+        fallback_device = devices[-1]
+        return {
+            'device': fallback_device,
+            'threads': threads or available_threads(),
+            'segment': 1,
+            'audio_seconds': round(audio_seconds, 2),
+            'predicted_seconds': round(cost_model.predict_seconds(model, fallback_device, shifts, audio_seconds), 1),
+            'predicted_peak_mb': round(cost_model.predict_peak_mb(model, fallback_device, 1, audio_seconds)),
+            'memory_budget_mb': memory_budget_mb,
+            'calibrated': cost_model.is_calibrated(model, fallback_device),
+            'fits_budget': False,
+        }
+
+    best = min(candidates, key=lambda c: c['predicted_seconds'])
+    best['fits_budget'] = True
+    return best
+
+
+def demucs_environment(device, threads):
+    """Environment for a Demucs subprocess using the planned device and thread count."""
+    env = os.environ.copy()
+    env['OMP_NUM_THREADS'] = str(threads)
+    env['MKL_NUM_THREADS'] = str(threads)
+    if device == 'cuda':
+        env.setdefault('CUDA_VISIBLE_DEVICES', '0')
+        env['PYTORCH_NO_CUDA_MEMORY_CACHING'] = '1'
+    return env
+
+
+def _write_clip(input_file, seconds, directory):
+    """Write the first `seconds` of the input as a WAV file for calibration runs."""
+    import librosa
+    import soundfile as sf
+    y, sr = librosa.load(input_file, sr=44100, mono=False, duration=seconds)
+    clip_path = os.path.join(directory, f"clip_{int(seconds)}s.wav")
+    sf.write(clip_path, y.T if y.ndim > 1 else y, sr)
+    return clip_path
+
+
+def calibrate(sample_file, models, devices, shifts_options, segments, clip_lengths, calibration_path=CALIBRATION_FILE):
+    """Run Demucs on clips of a sample file for every combination and record the measurements."""
+    threads = available_threads()
+    with tempfile.TemporaryDirectory() as workdir:
+        clips = [(_write_clip(sample_file, seconds, workdir), seconds) for seconds in clip_lengths]
+        for model in models:
+            for device in devices:
+                for shifts in shifts_options:
+                    for segment in segments:
+                        segment = min(segment, MAX_SEGMENT.get(model, DEFAULT_MAX_SEGMENT))
+                        for clip_path, _ in clips:
+                            command = ['demucs', '--device', device, '-n', model, '--segment', str(segment),
+                                       '--shifts', str(shifts), clip_path, '-o', os.path.join(workdir, 'out')]
+                            print(f"[{timestamp()}] Calibrating: {' '.join(command)}")
+                            start = time.time()
+                            process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                                       env=demucs_environment(device, threads))
+                            sampler = start_gpu_sampler(process, device)
+                            peak_rss_mb = wait_with_rusage(process)
+                            elapsed = time.time() - start
+                            if sampler:
+                                sampler.stop()
+                            if process.returncode != 0:
+                                print(f"[{timestamp()}] Run failed with exit code {process.returncode}, not recorded")
+                                continue
+                            run = make_run_record(model, device, shifts, segment, threads,
+                                                  get_audio_duration(clip_path), elapsed, peak_rss_mb,
+                                                  sampler.peak_mb if sampler else None)
+                            record_run(run, calibration_path)
+                            print(f"[{timestamp()}] {elapsed:.1f}s for {run['audio_seconds']:.1f}s of audio, "
+                                  f"peak RSS {peak_rss_mb:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate Demucs performance and plan separation runs")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    calibrate_parser = subparsers.add_parser('calibrate', help="Measure Demucs throughput and memory on this machine")
+    calibrate_parser.add_argument("sample_file", help="Audio file to cut calibration clips from")
+    calibrate_parser.add_argument("--models", nargs='+', default=['htdemucs_6s'])
+    calibrate_parser.add_argument("--devices", nargs='+', default=None, choices=['cpu', 'cuda'],
+                                  help="Devices to calibrate (default: cuda if available, and cpu)")
+    calibrate_parser.add_argument("--shifts", nargs='+', type=int, default=[1])
+    calibrate_parser.add_argument("--segments", nargs='+', type=int, default=[3, 7])
+    calibrate_parser.add_argument("--clips", nargs='+', type=float, default=[10, 30],
+                                  help="Clip lengths in seconds (two lengths separate fixed overhead from throughput)")
+    calibrate_parser.add_argument("--calibration-file", default=CALIBRATION_FILE)
+
+    plan_parser = subparsers.add_parser('plan', help="Show the planned settings for an input file")
+    plan_parser.add_argument("input_file")
+    plan_parser.add_argument("-m", "--model", default='htdemucs_6s')
+    plan_parser.add_argument("--shifts", type=int, default=2)
+    plan_parser.add_argument("--memory-budget", type=float, default=None, help="Peak memory budget in MB")
+    plan_parser.add_argument("--device", choices=['cpu', 'cuda'], default=None)
+    plan_parser.add_argument("--calibration-file", default=CALIBRATION_FILE)
+
+    args = parser.parse_args()
+
+    if args.command == 'calibrate':
+        devices = args.devices or (['cuda', 'cpu'] if cuda_available() else ['cpu'])
+        calibrate(args.sample_file, args.models, devices, args.shifts, args.segments, args.clips,
+                  args.calibration_file)
+    else:
+        plan = plan_separation(args.input_file, args.model, args.shifts, args.memory_budget, args.device,
+                               calibration_path=args.calibration_file)
+        print(json.dumps(plan, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,17 +5,25 @@ import os
 import argparse
 import time
 import sys
+import json
+import wave
 
-def separate_audio(input_file, output_dir='output', model='htdemucs_6s', segment=5, overlap=0.25, shifts=2, 
-                  two_stems=None, mp3=False, mp3_bitrate=320, float32=True, int24=False, clip_mode='rescale'):
+import numpy as np
+
+import resource_planner
+import transcode_stems
+
+def separate_audio(input_file, output_dir='output', model='htdemucs_6s', segment=None, overlap=0.25, shifts=2, 
+                  two_stems=None, mp3=False, mp3_bitrate=320, float32=True, int24=False, clip_mode='rescale',
+                  device=None, threads=None, memory_budget=None, transcode=True, keep_wav=False):
     """
-    Separates audio tracks using Demucs with GPU acceleration.
+    Separates audio tracks using Demucs, on the GPU when one is available.
     
     Args:
         input_file (str): Path to the input audio file
         output_dir (str): Directory to save the separated tracks
         model (str): Demucs model to use (htdemucs_6s for 6-stem separation)
-        segment (int): Length of each segment in seconds (must be integer, recommended 5-6 for transformer models)
+        segment (int): Length of each segment in seconds (must be integer); None lets the planner choose
         overlap (float): Overlap between segments (0 to 1)
         shifts (int): Number of random shifts for equivariant stabilization (1-5)
         two_stems (str): If not None, separate into two stems only (vocals/instrumental)
@@ -24,26 +32,38 @@ def separate_audio(input_file, output_dir='output', model='htdemucs_6s', segment
         float32 (bool): Export in 32-bit float WAV
         int24 (bool): Export in 24-bit int WAV
         clip_mode (str): Strategy for avoiding clipping ('rescale' or 'clamp')
+        device (str): 'cuda' or 'cpu'; None lets the planner choose
+        threads (int): CPU threads for Demucs; None lets the planner choose
+        memory_budget (float): Peak memory budget in MB used to choose the segment length
+        transcode (bool): Transcode the WAV stems to FLAC and lossy playback formats afterwards
+        keep_wav (bool): Keep the WAV stems after transcoding
     """
     start_time = time.time()
     print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Starting audio separation process")
     print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Input file: {input_file}")
     
-    # Ensure CUDA compatibility
-    os.environ["CUDA_VISIBLE_DEVICES"] = "0"  # Use first GPU
-    os.environ["PYTORCH_NO_CUDA_MEMORY_CACHING"] = "1"  # Reduce memory usage
+    # Choose device, threads and segment length from the calibrated cost model
+    plan = resource_planner.plan_separation(input_file, model, shifts, memory_budget, device, segment, threads)
+    device = plan['device']
+    threads = plan['threads']
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Planned run: device={device}, threads={threads}, "
+          f"segment={plan['segment']}s, predicted peak memory {plan['predicted_peak_mb']} MB"
+          f"{'' if plan['calibrated'] else ' (uncalibrated defaults)'}")
+    if not plan['fits_budget']:
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Warning: no segment length fits the memory budget, "
+              f"the run may run out of memory")
     
     # Create output directory
     os.makedirs(output_dir, exist_ok=True)
     print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Output directory created: {output_dir}")
     
     # Ensure segment is an integer
-    segment = int(segment)
+    segment = int(plan['segment'])
     
     # Demucs command with advanced options
     command = [
         "demucs",
-        "--device", "cuda",  # Force GPU usage
+        "--device", device,  # Planned device (cuda or cpu)
         "-n", model,  # Use the specified model
         "--segment", str(segment),  # Split audio into segments to reduce memory
         "--overlap", str(overlap),  # Overlap between segments
@@ -67,7 +87,8 @@ def separate_audio(input_file, output_dir='output', model='htdemucs_6s', segment
     command.extend([input_file, "-o", output_dir])
     
     print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Running command: {' '.join(command)}")
-    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Estimated time: {estimate_processing_time(input_file, model, shifts)} minutes")
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Estimated time: {plan['predicted_seconds'] / 60:.1f} minutes "
+          f"for {plan['audio_seconds']:.0f} seconds of audio")
     print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Separation started - this may take a while...")
     
     # Flush stdout to ensure progress messages are visible in real-time
@@ -75,8 +96,11 @@ def separate_audio(input_file, output_dir='output', model='htdemucs_6s', segment
     
     try:
         # Run the command and capture output
+        run_start = time.time()
         process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, 
-                                  universal_newlines=True, bufsize=1)
+                                  universal_newlines=True, bufsize=1,
+                                  env=resource_planner.demucs_environment(device, threads))
+        gpu_sampler = resource_planner.start_gpu_sampler(process, device)
         
         # Print output in real-time with timestamps
         for line in process.stdout:
@@ -84,92 +108,247 @@ def separate_audio(input_file, output_dir='output', model='htdemucs_6s', segment
             print(f"[{timestamp}] {line.strip()}")
             sys.stdout.flush()
         
-        # Wait for process to complete
-        process.wait()
-        
-        # Check return code
-        if process.returncode != 0:
-            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Error: Demucs returned non-zero exit code: {process.returncode}")
-            if process.returncode == -9:
-                print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] This is likely an out-of-memory error. Try reducing segment size or shifts.")
-                print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Recommended: Try with segment=3 and shifts=1")
-            return
-        
-        output_path = f"{output_dir}/{model}/{os.path.basename(input_file).split('.')[0]}"
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Tracks saved to: {output_path}")
-        
-        # Print information about the stems that were created
-        if model == "htdemucs_6s":
-            print("\nThe 6-stem model creates the following stems:")
-            print("- vocals.wav: Vocal track")
-            print("- drums.wav: Drum track")
-            print("- bass.wav: Bass track")
-            print("- other.wav: Other instruments")
-            print("- guitar.wav: Guitar track")
-            print("- piano.wav: Piano track (note: may have quality issues)")
-        elif two_stems:
-            print(f"\nTwo-stem separation created:")
-            print(f"- {two_stems}.wav: The selected stem")
-            print(f"- no_{two_stems}.wav: Everything else")
-        else:
-            print("\nThe 4-stem model creates the following stems:")
-            print("- vocals.wav: Vocal track")
-            print("- drums.wav: Drum track")
-            print("- bass.wav: Bass track")
-            print("- other.wav: Other instruments")
-        
-        # Check if all expected files were created
-        expected_stems = ["vocals.wav", "drums.wav", "bass.wav", "other.wav"]
-        if model == "htdemucs_6s":
-            expected_stems.extend(["guitar.wav", "piano.wav"])
-        elif two_stems:
-            expected_stems = [f"{two_stems}.wav", f"no_{two_stems}.wav"]
-        
-        missing_stems = []
-        for stem in expected_stems:
-            stem_path = os.path.join(output_path, stem)
-            if not os.path.exists(stem_path):
-                missing_stems.append(stem)
-        
-        if missing_stems:
-            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Warning: Some expected stems are missing: {', '.join(missing_stems)}")
-        else:
-            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] All expected stems were created successfully")
-        
-        # Print total processing time
-        elapsed_time = time.time() - start_time
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Total processing time: {elapsed_time:.2f} seconds ({elapsed_time/60:.2f} minutes)")
-        
-    except subprocess.CalledProcessError as e:
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Error: {e}")
+        # Wait for process to complete and measure its peak memory
+        peak_rss_mb = resource_planner.wait_with_rusage(process)
     except FileNotFoundError:
         print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Demucs not found! Make sure it's installed with: pip install demucs")
+        return
+    
+    if gpu_sampler:
+        gpu_sampler.stop()
+    
+    # Check return code
+    if process.returncode != 0:
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Error: Demucs returned non-zero exit code: {process.returncode}")
+        if process.returncode == -9:
+            smaller = resource_planner.plan_separation(input_file, model, 1, plan['predicted_peak_mb'] * 0.75,
+                                                       device)
+            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] This is likely an out-of-memory error. Try reducing segment size or shifts.")
+            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Recommended: Try with segment={smaller['segment']} and shifts=1, "
+                  f"or calibrate with resource_planner.py so the planner knows this machine's memory use")
+        return
+    
+    # Feed the measurement back into the cost model
+    try:
+        resource_planner.record_run(resource_planner.make_run_record(
+            model, device, shifts, segment, threads, plan['audio_seconds'], time.time() - run_start,
+            peak_rss_mb, gpu_sampler.peak_mb if gpu_sampler else None))
+    except OSError as e:
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Warning: could not record the run for the cost model: {e}")
+    
+    output_path = f"{output_dir}/{model}/{os.path.basename(input_file).split('.')[0]}"
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Tracks saved to: {output_path}")
+    
+    # Print information about the stems that were created
+    if model == "htdemucs_6s":
+        print("\nThe 6-stem model creates the following stems:")
+        print("- vocals.wav: Vocal track")
+        print("- drums.wav: Drum track")
+        print("- bass.wav: Bass track")
+        print("- other.wav: Other instruments")
+        print("- guitar.wav: Guitar track")
+        print("- piano.wav: Piano track (note: may have quality issues)")
+    elif two_stems:
+        print(f"\nTwo-stem separation created:")
+        print(f"- {two_stems}.wav: The selected stem")
+        print(f"- no_{two_stems}.wav: Everything else")
+    else:
+        print("\nThe 4-stem model creates the following stems:")
+        print("- vocals.wav: Vocal track")
+        print("- drums.wav: Drum track")
+        print("- bass.wav: Bass track")
+        print("- other.wav: Other instruments")
+    
+    # Check if all expected files were created
+    expected_stems = ["vocals.wav", "drums.wav", "bass.wav", "other.wav"]
+    if model == "htdemucs_6s":
+        expected_stems.extend(["guitar.wav", "piano.wav"])
+    elif two_stems:
+        expected_stems = [f"{two_stems}.wav", f"no_{two_stems}.wav"]
+    
+    missing_stems = []
+    for stem in expected_stems:
+        stem_path = os.path.join(output_path, stem)
+        if not os.path.exists(stem_path):
+            missing_stems.append(stem)
+    
+    if missing_stems:
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Warning: Some expected stems are missing: {', '.join(missing_stems)}")
+    else:
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] All expected stems were created successfully")
+    
+    if transcode and not mp3:
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Transcoding stems to {', '.join(transcode_stems.DEFAULT_FORMATS)}")
+        transcode_stems.transcode_stems(output_path, keep_wav=keep_wav)
+    
+    # Print total processing time
+    elapsed_time = time.time() - start_time
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Total processing time: {elapsed_time:.2f} seconds ({elapsed_time/60:.2f} minutes)")
+    
+
+class GrowingWav:
+    """16-bit WAV file whose header is patched after every append, so it can be read while it grows."""
+
+    def __init__(self, path, samplerate, channels):
+        self._file = open(path, 'wb')
+        self._wav = wave.open(self._file, 'wb')
+        self._wav.setnchannels(channels)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(samplerate)
+        self.frames_written = 0
+
+    def append(self, samples):
+        """Append samples shaped (channels, frames) in the -1..1 range."""
+        pcm = (np.clip(samples.T, -1.0, 1.0) * 32767).astype('<i2')
+        self._wav.writeframes(pcm.tobytes())
+        self._file.flush()
+        self.frames_written += samples.shape[1]
+
+    def close(self):
+        self._wav.close()
+        self._file.close()
+
+def write_progress(progress_path, progress):
+    """Atomically replace the progress file so readers never see a partial JSON document."""
+    tmp_path = f"{progress_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, progress_path)
+
+def separate_audio_streaming(input_file, output_dir='output', model='htdemucs_6s', chunk_seconds=30, crossfade=2.0,
+                             segment=None, overlap=0.25, shifts=1, device=None, threads=None, memory_budget=None,
+                             job_id=None, transcode=True, keep_wav=False):
+    """
+    Separates audio in time chunks and appends each chunk's stems to growing WAV files.
+    
+    Stems are written to the same layout as the Demucs CLI (output_dir/model/track_name/stem.wav),
+    so the first chunk of every stem is playable while the rest of the song is still being separated.
+    Progress is published per chunk in output_dir/<job_id>_progress.json.
+    
+    Args:
+        input_file (str): Path to the input audio file
+        output_dir (str): Directory to save the separated tracks
+        model (str): Demucs model to use
+        chunk_seconds (float): Length of audio separated per chunk
+        crossfade (float): Seconds of overlap between consecutive chunks, crossfaded linearly.
+            The same amount of audio after each chunk is fed to the model as context and discarded.
+        segment, overlap, shifts: Passed on to Demucs for the separation of each chunk
+        device, threads, memory_budget: Passed on to the resource planner
+        job_id (str): Prefix of the progress file (default: name of the output directory)
+        transcode (bool): Transcode the finished stems to FLAC and lossy playback formats
+        keep_wav (bool): Keep the WAV stems after transcoding
+    """
+    import torch
+    import librosa
+    from demucs.pretrained import get_model
+    from demucs.apply import apply_model
+    
+    start_time = time.time()
+    job_id = job_id or os.path.basename(os.path.normpath(output_dir))
+    progress_path = os.path.join(output_dir, f"{job_id}_progress.json")
+    
+    plan = resource_planner.plan_separation(input_file, model, shifts, memory_budget, device, segment, threads)
+    torch.set_num_threads(plan['threads'])
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Streaming separation on {plan['device']} "
+          f"with {chunk_seconds}s chunks, segment={plan['segment']}s")
+    
+    separator = get_model(model)
+    separator.eval()
+    samplerate = separator.samplerate
+    channels = separator.audio_channels
+    
+    y, _ = librosa.load(input_file, sr=samplerate, mono=False)
+    if y.ndim == 1:
+        y = np.tile(y, (channels, 1))
+    total = y.shape[1]
+    
+    # Normalize with statistics of the whole track, like demucs.separate does
+    reference = y.mean(axis=0)
+    ref_mean, ref_std = float(reference.mean()), float(reference.std()) or 1.0
+    
+    track_name = os.path.splitext(os.path.basename(input_file))[0]
+    stem_dir = os.path.join(output_dir, model, track_name)
+    os.makedirs(stem_dir, exist_ok=True)
+    writers = {source: GrowingWav(os.path.join(stem_dir, f"{source}.wav"), samplerate, channels)
+               for source in separator.sources}
+    
+    chunk = int(chunk_seconds * samplerate)
+    fade = min(int(crossfade * samplerate), chunk // 2)
+    fade_in = np.linspace(0.0, 1.0, fade, dtype=np.float32) if fade else None
+    starts = list(range(0, total, chunk))
+    held_back = None  # Last `fade` samples of the previous chunk, waiting to be crossfaded
+    
+    progress = {
+        'status': 'running',
+        'chunks_done': 0,
+        'chunks_total': len(starts),
+        'seconds_ready': 0.0,
+        'duration': round(total / samplerate, 2),
+        'stems': {source: f"{model}/{track_name}/{source}.wav" for source in separator.sources},
+    }
+    write_progress(progress_path, progress)
+    
+    try:
+        for index, start in enumerate(starts):
+            end = min(start + chunk, total)
+            is_last = end == total
+            lo = max(0, start - fade) if index else 0
+            hi = min(total, end + fade)
+            
+            mix = torch.from_numpy(np.ascontiguousarray(y[:, lo:hi], dtype=np.float32))
+            mix = (mix - ref_mean) / ref_std
+            with torch.no_grad():
+                sources = apply_model(separator, mix[None], shifts=shifts, split=True, overlap=overlap,
+                                      segment=plan['segment'], device=plan['device'], progress=False)[0]
+            sources = (sources * ref_std + ref_mean).cpu().numpy()
+            # Drop the right-hand context: the output now covers [lo, end)
+            sources = sources[:, :, :end - lo]
+            
+            if held_back is not None:
+                sources[:, :, :fade] = held_back * (1.0 - fade_in) + sources[:, :, :fade] * fade_in
+            
+            if is_last or not fade:
+                ready, held_back = sources, None
+            else:
+                ready, held_back = sources[:, :, :-fade], sources[:, :, -fade:]
+            
+            for source_index, source in enumerate(separator.sources):
+                writers[source].append(ready[source_index])
+            
+            progress['chunks_done'] = index + 1
+            progress['seconds_ready'] = round(writers[separator.sources[0]].frames_written / samplerate, 2)
+            write_progress(progress_path, progress)
+            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Chunk {index + 1}/{len(starts)} done, "
+                  f"{progress['seconds_ready']:.1f}s of {progress['duration']:.1f}s ready")
+            sys.stdout.flush()
+    except Exception as e:
+        progress['status'] = 'error'
+        progress['error'] = str(e)
+        write_progress(progress_path, progress)
+        raise
+    finally:
+        for writer in writers.values():
+            writer.close()
+    
+    if transcode:
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Transcoding stems to {', '.join(transcode_stems.DEFAULT_FORMATS)}")
+        transcode_stems.transcode_stems(stem_dir, keep_wav=keep_wav)
+    
+    progress['status'] = 'completed'
+    write_progress(progress_path, progress)
+    elapsed_time = time.time() - start_time
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Tracks saved to: {stem_dir}")
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Total processing time: {elapsed_time:.2f} seconds ({elapsed_time/60:.2f} minutes)")
+    return stem_dir
 
 def estimate_processing_time(input_file, model, shifts):
     """
-    Provides a rough estimate of processing time based on file size and model.
-    This is a very rough estimate and actual times will vary.
+    Estimate processing time in minutes from the audio length and the calibrated cost model.
+    Run resource_planner.py calibrate once per machine for accurate estimates.
     """
     try:
-        # Get file size in MB
-        file_size_mb = os.path.getsize(input_file) / (1024 * 1024)
-        
-        # Base processing factor (MB per minute) - empirically determined
-        # These are rough estimates and will vary by hardware
-        if model == "htdemucs_6s":
-            base_factor = 5  # MB per minute for 6-stem model
-        elif model == "htdemucs_ft":
-            base_factor = 7  # MB per minute for fine-tuned model
-        else:
-            base_factor = 10  # MB per minute for other models
-        
-        # Adjust for shifts (each shift roughly doubles processing time)
-        shift_factor = shifts / 2
-        
-        # Calculate estimated minutes
-        estimated_minutes = (file_size_mb / base_factor) * shift_factor
-        
-        return max(1, round(estimated_minutes))
+        plan = resource_planner.plan_separation(input_file, model, shifts)
+        return max(1, round(plan['predicted_seconds'] / 60))
     except Exception as e:
         print(f"Error estimating processing time: {e}")
         return "unknown"
@@ -181,8 +360,8 @@ def main():
     parser.add_argument("-m", "--model", default="htdemucs_6s", 
                         choices=["htdemucs_6s", "htdemucs_ft", "htdemucs", "hdemucs_mmi", "mdx", "mdx_extra"],
                         help="Model to use for separation (htdemucs_6s for 6 stems)")
-    parser.add_argument("-s", "--segment", type=int, default=5, 
-                        help="Length of each segment in seconds (must be an integer, recommended 5-6 for transformer models)")
+    parser.add_argument("-s", "--segment", type=int, default=None, 
+                        help="Length of each segment in seconds (must be an integer; default: largest that fits in memory)")
     parser.add_argument("--overlap", type=float, default=0.25, 
                         help="Overlap between segments (0 to 1)")
     parser.add_argument("--shifts", type=int, default=2, 
@@ -195,9 +374,46 @@ def main():
     parser.add_argument("--int24", action="store_true", help="Export in 24-bit int WAV")
     parser.add_argument("--clip-mode", default="rescale", choices=["rescale", "clamp"], 
                         help="Strategy for avoiding clipping")
+    parser.add_argument("--device", choices=["cuda", "cpu"], default=None,
+                        help="Device to run on (default: chosen by the resource planner)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="CPU threads to use (default: all available)")
+    parser.add_argument("--memory-budget", type=float, default=None,
+                        help="Peak memory budget in MB (default: free memory on the device)")
+    parser.add_argument("--no-transcode", action="store_true",
+                        help="Keep the raw WAV stems instead of transcoding them to FLAC/Opus/MP3")
+    parser.add_argument("--keep-wav", action="store_true",
+                        help="Keep the WAV stems next to the transcoded variants")
+    parser.add_argument("--stream", action="store_true",
+                        help="Separate in chunks and append to growing WAV files so the first stems are playable early")
+    parser.add_argument("--chunk-seconds", type=float, default=30,
+                        help="Chunk length in seconds for --stream")
+    parser.add_argument("--crossfade", type=float, default=2.0,
+                        help="Overlap in seconds crossfaded between chunks for --stream")
+    parser.add_argument("--job-id", default=None,
+                        help="Prefix of the progress file written by --stream (default: output directory name)")
     
     args = parser.parse_args()
     
+    if args.stream:
+        separate_audio_streaming(
+            args.input_file,
+            args.output,
+            args.model,
+            args.chunk_seconds,
+            args.crossfade,
+            args.segment,
+            args.overlap,
+            args.shifts,
+            args.device,
+            args.threads,
+            args.memory_budget,
+            args.job_id,
+            not args.no_transcode,
+            args.keep_wav
+        )
+        return
+    
     separate_audio(
         args.input_file, 
         args.output, 
@@ -210,7 +426,12 @@ def main():
         args.mp3_bitrate, 
         args.float32, 
         args.int24, 
-        args.clip_mode
+        args.clip_mode,
+        args.device,
+        args.threads,
+        args.memory_budget,
+        not args.no_transcode,
+        args.keep_wav
     )
 
 if __name__ == "__main__":
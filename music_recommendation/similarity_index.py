@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""
+Feature-vector store and nearest-neighbour index for "find similar songs".
+
+Every song is described by a fixed-length vector built from the existing analysis
+outputs: tempo and meter, beat strength statistics from the beat tracking, the mix
+metrics of trackEvaluation.py (spectral contrast, percussive energy, ...) and the
+per-stem rhythm metrics of the stem ranking. Missing features (e.g. no separation
+yet) are filled with the library mean.
+
+Vectors are standardized with the library's mean and standard deviation and
+L2-normalized, so a query is one matrix-vector product (cosine similarity) followed
+by a partial sort: a few milliseconds for tens of thousands of songs.
+
+On disk an index is a directory with a snapshot (vectors.npy, ids.json) written by
+batch builds, plus an append-only inserts.jsonl for incremental inserts. Several
+processes (e.g. web server workers) can insert; each picks up the others' inserts
+with refresh().
+
+Usage:
+    python similarity_index.py build --index similarity --audio input/ --analysis-cache ../webpage/static/cache/analysis
+    python similarity_index.py add --index similarity "input/Coldplay - Clocks.mp3"
+    python similarity_index.py query --index similarity "input/Coldplay - Clocks.mp3" -k 10
+    python similarity_index.py bench --songs 50000
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import time
+import warnings
+
+import numpy as np
+
+STEMS = ['drums', 'bass', 'vocals', 'other', 'guitar', 'piano']
+MIX_METRICS = ['spectral_contrast', 'energy_differentiation', 'onset_strength', 'percussive_rms']
+STEM_METRICS = ['percussive_rms', 'onset_strength']
+FEATURES = (['tempo', 'beats_per_measure', 'beat_strength_mean', 'beat_strength_std', 'strong_beat_ratio',
+             'beat_interval_cv']
+            + MIX_METRICS
+            + [f"{stem}_{metric}" for stem in STEMS for metric in STEM_METRICS])
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3', '.ogg', '.opus')
+# Spectral contrast needs its top band (200 Hz * 2^6) below Nyquist
+METRICS_SAMPLE_RATE = 22050
+
+
+def beat_statistics(beat_times, beat_strengths, strong_threshold=0.7):
+    """Beat strength and regularity features from beat times and 0-1 strengths"""
+    beat_times = np.asarray(beat_times, dtype=float)
+    beat_strengths = np.asarray(beat_strengths, dtype=float)
+    features = {}
+    if len(beat_strengths):
+        features['beat_strength_mean'] = float(np.mean(beat_strengths))
+        features['beat_strength_std'] = float(np.std(beat_strengths))
+        features['strong_beat_ratio'] = float(np.mean(beat_strengths > strong_threshold))
+    if len(beat_times) > 2:
+        intervals = np.diff(beat_times)
+        features['beat_interval_cv'] = float(np.std(intervals) / np.mean(intervals)) if np.mean(intervals) else 0.0
+    return features
+
+
+def feature_vector(features):
+    """Vector in FEATURES order from a dict of named features; missing ones are NaN"""
+    return np.array([features.get(name, np.nan) for name in FEATURES], dtype=np.float32)
+
+
+def features_from_analysis(analysis, metrics=None, stem_ranking=None):
+    """
+    Feature vector from the web app's outputs.
+
+    Args:
+        analysis (dict): analyze_audio() result (tempo, time_sig, beats with strength)
+        metrics (dict): trackEvaluation metrics of the mix
+        stem_ranking (list): Stem ranking rows ({'stem', 'percussive_rms', 'onset_strength', ...})
+    """
+    features = {'tempo': analysis.get('tempo')}
+    if analysis.get('time_sig'):
+        # The app writes the detected beat grouping as the denominator of "4/x"
+        features['beats_per_measure'] = float(analysis['time_sig'].split('/')[1])
+    beats = analysis.get('beats') or []
+    features.update(beat_statistics([beat['time'] for beat in beats], [beat['strength'] for beat in beats]))
+    features.update({name: value for name, value in (metrics or {}).items() if name in MIX_METRICS})
+    for row in stem_ranking or []:
+        for metric in STEM_METRICS:
+            if metric in row:
+                features[f"{row['stem']}_{metric}"] = row[metric]
+    return feature_vector(features)
+
+
+def features_from_audio(path, sr=METRICS_SAMPLE_RATE, stem_dir=None):
+    """Feature vector computed directly from an audio file (and optionally its separated stems) with librosa"""
+    import librosa
+    import pcm_cache
+    from trackEvaluation import FeatureEngine, evaluate_stems
+
+    y, sr = pcm_cache.load(path, sr=sr)
+    engine = FeatureEngine(y, sr)
+    # The beat tracker reuses the onset envelope of the metrics
+    tempo, beat_frames = librosa.beat.beat_track(onset_envelope=engine.onset_envelope, sr=sr,
+                                                 hop_length=engine.hop_length)
+    envelope = engine.onset_envelope[beat_frames]
+    strengths = (envelope - envelope.min()) / (np.ptp(envelope) or 1.0) if len(envelope) else envelope
+    features = {'tempo': float(np.atleast_1d(tempo)[0]), 'beats_per_measure': 4.0}
+    features.update(beat_statistics(librosa.frames_to_time(beat_frames, sr=sr, hop_length=engine.hop_length),
+                                    strengths))
+    features.update({name: engine.metric(name) for name in MIX_METRICS})
+    if stem_dir:
+        for row in evaluate_stems(stem_dir, sr=11025, metrics=STEM_METRICS):
+            for metric in STEM_METRICS:
+                features[f"{row['stem']}_{metric}"] = row[metric]
+    return feature_vector(features)
+
+
+class SimilarityIndex:
+    """Nearest-neighbour index over song feature vectors (cosine similarity of standardized vectors)"""
+
+    # Restandardize everything once the library grew by this fraction since the statistics were computed
+    RESTANDARDIZE_GROWTH = 0.1
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.ids = []
+        self.meta = []
+        self.position = {}  # id -> row
+        self._raw = np.zeros((0, len(FEATURES)), dtype=np.float32)
+        self._normed = np.zeros((0, len(FEATURES)), dtype=np.float32)
+        self._stats = None  # (mean, std, count they were computed from)
+        self._log_offset = 0
+        self._version = None  # mtime of the loaded snapshot
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load_snapshot()
+            self.refresh()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, track_id):
+        return track_id in self.position
+
+    # Persistence
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _snapshot_version(self):
+        try:
+            return os.stat(self._path('ids.json')).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load_snapshot(self):
+        self.ids, self.meta, self.position = [], [], {}
+        self._raw = np.zeros((0, len(FEATURES)), dtype=np.float32)
+        self._normed = np.zeros_like(self._raw)
+        self._stats = None
+        self._log_offset = 0
+        self._version = self._snapshot_version()
+        if self._version is None:
+            return
+        with open(self._path('ids.json'), 'r') as f:
+            snapshot = json.load(f)
+        vectors = np.load(self._path('vectors.npy'))
+        self._insert_rows(snapshot['ids'], vectors, snapshot['meta'])
+
+    def refresh(self):
+        """Apply inserts appended to the log (also by other processes) since the last refresh"""
+        if not self.directory:
+            return 0
+        if self._snapshot_version() != self._version:
+            # Another process saved a new snapshot and started a new log
+            self._load_snapshot()
+        if not os.path.exists(self._path('inserts.jsonl')):
+            return 0
+        if os.path.getsize(self._path('inserts.jsonl')) < self._log_offset:
+            # Saved and truncated while we loaded the snapshot; that snapshot has every logged insert
+            self._load_snapshot()
+        with open(self._path('inserts.jsonl'), 'rb') as f:
+            f.seek(self._log_offset)
+            data = f.read()
+        # Only complete lines; a concurrent writer may be in the middle of one
+        end = data.rfind(b'\n') + 1
+        entries = [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+        self._log_offset += end
+        if entries:
+            self._insert_rows([entry['id'] for entry in entries],
+                              np.array([entry['vector'] for entry in entries], dtype=np.float32),
+                              [entry.get('meta') or {} for entry in entries])
+        return len(entries)
+
+    def save(self):
+        """Write a snapshot of all vectors and start a new insert log"""
+        with open(self._path('inserts.jsonl'), 'a') as log:
+            fcntl.lockf(log, fcntl.LOCK_EX)
+            self.refresh()
+            np.save(self._path('vectors.tmp.npy'), self._raw[:len(self.ids)])
+            with open(self._path('ids.tmp.json'), 'w') as f:
+                json.dump({'ids': self.ids, 'meta': self.meta, 'features': FEATURES}, f)
+            os.replace(self._path('vectors.tmp.npy'), self._path('vectors.npy'))
+            os.replace(self._path('ids.tmp.json'), self._path('ids.json'))
+            log.truncate(0)
+            self._log_offset = 0
+            self._version = self._snapshot_version()
+
+    # Building and inserting
+
+    def _insert_rows(self, ids, vectors, metas):
+        new_ids, new_rows, new_metas = [], [], []
+        for track_id, vector, meta in zip(ids, vectors, metas):
+            if self.position.get(track_id, -1) >= len(self.ids):
+                # Inserted earlier in this same batch, so it has no row yet
+                pending = self.position[track_id] - len(self.ids)
+                new_rows[pending] = vector
+                new_metas[pending] = meta
+            elif track_id in self.position:
+                # Re-inserting a song replaces its vector (e.g. once stem metrics are known)
+                row = self.position[track_id]
+                self._raw[row] = vector
+                self.meta[row] = meta
+                if self._stats is not None:
+                    self._normed[row] = self._normalize(vector[None, :])[0]
+            else:
+                self.position[track_id] = len(self.ids) + len(new_ids)
+                new_ids.append(track_id)
+                new_rows.append(vector)
+                new_metas.append(meta)
+        if not new_ids:
+            return
+
+        count = len(self.ids)
+        needed = count + len(new_ids)
+        if needed > len(self._raw):
+            # Grow geometrically so incremental inserts are amortized O(1)
+            capacity = max(needed, 2 * len(self._raw), 64)
+            raw = np.zeros((capacity, len(FEATURES)), dtype=np.float32)
+            raw[:count] = self._raw[:count]
+            normed = np.zeros_like(raw)
+            normed[:count] = self._normed[:count]
+            self._raw, self._normed = raw, normed
+        self._raw[count:needed] = np.array(new_rows, dtype=np.float32)
+        self.ids.extend(new_ids)
+        self.meta.extend(new_metas)
+
+        if self._stats is None or needed > self._stats[2] * (1 + self.RESTANDARDIZE_GROWTH):
+            self._standardize()
+        else:
+            self._normed[count:needed] = self._normalize(self._raw[count:needed])
+
+    def build(self, ids, vectors, metas=None):
+        """Replace the index contents with a batch of songs and save it"""
+        self.ids, self.meta, self.position = [], [], {}
+        self._raw = np.zeros((0, len(FEATURES)), dtype=np.float32)
+        self._normed = np.zeros_like(self._raw)
+        self._stats = None
+        self._insert_rows(list(ids), np.asarray(vectors, dtype=np.float32), metas or [{} for _ in ids])
+        if self.directory:
+            self.save()
+
+    def add(self, track_id, vector, meta=None):
+        """Insert (or replace) one song; appended to the insert log so other processes see it"""
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.directory:
+            entry = {'id': track_id, 'vector': [None if np.isnan(v) else float(v) for v in vector],
+                     'meta': meta or {}}
+            with open(self._path('inserts.jsonl'), 'a') as log:
+                fcntl.lockf(log, fcntl.LOCK_EX)
+                log.write(json.dumps(entry) + '\n')
+            # Picks up our own line and those of other processes written before it
+            self.refresh()
+        else:
+            self._insert_rows([track_id], vector[None, :], [meta or {}])
+
+    # Standardization
+
+    def _standardize(self):
+        raw = self._raw[:len(self.ids)]
+        with warnings.catch_warnings():
+            # Features that are missing for every song give all-NaN columns
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean = np.nanmean(raw, axis=0) if len(raw) else np.zeros(len(FEATURES))
+            std = np.nanstd(raw, axis=0) if len(raw) else np.ones(len(FEATURES))
+        mean = np.nan_to_num(mean)
+        std = np.where(np.isnan(std) | (std < 1e-9), 1.0, std)
+        self._stats = (mean.astype(np.float32), std.astype(np.float32), len(raw))
+        self._normed[:len(raw)] = self._normalize(raw)
+
+    def _normalize(self, vectors):
+        mean, std, _ = self._stats
+        z = np.nan_to_num((vectors - mean) / std)  # Missing features count as the library mean
+        norms = np.linalg.norm(z, axis=1, keepdims=True)
+        return z / np.where(norms > 0, norms, 1.0)
+
+    # Queries
+
+    def query(self, vector, k=10, exclude=None):
+        """The k most similar songs to a feature vector: [(id, cosine similarity, meta)], best first"""
+        count = len(self.ids)
+        if count == 0 or self._stats is None:
+            return []
+        q = self._normalize(np.asarray(vector, dtype=np.float32)[None, :])[0]
+        scores = self._normed[:count] @ q
+        if exclude is not None and exclude in self.position:
+            scores[self.position[exclude]] = -np.inf
+        k = min(k, count - (1 if exclude in self.position else 0))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[i], float(scores[i]), self.meta[i]) for i in top]
+
+    def query_id(self, track_id, k=10):
+        """Songs most similar to a song in the index (excluding itself)"""
+        if track_id not in self.position:
+            raise KeyError(track_id)
+        return self.query(self._raw[self.position[track_id]], k, exclude=track_id)
+
+
+def find_audio_files(inputs):
+    files = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            files.extend(sorted(os.path.join(entry, name) for name in os.listdir(entry)
+                                if name.lower().endswith(AUDIO_EXTENSIONS)))
+        else:
+            files.append(entry)
+    return files
+
+
+def load_analysis_cache(cache_dir, separated_dir=None):
+    """(ids, vectors, metas) from the web app's analysis cache, with stem rankings of finished separations"""
+    ids, vectors, metas = [], [], []
+    for name in sorted(os.listdir(cache_dir)):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(cache_dir, name), 'r') as f:
+            entry = json.load(f)
+        analysis = entry.get('analysis')
+        if not analysis or analysis.get('is_midi'):
+            continue
+        ranking = None
+        job_id = entry.get('separation_job_id')
+        if separated_dir and job_id and os.path.exists(os.path.join(separated_dir, job_id, 'ranking.json')):
+            with open(os.path.join(separated_dir, job_id, 'ranking.json'), 'r') as f:
+                ranking = json.load(f)
+        ids.append(os.path.splitext(name)[0])
+        vectors.append(features_from_analysis(analysis, entry.get('metrics'), ranking))
+        metas.append({'audio_url': analysis.get('audio_url')})
+    return ids, vectors, metas
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find similar songs by their analysis features')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Build an index from audio files and/or the web analysis cache')
+    build_parser.add_argument('--index', default='similarity', help='Index directory')
+    build_parser.add_argument('--audio', nargs='*', default=[], help='Audio files or directories')
+    build_parser.add_argument('--analysis-cache', default=None, help='Web app analysis cache (static/cache/analysis)')
+    build_parser.add_argument('--separated', default=None, help='Web app separated folder, for stem metrics')
+
+    add_parser = subparsers.add_parser('add', help='Insert audio files into an existing index')
+    add_parser.add_argument('audio', nargs='+')
+    add_parser.add_argument('--index', default='similarity')
+    add_parser.add_argument('--stems', default=None, help='Directory with the separated stems of the (single) file')
+
+    query_parser = subparsers.add_parser('query', help='Most similar songs to an indexed id or an audio file')
+    query_parser.add_argument('song', help='Song id in the index, or an audio file')
+    query_parser.add_argument('--index', default='similarity')
+    query_parser.add_argument('-k', type=int, default=10)
+
+    bench_parser = subparsers.add_parser('bench', help='Query latency on random vectors')
+    bench_parser.add_argument('--songs', type=int, default=50000)
+    bench_parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        ids, vectors, metas = [], [], []
+        if args.analysis_cache:
+            ids, vectors, metas = load_analysis_cache(args.analysis_cache, args.separated)
+        for path in find_audio_files(args.audio):
+            start = time.time()
+            ids.append(os.path.abspath(path))
+            vectors.append(features_from_audio(path))
+            metas.append({'path': os.path.abspath(path)})
+            print(f"{path}: {time.time() - start:.1f}s")
+        index = SimilarityIndex(args.index)
+        index.build(ids, vectors, metas)
+        print(f"Indexed {len(index)} songs in {args.index}")
+
+    elif args.command == 'add':
+        index = SimilarityIndex(args.index)
+        for path in find_audio_files(args.audio):
+            index.add(os.path.abspath(path), features_from_audio(path, stem_dir=args.stems),
+                      {'path': os.path.abspath(path)})
+            print(f"Added {path}")
+        index.save()
+        print(f"{len(index)} songs in {args.index}")
+
+    elif args.command == 'query':
+        index = SimilarityIndex(args.index)
+        start = time.perf_counter()
+        if args.song in index:
+            results = index.query_id(args.song, args.k)
+        elif os.path.abspath(args.song) in index:
+            results = index.query_id(os.path.abspath(args.song), args.k)
+        else:
+            results = index.query(features_from_audio(args.song), args.k)
+        elapsed = (time.perf_counter() - start) * 1000
+        for rank, (track_id, score, meta) in enumerate(results, 1):
+            print(f"{rank:>3}. {score:.3f}  {meta.get('path') or meta.get('audio_url') or track_id}")
+        print(f"({len(index)} songs, {elapsed:.1f} ms)")
+
+    elif args.command == 'bench':
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(args.songs, len(FEATURES))).astype(np.float32)
+        index = SimilarityIndex()
+        start = time.perf_counter()
+        index.build([str(i) for i in range(args.songs)], vectors)
+        print(f"Batch build of {args.songs} songs: {(time.perf_counter() - start) * 1000:.0f} ms")
+        start = time.perf_counter()
+        for i in range(1000):
+            index.add(f"new{i}", rng.normal(size=len(FEATURES)))
+        print(f"Incremental insert: {(time.perf_counter() - start):.3f} ms per song")
+        latencies = []
+        for i in rng.integers(0, args.songs, args.queries):
+            start = time.perf_counter()
+            index.query_id(str(i), 10)
+            latencies.append((time.perf_counter() - start) * 1000)
+        print(f"Top-10 query: median {np.median(latencies):.2f} ms, p95 {np.percentile(latencies, 95):.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Multi-resolution log-mel spectrogram tiles for zoomable views of a song.
+
+One STFT pass over the decoded signal (from the PCM cache, 22050 Hz mono, 2048-point
+frames every 256 samples, i.e. 11.6 ms) gives the finest level. Every further level
+halves the time resolution by taking the maximum of pairs of frames, so onsets stay
+visible when zoomed out, until the whole song fits in one tile. Values are in dB below
+the loudest bin of the song, clipped at -80 dB and quantized to uint8 (0 = -80 dB,
+255 = 0 dB, 0.3 dB steps).
+
+Every level is cut into tiles of TILE_FRAMES frames, each stored as its own file of
+n_mels x frames bytes (32 KB, row 0 = lowest mel band), so zooming into any measure
+costs one or two small cached fetches:
+
+    <directory>/manifest.json       parameters, duration and the frames of every level
+    <directory>/<level>/<tile>.bin  tile `tile` of level `level`
+
+A set is written to a temporary directory and renamed into place, so a directory with a
+manifest is complete; an existing complete set is never replaced by a concurrent build.
+
+Usage:
+    python spectrogram_tiles.py build "input/Coldplay - Clocks.mp3" --out tiles/clocks
+    python spectrogram_tiles.py info tiles/clocks --start 30 --end 32.5 --width 800
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+SAMPLE_RATE = 22050
+N_FFT = 2048
+HOP_LENGTH = 256
+N_MELS = 128
+TILE_FRAMES = 256
+DB_RANGE = 80.0
+STFT_BLOCK_FRAMES = 4096
+
+
+def quantize(db):
+    """dB in [-DB_RANGE, 0] to uint8"""
+    return np.round((np.clip(db, -DB_RANGE, 0.0) + DB_RANGE) * (255 / DB_RANGE)).astype(np.uint8)
+
+
+def dequantize(values):
+    return values.astype(np.float32) * (DB_RANGE / 255) - DB_RANGE
+
+
+def build_levels(y, sr):
+    """[level 0, level 1, ...] quantized log-mel spectrograms (n_mels x frames), each half as long as the previous"""
+    import librosa
+    # The STFT is taken in blocks of frames, so a long song never holds its full complex spectrogram
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=N_FFT, n_mels=N_MELS)
+    padded = np.pad(y, N_FFT // 2)  # Frames centered on multiples of the hop, as librosa's center=True
+    n_frames = 1 + len(y) // HOP_LENGTH
+    mel = np.empty((N_MELS, n_frames), dtype=np.float32)
+    for first in range(0, n_frames, STFT_BLOCK_FRAMES):
+        count = min(STFT_BLOCK_FRAMES, n_frames - first)
+        segment = padded[first * HOP_LENGTH:(first + count - 1) * HOP_LENGTH + N_FFT]
+        segment = np.pad(segment, (0, (count - 1) * HOP_LENGTH + N_FFT - len(segment)))
+        power = np.abs(librosa.stft(segment, n_fft=N_FFT, hop_length=HOP_LENGTH, center=False)) ** 2
+        mel[:, first:first + count] = mel_basis @ power
+    levels = [quantize(librosa.power_to_db(mel, ref=np.max, top_db=DB_RANGE))]
+    while levels[-1].shape[1] > TILE_FRAMES:
+        level = levels[-1]
+        if level.shape[1] % 2:
+            level = np.concatenate([level, level[:, -1:]], axis=1)
+        levels.append(np.maximum(level[:, 0::2], level[:, 1::2]))
+    return levels
+
+
+def build(path, directory, cache_dir=None):
+    """Compute all levels of an audio file and write their tiles and the manifest to `directory`"""
+    from pcm_cache import load as load_pcm
+    y, sr = load_pcm(path, sr=SAMPLE_RATE, mono=True, cache_dir=cache_dir)
+    levels = build_levels(y, sr)
+
+    # Written next to the final directory and moved in place, so readers never see half a set
+    tmp_directory = f"{os.path.normpath(directory)}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(os.path.dirname(os.path.abspath(directory)), exist_ok=True)
+    manifest = {
+        'sample_rate': sr, 'n_fft': N_FFT, 'hop_length': HOP_LENGTH, 'n_mels': N_MELS, 'fmin': 0.0,
+        'fmax': sr / 2, 'tile_frames': TILE_FRAMES, 'db_range': DB_RANGE, 'duration': round(len(y) / sr, 3),
+        'levels': [],
+    }
+    for number, level in enumerate(levels):
+        os.makedirs(os.path.join(tmp_directory, str(number)))
+        for tile in range(math.ceil(level.shape[1] / TILE_FRAMES)):
+            data = np.ascontiguousarray(level[:, tile * TILE_FRAMES:(tile + 1) * TILE_FRAMES])
+            with open(os.path.join(tmp_directory, str(number), f'{tile}.bin'), 'wb') as f:
+                f.write(data.tobytes())
+        manifest['levels'].append({
+            'level': number,
+            'frames': int(level.shape[1]),
+            'tiles': math.ceil(level.shape[1] / TILE_FRAMES),
+            'seconds_per_frame': HOP_LENGTH * 2 ** number / sr,
+        })
+    with open(os.path.join(tmp_directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    try:
+        os.replace(tmp_directory, directory)
+    except OSError:
+        # The directory exists: a complete set another process built meanwhile is kept,
+        # anything without a manifest is left over from an interrupted build and replaced
+        if load_manifest(directory) is None:
+            shutil.rmtree(directory, ignore_errors=True)
+            try:
+                os.replace(tmp_directory, directory)
+                return manifest
+            except OSError:
+                if load_manifest(directory) is None:
+                    raise
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    return manifest
+
+
+def load_manifest(directory):
+    """Manifest of a complete tile set, or None"""
+    try:
+        with open(os.path.join(directory, 'manifest.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def tiles_for(manifest, start, end, width):
+    """
+    Level and tile numbers covering start..end seconds with at least `width` frames
+    (one per pixel), using the coarsest such level; the finest level if none has enough.
+    """
+    start, end = max(0.0, start), max(start, end)
+    chosen = manifest['levels'][0]
+    for level in manifest['levels']:
+        if (end - start) / level['seconds_per_frame'] >= width:
+            chosen = level
+    # Frame i is centered on i * seconds_per_frame
+    first_frame = max(0, int(math.floor(start / chosen['seconds_per_frame'])))
+    last_frame = min(chosen['frames'] - 1, int(math.ceil(end / chosen['seconds_per_frame'])))
+    first_tile = min(first_frame // TILE_FRAMES, chosen['tiles'] - 1)
+    last_tile = max(first_tile, min(last_frame // TILE_FRAMES, chosen['tiles'] - 1))
+    return chosen, list(range(first_tile, last_tile + 1))
+
+
+def read_tile(directory, level, tile, manifest=None):
+    """Quantized tile as an (n_mels x frames) uint8 array"""
+    manifest = manifest or load_manifest(directory)
+    data = np.fromfile(os.path.join(directory, str(level), f'{tile}.bin'), dtype=np.uint8)
+    return data.reshape(manifest['n_mels'], -1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi-resolution spectrogram tiles')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Compute the tiles of an audio file')
+    build_parser.add_argument('audio', help='Audio file')
+    build_parser.add_argument('--out', required=True, help='Directory for the tiles')
+    info_parser = subparsers.add_parser('info', help='Show the levels, and the tiles covering a time range')
+    info_parser.add_argument('directory', help='Directory of a tile set')
+    info_parser.add_argument('--start', type=float, default=None, help='Start of the range in seconds')
+    info_parser.add_argument('--end', type=float, default=None, help='End of the range in seconds')
+    info_parser.add_argument('--width', type=int, default=1000, help='Pixels the range is drawn on')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        manifest = build(args.audio, args.out)
+        size = sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(args.out) for name in names)
+        print(f"{args.audio}: {manifest['duration']:.0f}s, {len(manifest['levels'])} levels, "
+              f"{sum(level['tiles'] for level in manifest['levels'])} tiles, {size / 1024 ** 2:.1f} MB "
+              f"in {time.perf_counter() - start:.2f}s")
+    elif args.command == 'info':
+        manifest = load_manifest(args.directory)
+        if manifest is None:
+            print(f"No complete tile set in {args.directory}")
+            return
+        for level in manifest['levels']:
+            print(f"level {level['level']:>2}: {level['frames']:>7} frames of {level['seconds_per_frame'] * 1000:7.1f} ms"
+                  f" in {level['tiles']:>4} tiles")
+        if args.start is not None:
+            end = args.end if args.end is not None else manifest['duration']
+            level, tiles = tiles_for(manifest, args.start, end, args.width)
+            print(f"{args.start}-{end}s on {args.width} px: level {level['level']}, tiles {tiles}")
+
+
+if __name__ == '__main__':
+    main()
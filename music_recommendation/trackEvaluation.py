@@ -1,45 +1,208 @@
+#!/usr/bin/env python3
+"""
+Beat separability and rhythmic clarity metrics of separated stems.
+
+All spectral metrics are derived from a single STFT per signal: spectral contrast from
+its magnitude, onset strength from the mel spectrogram of its power, and the
+percussive RMS from the harmonic-percussive separation of the same STFT. RMS energy
+is framed directly from the signal. Scoring a 6-stem separation therefore costs one
+STFT (plus one HPSS) per stem.
+
+Usage:
+    python trackEvaluation.py output/htdemucs_6s/audio_07 --csv audio_07_metrics.csv
+    python trackEvaluation.py output/audio_07/other.wav
+"""
+
+import argparse
+import csv
+import os
+import time
+
 import librosa
 import numpy as np
 
-# Load the audio file
-audio_path = 'output/audio_07/other.wav'
-y, sr = librosa.load(audio_path, sr=None)
-
-# ----------------------------
-# 1. Beat Separability
-# ----------------------------
-
-# Spectral Contrast
-spectral_contrast = librosa.feature.spectral_contrast(y=y, sr=sr)
-mean_spectral_contrast = np.mean(spectral_contrast)
-print(f"Mean Spectral Contrast: {mean_spectral_contrast}")
-
-# Energy Differentiation
-rms_energy = librosa.feature.rms(y=y)
-onsets = librosa.onset.onset_detect(y=y, sr=sr, units='frames')
-beat_rms = rms_energy[:, onsets]
-non_beat_rms = np.delete(rms_energy, onsets, axis=1)
-mean_beat_rms = np.mean(beat_rms)
-mean_non_beat_rms = np.mean(non_beat_rms)
-energy_differentiation = mean_beat_rms - mean_non_beat_rms
-print(f"Energy Differentiation: {energy_differentiation}")
-
-# Temporal Clarity
-onset_strength = librosa.onset.onset_strength(y=y, sr=sr)
-mean_onset_strength = np.mean(onset_strength)
-print(f"Mean Onset Strength: {mean_onset_strength}")
-
-# Harmonic-Percussive Separation
-y_harmonic, y_percussive = librosa.effects.hpss(y)
-percussive_rms = librosa.feature.rms(y=y_percussive)
-mean_percussive_rms = np.mean(percussive_rms)
-print(f"Mean Percussive RMS Energy: {mean_percussive_rms}")
-
-# ----------------------------
-# 2. Rhythmic Clarity
-# ----------------------------
-
-# Beat Salience
-beat_strength = librosa.onset.onset_strength(y=y, sr=sr)
-mean_beat_strength = np.mean(beat_strength)
-print(f"Mean Beat Strength: {mean_beat_strength}")
\ No newline at end of file
+import pcm_cache
+
+N_FFT = 2048
+HOP_LENGTH = 512
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3', '.ogg', '.opus')
+
+# Metric name -> description, in table order
+METRICS = {
+    # 1. Beat separability
+    'spectral_contrast': 'Mean Spectral Contrast',
+    'energy_differentiation': 'Energy Differentiation',
+    'onset_strength': 'Mean Onset Strength',  # Temporal clarity
+    'percussive_rms': 'Mean Percussive RMS Energy',
+    # 2. Rhythmic clarity
+    'beat_strength': 'Mean Beat Strength',  # Beat salience
+}
+
+# Stems are ranked by rhythmic clarity with cheap features on a downsampled signal,
+# so the beat tracking only has to run on the best stem (web app and pipeline.py)
+RANKING_SAMPLE_RATE = 11025
+RANKING_METRICS = ['percussive_rms', 'onset_strength']
+
+
+class FeatureEngine:
+    """
+    Lazily derived spectral features of one signal, all sharing one STFT.
+    Only the features needed by the requested metrics are computed.
+    """
+
+    def __init__(self, y, sr, n_fft=N_FFT, hop_length=HOP_LENGTH):
+        self.y = y
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self._cache = {}
+
+    def _get(self, name, compute):
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    @property
+    def stft(self):
+        return self._get('stft', lambda: librosa.stft(self.y, n_fft=self.n_fft, hop_length=self.hop_length))
+
+    @property
+    def magnitude(self):
+        return self._get('magnitude', lambda: np.abs(self.stft))
+
+    @property
+    def rms(self):
+        # Framed time-domain RMS needs no transform and keeps the values of rms(y=...)
+        return self._get('rms', lambda: librosa.feature.rms(y=self.y, frame_length=self.n_fft,
+                                                            hop_length=self.hop_length))
+
+    @property
+    def onset_envelope(self):
+        # Same mel/dB front end onset_strength(y=...) uses, fed from the shared STFT
+        def compute():
+            mel = librosa.feature.melspectrogram(S=self.magnitude ** 2, sr=self.sr)
+            return librosa.onset.onset_strength(S=librosa.power_to_db(mel), sr=self.sr,
+                                                hop_length=self.hop_length)
+        return self._get('onset_envelope', compute)
+
+    @property
+    def onsets(self):
+        return self._get('onsets', lambda: librosa.onset.onset_detect(
+            onset_envelope=self.onset_envelope, sr=self.sr, hop_length=self.hop_length, units='frames'))
+
+    @property
+    def percussive_rms(self):
+        # HPSS on the existing STFT (librosa.effects.hpss would compute its own); only the
+        # percussive part is transformed back
+        def compute():
+            _, percussive = librosa.decompose.hpss(self.stft)
+            y_percussive = librosa.istft(percussive, hop_length=self.hop_length, length=len(self.y))
+            return librosa.feature.rms(y=y_percussive, frame_length=self.n_fft, hop_length=self.hop_length)
+        return self._get('percussive_rms', compute)
+
+    def metric(self, name):
+        if name == 'spectral_contrast':
+            return float(np.mean(librosa.feature.spectral_contrast(S=self.magnitude, sr=self.sr,
+                                                                   n_fft=self.n_fft, hop_length=self.hop_length)))
+        if name == 'energy_differentiation':
+            onsets = self.onsets[self.onsets < self.rms.shape[1]]
+            if len(onsets) == 0 or len(onsets) == self.rms.shape[1]:
+                return 0.0
+            beat_rms = self.rms[:, onsets]
+            non_beat_rms = np.delete(self.rms, onsets, axis=1)
+            return float(np.mean(beat_rms) - np.mean(non_beat_rms))
+        if name in ('onset_strength', 'beat_strength'):
+            return float(np.mean(self.onset_envelope))
+        if name == 'percussive_rms':
+            return float(np.mean(self.percussive_rms))
+        raise ValueError(f"Unknown metric: {name}")
+
+
+def evaluate_signal(y, sr, metrics=None):
+    """Metrics (default: all of METRICS) of one signal as a dict"""
+    engine = FeatureEngine(y, sr)
+    return {name: engine.metric(name) for name in (metrics or METRICS)}
+
+
+def evaluate_file(path, sr=None, metrics=None):
+    y, sr = pcm_cache.load(path, sr=sr)
+    return evaluate_signal(y, sr, metrics)
+
+
+def rank_by_clarity(rows, metrics=RANKING_METRICS):
+    """
+    Sort stem rows ({'stem', <metric>: value, ...}) best first, adding their 'score': each
+    metric scaled by its maximum over the stems, then averaged.
+    """
+    maxima = {metric: max(row[metric] for row in rows) or 1.0 for metric in metrics}
+    for row in rows:
+        row['score'] = round(float(np.mean([row[metric] / maxima[metric] for metric in metrics])), 4)
+    return sorted(rows, key=lambda row: row['score'], reverse=True)
+
+
+def find_stems(stem_dir):
+    return sorted(os.path.join(stem_dir, name) for name in os.listdir(stem_dir)
+                  if name.lower().endswith(AUDIO_EXTENSIONS))
+
+
+def evaluate_stems(stems, sr=None, metrics=None):
+    """
+    Evaluate every stem of a separated song.
+
+    Args:
+        stems (str or list): Directory with the stems, or a list of audio files
+        sr (int): Resample to this rate before evaluating (None keeps the native rate)
+        metrics (list): Metric names (default: all of METRICS)
+
+    Returns:
+        list: One row per stem: {'stem', 'path', 'seconds', <metric>: value, ...}
+    """
+    paths = find_stems(stems) if isinstance(stems, str) else list(stems)
+    rows = []
+    for path in paths:
+        start = time.perf_counter()
+        row = {'stem': os.path.splitext(os.path.basename(path))[0], 'path': path}
+        row.update(evaluate_file(path, sr, metrics))
+        row['seconds'] = round(time.perf_counter() - start, 3)
+        rows.append(row)
+    return rows
+
+
+def format_table(rows, metrics=None):
+    metrics = [name for name in (metrics or METRICS) if any(name in row for row in rows)]
+    header = f"{'stem':<12}" + ''.join(f"{name:>24}" for name in metrics) + f"{'seconds':>10}"
+    lines = [header, '-' * len(header)]
+    for row in rows:
+        lines.append(f"{row['stem']:<12}" + ''.join(f"{row[name]:>24.4f}" for name in metrics)
+                     + f"{row['seconds']:>10.2f}")
+    return '\n'.join(lines)
+
+
+def write_csv(rows, path):
+    fields = ['stem'] + [name for name in METRICS if name in rows[0]] + ['seconds', 'path']
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Beat separability and rhythmic clarity metrics of stems')
+    parser.add_argument('inputs', nargs='+', help='Directory of stems and/or audio files')
+    parser.add_argument('--sr', type=int, default=None, help='Resample before evaluating (default: native rate)')
+    parser.add_argument('--csv', default=None, help='Also write the table to this CSV file')
+    args = parser.parse_args()
+
+    paths = []
+    for entry in args.inputs:
+        paths.extend(find_stems(entry) if os.path.isdir(entry) else [entry])
+
+    rows = evaluate_stems(paths, args.sr)
+    print(format_table(rows))
+    if args.csv:
+        write_csv(rows, args.csv)
+        print(f"Saved metrics to {args.csv}")
+
+
+if __name__ == '__main__':
+    main()
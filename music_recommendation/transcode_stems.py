@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Transcode separated stems to FLAC for archival and to compact lossy formats for playback.
+
+All stems x formats are encoded in parallel with ffmpeg. A manifest.json is written next to
+the stems listing every variant, which the web app uses to pick the right file per client.
+
+Usage:
+    python transcode_stems.py output/htdemucs_6s/audio_example --formats flac opus mp3
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+MANIFEST_NAME = 'manifest.json'
+
+# ffmpeg encoder settings per output format
+FORMATS = {
+    # 24-bit FLAC keeps the float32 Demucs output (clipped/rescaled to -1..1) losslessly enough for analysis
+    'flac': {'ext': 'flac', 'mime': 'audio/flac',
+             'args': ['-c:a', 'flac', '-sample_fmt', 's32', '-bits_per_raw_sample', '24', '-compression_level', '8']},
+    'opus': {'ext': 'opus', 'mime': 'audio/ogg; codecs=opus',
+             'args': ['-c:a', 'libopus', '-b:a', '96k', '-vbr', 'on']},
+    'mp3': {'ext': 'mp3', 'mime': 'audio/mpeg',
+            'args': ['-c:a', 'libmp3lame', '-q:a', '4']},
+}
+DEFAULT_FORMATS = ['flac', 'opus', 'mp3']
+
+
+def transcode_file(wav_path, fmt):
+    """Encode one WAV file to the given format; returns the output path."""
+    settings = FORMATS[fmt]
+    output_path = f"{os.path.splitext(wav_path)[0]}.{settings['ext']}"
+    tmp_path = f"{output_path}.part"
+    command = ['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-i', wav_path,
+               *settings['args'], '-f', 'ogg' if fmt == 'opus' else fmt, tmp_path]
+    subprocess.run(command, check=True, capture_output=True, text=True)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def load_manifest(stem_dir):
+    manifest_path = os.path.join(stem_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def transcode_stems(stem_dir, formats=None, keep_wav=False, workers=None):
+    """
+    Transcode every WAV stem in a directory to the requested formats in parallel.
+
+    Args:
+        stem_dir (str): Directory with the separated <stem>.wav files
+        formats (list): Formats to produce (keys of FORMATS)
+        keep_wav (bool): Keep the original WAV files; otherwise they are removed once
+            every variant of the stem was written successfully
+        workers (int): Number of concurrent ffmpeg processes (default: number of CPUs)
+
+    Returns:
+        The manifest dict: {'stems': {stem: {format: {'file', 'size', 'mime'}}}}
+    """
+    formats = formats or DEFAULT_FORMATS
+    start_time = time.time()
+    stems = sorted(os.path.splitext(f)[0] for f in os.listdir(stem_dir) if f.endswith('.wav'))
+    manifest = load_manifest(stem_dir) or {'stems': {}}
+
+    failed = set()
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = {pool.submit(transcode_file, os.path.join(stem_dir, f"{stem}.wav"), fmt): (stem, fmt)
+                   for stem in stems for fmt in formats}
+        for future in as_completed(futures):
+            stem, fmt = futures[future]
+            try:
+                output_path = future.result()
+            except FileNotFoundError:
+                print("ffmpeg not found! Stems are left as WAV files.")
+                return manifest
+            except subprocess.CalledProcessError as e:
+                print(f"Error transcoding {stem} to {fmt}: {e.stderr.strip()}")
+                failed.add(stem)
+                continue
+            manifest['stems'].setdefault(stem, {})[fmt] = {
+                'file': os.path.basename(output_path),
+                'size': os.path.getsize(output_path),
+                'mime': FORMATS[fmt]['mime'],
+            }
+
+    for stem in stems:
+        wav_path = os.path.join(stem_dir, f"{stem}.wav")
+        if keep_wav or stem in failed:
+            manifest['stems'].setdefault(stem, {})['wav'] = {
+                'file': f"{stem}.wav", 'size': os.path.getsize(wav_path), 'mime': 'audio/wav'}
+        else:
+            manifest['stems'][stem].pop('wav', None)
+
+    # Write the manifest before deleting anything so there is always a playable variant listed
+    manifest_path = os.path.join(stem_dir, MANIFEST_NAME)
+    with open(f"{manifest_path}.tmp", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+    if not keep_wav:
+        for stem in stems:
+            if stem not in failed:
+                os.remove(os.path.join(stem_dir, f"{stem}.wav"))
+
+    elapsed = time.time() - start_time
+    print(f"Transcoded {len(stems)} stems to {', '.join(formats)} in {elapsed:.1f} seconds")
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcode separated stems to FLAC and lossy playback formats")
+    parser.add_argument("stem_dir", help="Directory containing the separated WAV stems")
+    parser.add_argument("--formats", nargs='+', default=DEFAULT_FORMATS, choices=sorted(FORMATS))
+    parser.add_argument("--keep-wav", action="store_true", help="Keep the original WAV files")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Concurrent ffmpeg processes")
+    args = parser.parse_args()
+
+    manifest = transcode_stems(args.stem_dir, args.formats, args.keep_wav, args.workers)
+    for stem, variants in sorted(manifest['stems'].items()):
+        sizes = ', '.join(f"{fmt} {info['size'] / 1024 / 1024:.1f} MB" for fmt, info in sorted(variants.items()))
+        print(f"- {stem}: {sizes}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,27 @@
 import os
+import re
+import sys
 import uuid
-import numpy as np
-import subprocess
 import time
 import json
-from flask import Flask, render_template, request, send_from_directory, jsonify
-from madmom.features import DBNBeatTrackingProcessor, RNNBeatProcessor
-from madmom.features.tempo import TempoEstimationProcessor
-import librosa
+from flask import Flask, render_template, request, jsonify
 import tempfile
 import argparse
-import mido  # Import mido for MIDI file handling
-
-# Custom JSON encoder to handle NumPy types
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        elif isinstance(obj, np.bool_):
-            return bool(obj)
-        return super(NumpyEncoder, self).default(obj)
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.storage import StorageManager
+from utils.http_cache import send_cached_file, write_precompressed
+from utils.ingest import AnalysisCache, IngestRequest, ResumableUploads
+from utils.serialization import dumps, json_response
+from utils.analysis import configure as configure_analysis
+# analysis_warmup, get_beat_processors, preload_analysis and start_activation_workers are used by serve.py
+# and the benchmarks
+from utils.analysis import (analysis_warmup, analyze_audio, get_beat_processors, preload_analysis,  # noqa: F401
+                            start_activation_workers)
+from utils.admission import AdmissionController, AdmissionRejected, audio_duration, physical_memory_mb
+from utils.compute import FINAL_STATES, create_backend, file_status, load_job, new_job
+from utils.stems import ANALYSIS_FORMATS, load_ranking, stem_files
+from werkzeug.http import parse_content_range_header
 
 app = Flask(__name__)
 app.config.update({
@@ -32,94 +30,237 @@ app.config.update({
     'SEPARATED_FOLDER': 'static/separated',
     'MIDI_FOLDER': 'static/midi',  # Add MIDI folder
     'ALLOWED_EXTENSIONS': {'wav', 'mp3', 'mid'},  # Add 'mid' as allowed extension
-    'MAX_CONTENT_LENGTH': 50 * 1024 * 1024
+    'MAX_CONTENT_LENGTH': 50 * 1024 * 1024,
+    # Disk quotas in bytes per artifact kind, enforced by LRU eviction in the background
+    'STORAGE_INDEX': 'static/storage_index.sqlite3',
+    'STORAGE_QUOTAS': {
+        'upload': 2 * 1024 ** 3,
+        'stems': 10 * 1024 ** 3,
+        'midi_track': 200 * 1024 ** 2,
+        'script': 10 * 1024 ** 2,
+        'incoming': 1024 ** 3,
+        'cache': 500 * 1024 ** 2,
+    },
+    'STORAGE_COMPACTION_INTERVAL': 300,
+    # Uploads are streamed into INCOMING_FOLDER and moved to <content id>.<ext> once complete
+    'INCOMING_FOLDER': 'static/incoming',
+    'ANALYSIS_CACHE_FOLDER': 'static/cache/analysis',
+    'MAX_RESUMABLE_UPLOAD': 500 * 1024 * 1024,
+    # Resumable uploads without a new chunk for this long are abandoned and removed
+    'RESUMABLE_UPLOAD_MAX_AGE': 24 * 3600,
+    # Feature vectors of analyzed songs for "find similar songs"; the compaction pass folds
+    # the insert log into a new snapshot once it is larger than SIMILARITY_LOG_MAX_BYTES
+    'SIMILARITY_INDEX_FOLDER': 'static/cache/similarity',
+    'SIMILARITY_LOG_MAX_BYTES': 1024 ** 2,
+    # Threads per server worker computing the mix metrics of uploads after the response
+    'POSTPROCESS_WORKERS': 1,
+    # Acoustic fingerprints to recognize the same song in another encoding or trim
+    'FINGERPRINT_INDEX_FOLDER': 'static/cache/fingerprints',
+    # Quantized log-mel spectrogram tiles at several zoom levels of every upload and stem
+    'SPECTROGRAM_FOLDER': 'static/cache/spectrograms',
+    # Processes computing the beat activations of one long track in parallel windows
+    # (per server worker; serve.py sets it to the CPUs divided by its server workers)
+    'ACTIVATION_WORKERS': os.cpu_count() or 1,
+    # Analyses and local separations are admitted against a memory budget shared by all
+    # server workers; jobs that do not fit wait up to ADMISSION_MAX_WAIT seconds, then get a 503
+    'ADMISSION_FOLDER': 'static/cache/admission',
+    'MEMORY_BUDGET_MB': int(physical_memory_mb() * 0.7),
+    'ADMISSION_MAX_WAIT': 20,
+    'ADMISSION_MAX_QUEUE': 8,
+    # Where separation and offloaded analysis jobs run: 'inprocess' (threads of the server
+    # worker), 'local' (child processes), 'slurm' (sbatch) or 'auto' (slurm where sbatch exists)
+    'COMPUTE_BACKENDS': {'separation': 'auto', 'analysis': 'inprocess'},
+    'COMPUTE_WORKERS': 2,  # Jobs running at once per server worker (inprocess and local)
+    'COMPUTE_JOBS_FOLDER': 'static/jobs',
+    # Longer tracks are analyzed as a job on the analysis backend, shorter ones in the request
+    'ANALYSIS_OFFLOAD_SECONDS': 600,
+    'ANALYSIS_JOB_TIMEOUT': 900,
+    # sbatch options per job kind, on top of the defaults in compute_job.sh
+    'SLURM_OPTIONS': {
+        'separation': ['--job-name=demucs_separation', '--partition=gpu', '--gpus-per-task=1',
+                       '--cpus-per-task=8', '--mem=16G', '--time=00:30:00', '--output=demucs_%j.log'],
+        'analysis': ['--job-name=beat_analysis', '--partition=compute', '--cpus-per-task=8',
+                     '--mem=8G', '--time=00:20:00', '--output=analysis_%j.log'],
+    }
 })
 
+configure_analysis(app.config['ACTIVATION_WORKERS'])
+started_at = time.time()
+
 os.makedirs(app.config['AUDIO_FOLDER'], exist_ok=True)
 os.makedirs(app.config['SEPARATED_FOLDER'], exist_ok=True)
 os.makedirs(app.config['MIDI_FOLDER'], exist_ok=True)  # Create MIDI folder
 
-def analyze_audio(filepath):
-    # Process audio with Madmom
-    beat_processor = DBNBeatTrackingProcessor(fps=100)
-    act_processor = RNNBeatProcessor()(filepath)
-    beats = beat_processor(act_processor)
-    
-    # Convert beat times to integer indices (multiply by fps to get frame indices)
-    beat_indices = (beats * 100).astype(int)  # fps is 100
-    
-    # Get beat activation values for strength
-    beat_activations = act_processor[beat_indices]
-    
-    # Normalize activations to 0-1 range
-    beat_activations = (beat_activations - np.min(beat_activations)) / (np.max(beat_activations) - np.min(beat_activations))
-    
-    # Estimate tempo
-    tempo_processor = TempoEstimationProcessor(fps=100)(act_processor)
-    tempo = int(round(tempo_processor[np.argmax(tempo_processor[:, 1])][0]))
-    
-    # Detect time signature
-    intervals = np.diff(beats)
-    best_denominator = 4
-    if len(intervals) > 3:
-        median_interval = np.median(intervals)
-        scores = []
-        for denom in [2, 3, 4, 6, 8]:
-            scores.append(np.sum(np.abs(intervals - (median_interval * denom))))
-        best_denominator = [2, 3, 4, 6, 8][np.argmin(scores)]
-    
-    # Create measures and beats
+# Track size and last access of everything written under static/ (compaction starts with the server)
+storage = StorageManager(app.config['STORAGE_INDEX'], app.config['STORAGE_QUOTAS'],
+                         app.config['STORAGE_COMPACTION_INTERVAL'])
+storage.watch('stems', app.config['SEPARATED_FOLDER'], directories=True)
+storage.watch('script', os.path.join(app.config['AUDIO_FOLDER'], 'scripts'))
+storage.watch('upload', app.config['AUDIO_FOLDER'])
+storage.watch('midi_track', app.config['MIDI_FOLDER'], match='_track_')
+storage.watch('upload', app.config['MIDI_FOLDER'])
+storage.watch('incoming', app.config['INCOMING_FOLDER'])
+storage.watch('incoming', os.path.join(app.config['INCOMING_FOLDER'], 'resumable'),
+              max_age=app.config['RESUMABLE_UPLOAD_MAX_AGE'])
+storage.watch('cache', app.config['ANALYSIS_CACHE_FOLDER'])
+storage.watch('cache', app.config['COMPUTE_JOBS_FOLDER'], directories=True)
+storage.watch('cache', app.config['SPECTROGRAM_FOLDER'], directories=True)
+
+# Stream uploads to disk while hashing them, and reuse analyses of identical content
+app.request_class = IngestRequest
+analysis_cache = AnalysisCache(app.config['ANALYSIS_CACHE_FOLDER'])
+app.extensions['analysis_cache'] = analysis_cache
+resumable_uploads = ResumableUploads(os.path.join(app.config['INCOMING_FOLDER'], 'resumable'),
+                                     app.config['MAX_RESUMABLE_UPLOAD'], on_prefix=analysis_cache.prefetch)
+admission = AdmissionController(app.config['ADMISSION_FOLDER'], app.config['MEMORY_BUDGET_MB'],
+                                app.config['ADMISSION_MAX_WAIT'], app.config['ADMISSION_MAX_QUEUE'])
+
+MUSIC_RECOMMENDATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'music_recommendation')
+# Makes trackEvaluation, separate_tracks, similarity_index, fingerprint, pcm_cache and spectrogram_tiles importable
+sys.path.append(MUSIC_RECOMMENDATION_DIR)
+
+# Analysis tiers: 'accurate' (madmom) and 'fast' (librosa on a downsampled signal, for
+# previews and library scans); each is cached in its own field of the analysis cache
+ANALYSIS_MODES = ('accurate', 'fast')
+ANALYSIS_CACHE_FIELDS = {'accurate': 'analysis', 'fast': 'analysis_fast'}
+
+def requested_analysis_mode():
+    """Analysis mode of the request (form field or query argument 'mode', default 'accurate')"""
+    mode = request.values.get('mode', 'accurate')
+    if mode not in ANALYSIS_MODES:
+        raise ValueError(f"Unknown analysis mode: {mode} (use {' or '.join(ANALYSIS_MODES)})")
+    return mode
+
+# Similarity index over all analyzed uploads, opened lazily in every (forked) process
+_similarity_index = None
+
+def get_similarity_index():
+    global _similarity_index
+    if _similarity_index is None:
+        from similarity_index import SimilarityIndex
+        _similarity_index = SimilarityIndex(app.config['SIMILARITY_INDEX_FOLDER'])
+    return _similarity_index
+
+def compact_similarity_index():
+    """Fold the similarity index's insert log into a new snapshot once it grew large (storage maintenance task)"""
+    log_path = os.path.join(app.config['SIMILARITY_INDEX_FOLDER'], 'inserts.jsonl')
+    if os.path.exists(log_path) and os.path.getsize(log_path) > app.config['SIMILARITY_LOG_MAX_BYTES']:
+        get_similarity_index().save()
+        print(f"Similarity index: saved a snapshot of {len(get_similarity_index())} songs")
+
+storage.add_maintenance(compact_similarity_index)
+
+def index_similar_song(content_id):
+    """Insert or update the feature vector of an analyzed upload from its cached analysis, metrics and stem ranking"""
+    from similarity_index import features_from_analysis
+    entry = analysis_cache.get(content_id) or {}
+    analysis = entry.get('analysis') or entry.get('analysis_fast')
+    if analysis is None:
+        return
+    ranking = None
+    job_id = entry.get('separation_job_id')
+    ranking_path = os.path.join(app.config['SEPARATED_FOLDER'], job_id, 'ranking.json') if job_id else None
+    if ranking_path and os.path.exists(ranking_path):
+        with open(ranking_path, 'r') as f:
+            ranking = json.load(f)
+    vector = features_from_analysis(analysis, entry.get('metrics'), ranking)
+    get_similarity_index().add(content_id, vector, {'audio_url': analysis.get('audio_url')})
+
+# Fingerprint index of all analyzed uploads, opened lazily in every (forked) process
+_fingerprint_index = None
+
+def get_fingerprint_index():
+    global _fingerprint_index
+    if _fingerprint_index is None:
+        from fingerprint import FingerprintIndex
+        _fingerprint_index = FingerprintIndex(app.config['FINGERPRINT_INDEX_FOLDER'])
+    return _fingerprint_index
+
+def shift_analysis(analysis, offset, duration):
+    """
+    Analysis of a song for a copy that starts `offset` seconds later in the song (earlier
+    if negative) and lasts `duration` seconds; beats outside the copy are dropped.
+    """
+    duration = round(float(duration), 2)
     measures = []
-    current_measure = 1
-    beat_count = 0
-    current_measure_beats = []
-    
-    # Get duration from librosa
-    y, sr = librosa.load(filepath, sr=44100, mono=True)
-    duration = round(float(librosa.get_duration(y=y, sr=sr)), 2)
-    
-    for i, beat in enumerate(beats):
-        # Add beat information
-        beat_info = {
-            'time': round(float(beat), 2),
-            'strength': round(float(beat_activations[i]), 2),
-            'is_strong': bool(beat_activations[i] > 0.7)  # Convert NumPy bool_ to Python bool
-        }
-        
-        # Start a new measure if we've reached the beat count for the current measure
-        if beat_count % best_denominator == 0:
-            if current_measure_beats:  # If we have beats from the previous measure
-                measures.append({
-                    'number': current_measure,
-                    'start': current_measure_beats[0]['time'],
-                    'end': round(float(beat), 2),
-                    'beats': current_measure_beats.copy()  # Make a copy of the beats for this measure
-                })
-                current_measure += 1
-            current_measure_beats = []  # Reset beats for next measure
-        
-        current_measure_beats.append(beat_info)
-        beat_count += 1
-    
-    # Add the last measure if it has any beats
-    if current_measure_beats:
-        measures.append({
-            'number': current_measure,
-            'start': current_measure_beats[0]['time'],
-            'end': duration,
-            'beats': current_measure_beats
-        })
+    for measure in analysis['measures']:
+        beats = [dict(beat, time=round(beat['time'] - offset, 2)) for beat in measure['beats']]
+        beats = [beat for beat in beats if 0 <= beat['time'] <= duration]
+        if beats:
+            measures.append({
+                'number': len(measures) + 1,
+                'start': beats[0]['time'],
+                'end': min(round(measure['end'] - offset, 2), duration),
+                'beats': beats
+            })
+    shifted = dict(analysis, measures=measures, duration=duration)
+    shifted['beats'] = [beat for measure in measures for beat in measure['beats']]
+    return shifted
+
+def reuse_fingerprint_match(save_path, content_id, prefix_digest):
+    """
+    Reuse the analysis of an earlier upload of the same song in another encoding or trim.
+    Returns the analysis, or None after adding the upload's fingerprint to the index.
+    """
+    from fingerprint import fingerprint_file
+    with admission.admit('fingerprint', save_path):
+        hashes, times, duration = fingerprint_file(save_path)
+    index = get_fingerprint_index()
+    index.refresh()
+    match = index.identify(hashes, times)
+    known = analysis_cache.get(match['song_id']) if match and match['song_id'] != content_id else None
+    if not known or 'analysis' not in known or known['analysis'].get('is_midi'):
+        index.add(content_id, hashes, times)
+        return None
+
+    print(f"{os.path.basename(save_path)} is {match['song_id']} ({match['aligned']} aligned hashes, "
+          f"offset {match['offset']:+.2f}s)")
+    analysis = shift_analysis(known['analysis'], match['offset'], duration)
+    analysis['audio_url'] = f"/audio/{os.path.basename(save_path)}"
+    entry = {'analysis': analysis,
+             'fingerprint_match': {'content_id': match['song_id'], 'confidence': match['confidence'],
+                                   'offset': match['offset']}}
+    # Stems only line up with the new file if it was not trimmed
+    if abs(match['offset']) < 0.05 and known.get('separation_job_id'):
+        entry['separation_job_id'] = known['separation_job_id']
+    analysis_cache.put(content_id, prefix_digest, **entry)
+    return analysis
+
+def admitted_analysis(filepath, mode='accurate'):
+    """analyze_audio() once the memory budget admits it; raises AdmissionRejected when the server is busy"""
+    with admission.admit(f"analysis_{mode}", filepath):
+        return analyze_audio(filepath, mode)
+
+def run_analysis(filepath, mode='accurate'):
+    """
+    analyze_audio() in this request, or for tracks longer than ANALYSIS_OFFLOAD_SECONDS as
+    a job on the analysis compute backend (unless that is 'inprocess') that the request waits for.
+    """
+    duration = audio_duration(filepath)
+    # An inprocess job would only move the analysis to another thread of this worker
+    if duration <= app.config['ANALYSIS_OFFLOAD_SECONDS'] or app.config['COMPUTE_BACKENDS']['analysis'] == 'inprocess':
+        return admitted_analysis(filepath, mode)
     
-    return {
-        'tempo': tempo,
-        'time_sig': f"4/{best_denominator}",
-        'measures': measures,
-        'duration': duration,
-        'beats': [beat for measure in measures for beat in measure['beats']]  # Flatten beats for overall list
-    }
+    job_id = f"ana_{uuid.uuid4().hex}"
+    folder = app.config['COMPUTE_JOBS_FOLDER']
+    backend = get_compute_backend('analysis')
+    job = backend.submit(new_job(job_id, 'analysis', os.path.join(folder, job_id), 'utils.analysis:analyze_audio',
+                                 [os.path.abspath(filepath), mode],
+                                 memory_kind=f"analysis_{mode}", duration=duration))
+    deadline = time.time() + app.config['ANALYSIS_JOB_TIMEOUT']
+    status = check_job_status(job_id, folder)
+    while status['status'] not in FINAL_STATES and time.time() < deadline:
+        time.sleep(0.5)
+        status = check_job_status(job_id, folder)
+    if status['status'] != 'completed':
+        backend.cancel(job)
+        raise RuntimeError(f"Analysis job {job_id} did not complete: "
+                           f"{status.get('error_details') or status['status']}")
+    return backend.result(job)
 
 def analyze_midi(filepath):
     """Analyze a MIDI file and extract track information"""
+    import mido  # Imported on first use to keep the server start fast
     midi_data = mido.MidiFile(filepath)
     
     # Calculate duration in seconds
@@ -155,7 +296,7 @@ def analyze_midi(filepath):
             'number': i,
             'name': track.name if hasattr(track, 'name') and track.name else f'Track {i}',
             'notes_count': sum(1 for msg in track if msg.type == 'note_on'),
-            'program_changes': [msg for msg in track if msg.type == 'program_change'],
+            'program_changes': [msg.program for msg in track if msg.type == 'program_change'],
             'instruments': []
         }
         
@@ -222,203 +363,96 @@ def analyze_midi(filepath):
         'tracks': tracks
     }
 
+# Compute backends by name, created on first use in every (forked) server worker
+_compute_backends = {}
+
+def get_compute_backend(name):
+    """Backend by name ('inprocess', 'local', 'slurm', 'auto') or by job kind ('separation', 'analysis')"""
+    name = app.config['COMPUTE_BACKENDS'].get(name, name)
+    if name not in _compute_backends:
+        _compute_backends[name] = create_backend(name, app.config['COMPUTE_WORKERS'], admission,
+                                                 app.config['SLURM_OPTIONS'])
+    return _compute_backends[name]
+
 def submit_separation_job(audio_path, job_id):
-    """Submit a track separation job to DelftBlue or run locally if sbatch is not available"""
+    """Submit a track separation job to the separation compute backend (SLURM on DelftBlue, local processes elsewhere)"""
     output_dir = os.path.join(app.config['SEPARATED_FOLDER'], job_id)
-    os.makedirs(output_dir, exist_ok=True)
+    backend = get_compute_backend('separation')
+    job = new_job(job_id, 'separation', output_dir, 'compute_job:separate',
+                  [os.path.abspath(audio_path), os.path.abspath(output_dir), job_id],
+                  {'device': 'cuda' if backend.name == 'slurm' else None,
+                   'spectrogram_folder': os.path.abspath(app.config['SPECTROGRAM_FOLDER'])},
+                  audio_path=audio_path, memory_kind='separation', duration=audio_duration(audio_path))
+    job = backend.submit(job)
     
-    # Path to the separation script
-    script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'separate_tracks.sh')
-    
-    # Make the script executable
-    os.chmod(script_path, 0o755)
-    
-    # First, check if we're on DelftBlue by testing if sbatch is available
-    try:
-        subprocess.run(['which', 'sbatch'], check=True, capture_output=True, text=True)
-        use_slurm = True
-    except subprocess.CalledProcessError:
-        use_slurm = False
-    
-    job_info = {
-        'job_id': job_id,
-        'status': 'submitted',
-        'audio_path': audio_path,
-        'output_dir': output_dir,
-        'submit_time': time.time(),
-        'use_slurm': use_slurm
-    }
-    
-    if use_slurm:
-        # Convert relative path to absolute path for DelftBlue
-        abs_audio_path = os.path.abspath(audio_path)
-        abs_output_dir = os.path.abspath(output_dir)
+    # Keep the input and the growing stem set from being evicted while the job runs
+    if job['status'] != 'error':
+        storage.register('stems', output_dir, in_flight=True)
+        storage.pin(audio_path)
         
-        # Submit the job to SLURM
-        cmd = ['sbatch', script_path, abs_audio_path, abs_output_dir, job_id]
-        try:
-            result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-            # Extract job ID from SLURM output (usually "Submitted batch job 12345")
-            slurm_job_id = result.stdout.strip().split()[-1]
-            job_info['slurm_job_id'] = slurm_job_id
-            print(f"Successfully submitted job {slurm_job_id} for {job_id}")
-        except subprocess.CalledProcessError as e:
-            print(f"Error submitting job: {e}")
-            print(f"STDOUT: {e.stdout}")
-            print(f"STDERR: {e.stderr}")
-            job_info['status'] = 'error'
-            job_info['error_message'] = f"STDOUT: {e.stdout}, STDERR: {e.stderr}"
-            
-            # Create an error log file for debugging
-            with open(os.path.join(output_dir, f"{job_id}_error.log"), 'w') as f:
-                f.write(f"Command: {' '.join(cmd)}\n")
-                f.write(f"Error: {str(e)}\n")
-                f.write(f"STDOUT: {e.stdout}\n")
-                f.write(f"STDERR: {e.stderr}\n")
-    else:
-        # Run locally in a separate process
-        print("SLURM not available, running separation locally in background")
-        job_info['status'] = 'running'
-        
-        # Create a simple script to run locally
-        local_script = f"""#!/bin/bash
-echo "Starting local separation for file: {audio_path}"
-echo "Output directory: {output_dir}"
-
-# Run demucs if available, otherwise just create dummy files for testing
-if command -v demucs &> /dev/null; then
-    python -m demucs.separate -n htdemucs "{audio_path}" -o "{output_dir}"
-else
-    # Create dummy files for testing
-    mkdir -p "{output_dir}/htdemucs/test"
-    touch "{output_dir}/htdemucs/test/drums.wav"
-    touch "{output_dir}/htdemucs/test/bass.wav"
-    touch "{output_dir}/htdemucs/test/vocals.wav"
-    touch "{output_dir}/htdemucs/test/other.wav"
-fi
-
-echo "completed" > "{output_dir}/{job_id}_status.txt"
-echo "Separation completed"
-"""
-        local_script_path = os.path.join(output_dir, f"{job_id}_local.sh")
-        with open(local_script_path, 'w') as f:
-            f.write(local_script)
-        os.chmod(local_script_path, 0o755)
-        
-        # Run in background
-        subprocess.Popen(
-            ['/bin/bash', local_script_path], 
-            stdout=open(os.path.join(output_dir, f"{job_id}_local.log"), 'w'),
-            stderr=subprocess.STDOUT
-        )
-    
-    # Save job info
-    with open(os.path.join(output_dir, f"{job_id}_info.json"), 'w') as f:
-        json.dump(job_info, f)
-        
-    return job_info
+    return job
 
-def check_job_status(job_id):
-    """Check the status of a separation job"""
+def release_separation_job(job_id):
+    """Unpin a finished separation job's artifacts and record the final size of its stems"""
     output_dir = os.path.join(app.config['SEPARATED_FOLDER'], job_id)
-    status_file = os.path.join(output_dir, f"{job_id}_status.txt")
-    error_log = os.path.join(output_dir, f"{job_id}_error.log")
-    
-    # Check for completed status
-    if os.path.exists(status_file):
-        with open(status_file, 'r') as f:
-            status = f.read().strip()
-        return {'status': status}
-    
-    # Check for error log
-    if os.path.exists(error_log):
-        with open(error_log, 'r') as f:
-            error_content = f.read()
-        return {'status': 'error', 'error_details': error_content}
-    
-    # If status file doesn't exist, check if the job info exists
     info_file = os.path.join(output_dir, f"{job_id}_info.json")
     if os.path.exists(info_file):
         with open(info_file, 'r') as f:
-            job_info = json.load(f)
-        
-        # If job already has error status, return it with details
-        if job_info.get('status') == 'error':
-            return {
-                'status': 'error', 
-                'error_details': job_info.get('error_message', 'Unknown error')
-            }
-        
-        # Check if using SLURM
-        if job_info.get('use_slurm', False) and 'slurm_job_id' in job_info:
-            # Check SLURM job status
-            slurm_job_id = job_info['slurm_job_id']
-            cmd = ['squeue', '-j', slurm_job_id, '-h']
-            try:
-                result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-                if result.stdout.strip():
-                    # Job is in the queue, check its state
-                    state = result.stdout.strip().split()[4] if len(result.stdout.strip().split()) > 4 else "UNKNOWN"
-                    if state == "PD":
-                        return {'status': 'pending', 'details': 'Job is pending in the queue'}
-                    elif state == "R":
-                        return {'status': 'running', 'details': 'Job is running'}
-                    else:
-                        return {'status': 'queued', 'details': f'Job state: {state}'}
-                else:
-                    # Job not in queue, check if it completed without creating a status file
-                    sacct_cmd = ['sacct', '-j', slurm_job_id, '--format=State', '--noheader']
-                    try:
-                        sacct_result = subprocess.run(sacct_cmd, check=True, capture_output=True, text=True)
-                        state = sacct_result.stdout.strip().split()[0] if sacct_result.stdout.strip() else "UNKNOWN"
-                        if state == "COMPLETED":
-                            # Job completed but status file wasn't created, create it now
-                            with open(status_file, 'w') as f:
-                                f.write("completed")
-                            return {'status': 'completed'}
-                        elif state in ["FAILED", "TIMEOUT", "CANCELLED"]:
-                            return {'status': 'error', 'error_details': f'SLURM job {slurm_job_id} ended with state {state}'}
-                        else:
-                            return {'status': 'unknown', 'details': f'SLURM job state: {state}'}
-                    except:
-                        # Can't determine job state from sacct
-                        return {'status': 'unknown', 'details': 'Job not in queue and state unknown'}
-            except:
-                return {'status': 'unknown', 'details': 'Error checking SLURM job status'}
-        else:
-            # For local jobs, just return the status from job_info
-            return {'status': job_info.get('status', 'unknown')}
-    
-    return {'status': 'not_found'}
+            storage.unpin(json.load(f)['audio_path'])
+    storage.register('stems', output_dir)
+    storage.unpin(output_dir)
 
-def get_separated_tracks(job_id):
-    """Get the paths to separated tracks"""
-    output_dir = os.path.join(app.config['SEPARATED_FOLDER'], job_id)
+def check_job_status(job_id, folder=None):
+    """Check the status of a separation job (or of a job in another folder, e.g. COMPUTE_JOBS_FOLDER)"""
+    output_dir = os.path.join(folder or app.config['SEPARATED_FOLDER'], job_id)
     
-    # Check for the htdemucs output structure
-    model_dir = os.path.join(output_dir, 'htdemucs')
-    if not os.path.exists(model_dir):
-        return None
+    # The job's own files (status, error log, progress) are the same for every backend
+    status = file_status(output_dir, job_id)
+    if status is not None:
+        return status
     
-    # Find the audio file directory (named after the input file)
-    audio_dirs = [d for d in os.listdir(model_dir) if os.path.isdir(os.path.join(model_dir, d))]
-    if not audio_dirs:
-        return None
+    job = load_job(output_dir, job_id)
+    if job is None:
+        return {'status': 'not_found'}
+    # If job already has error status, return it with details
+    if job.get('status') == 'error':
+        return {
+            'status': 'error', 
+            'error_details': job.get('error_message', 'Unknown error')
+        }
+    return get_compute_backend(job['backend']).status(job)
+
+# Stem formats in order of preference; the transcoding stage lists the available ones in manifest.json
+PLAYBACK_FORMATS = ['opus', 'mp3', 'wav', 'flac']
+
+def client_audio_formats():
+    """Order the stem formats by what the requesting browser can play"""
+    requested = request.args.get('formats')
+    if requested:
+        preferred = [fmt.strip() for fmt in requested.split(',') if fmt.strip()]
+        return preferred + [fmt for fmt in PLAYBACK_FORMATS if fmt not in preferred]
     
-    audio_dir = os.path.join(model_dir, audio_dirs[0])
+    user_agent = request.headers.get('User-Agent', '')
+    if 'Safari' in user_agent and 'Chrome' not in user_agent and 'Chromium' not in user_agent:
+        # Older Safari versions cannot play Ogg Opus
+        return ['mp3', 'opus', 'wav', 'flac']
+    return PLAYBACK_FORMATS
+
+def get_separated_tracks(job_id, formats=None):
+    """Get the paths to separated tracks, picking for each stem the first available format in `formats`"""
+    formats = formats or PLAYBACK_FORMATS
+    output_dir = os.path.join(app.config['SEPARATED_FOLDER'], job_id)
     
-    # Get the separated tracks
-    tracks = {}
-    for track in os.listdir(audio_dir):
-        if track.endswith('.wav'):
-            track_name = os.path.splitext(track)[0]
-            tracks[track_name] = f"/separated/{job_id}/htdemucs/{audio_dirs[0]}/{track}"
+    files = stem_files(output_dir, formats)
+    if files is None:
+        return None
+    tracks = {track_name: f"/separated/{job_id}/{path}" for track_name, path in files.items()}
     
     # If no tracks found but we have a status file indicating completion,
     # create dummy tracks for testing
     if not tracks and os.path.exists(os.path.join(output_dir, f"{job_id}_status.txt")):
         # Create dummy files for testing UI
-        dummy_dir = os.path.join(model_dir, 'test')
+        dummy_dir = os.path.join(output_dir, 'htdemucs', 'test')
         os.makedirs(dummy_dir, exist_ok=True)
         
         # Create empty files if they don't exist
@@ -431,6 +465,169 @@ def get_separated_tracks(job_id):
     
     return tracks
 
+def separated_track_path(track_url):
+    """File path of a /separated/... track URL"""
+    return os.path.join(app.config['SEPARATED_FOLDER'], *track_url.split('/')[2:])
+
+def rank_stems(job_id):
+    """Stems of a finished separation ranked by rhythmic clarity, best first, as the job stored them; None if not ranked"""
+    return load_ranking(os.path.join(app.config['SEPARATED_FOLDER'], job_id))
+
+def index_separated_song(job_id):
+    """Add the stem ranking of a finished separation to its song's similarity vector, once per job"""
+    info_file = os.path.join(app.config['SEPARATED_FOLDER'], job_id, f"{job_id}_info.json")
+    if not os.path.exists(info_file):
+        return
+    with open(info_file, 'r') as f:
+        content_id = os.path.splitext(os.path.basename(json.load(f)['audio_path']))[0]
+    entry = analysis_cache.get(content_id)
+    if entry is None or entry.get('indexed_separation_job_id') == job_id:
+        return
+    try:
+        index_similar_song(content_id)
+        analysis_cache.put(content_id, indexed_separation_job_id=job_id)
+    except Exception as e:
+        print(f"Could not update the similarity index for job {job_id}: {e}")
+
+# Spectrogram tiles are keyed by the content id of an upload, or "<job id>_<stem>" for a stem
+SPECTROGRAM_KEY = re.compile(r'^[A-Za-z0-9_]+$')
+
+def build_spectrogram(key, audio_path):
+    """Compute the spectrogram tiles of an audio file under `key` (all zoom levels in one pass)"""
+    from spectrogram_tiles import build
+    directory = os.path.join(app.config['SPECTROGRAM_FOLDER'], key)
+    manifest = build(audio_path, directory)
+    storage.register('cache', directory)
+    return manifest
+
+def get_spectrogram(key):
+    """
+    (directory, manifest) of the spectrogram tiles of `key`, or None until they exist.
+    Tiles are only built by the upload post-processing and the separation job, never by a request.
+    """
+    from spectrogram_tiles import load_manifest
+    if not SPECTROGRAM_KEY.match(key):
+        return None
+    directory = os.path.join(app.config['SPECTROGRAM_FOLDER'], key)
+    manifest = load_manifest(directory)
+    return (directory, manifest) if manifest is not None else None
+
+# Uploads are post-processed (mix metrics, similarity index, spectrogram tiles) on a small thread pool of every
+# server worker, created on first use so each forked worker has its own
+_postprocess_pool = None
+_postprocessing = set()  # Content ids queued or running in this process
+_postprocess_lock = threading.Lock()
+POSTPROCESS_ATTEMPTS = 5
+
+def schedule_postprocess(content_id, save_path):
+    """Queue postprocess_upload() unless this process already queued the same content"""
+    global _postprocess_pool
+    with _postprocess_lock:
+        if content_id in _postprocessing:
+            return
+        _postprocessing.add(content_id)
+        if _postprocess_pool is None:
+            _postprocess_pool = ThreadPoolExecutor(max_workers=app.config['POSTPROCESS_WORKERS'],
+                                                   thread_name_prefix='postprocess')
+    _postprocess_pool.submit(postprocess_upload, content_id, save_path)
+
+def admitted_in_background(kind, path, function, *args, **kwargs):
+    """function(*args, **kwargs) as an admitted job of `kind`, retrying when the memory budget is committed"""
+    for attempt in range(POSTPROCESS_ATTEMPTS):
+        try:
+            with admission.admit(kind, path):
+                return function(*args, **kwargs)
+        except AdmissionRejected as e:
+            # Requests come first; try again when the earliest running job should be done
+            if attempt == POSTPROCESS_ATTEMPTS - 1:
+                raise
+            time.sleep(e.retry_after)
+
+def postprocess_upload(content_id, save_path):
+    """Mix metrics of an upload once the memory budget admits them, then its similarity vector and spectrogram tiles"""
+    filename = os.path.basename(save_path)
+    try:
+        if 'metrics' not in (analysis_cache.get(content_id) or {}):
+            from trackEvaluation import evaluate_file
+            from similarity_index import METRICS_SAMPLE_RATE, MIX_METRICS
+            metrics = admitted_in_background('mix_metrics', save_path, evaluate_file, save_path,
+                                             sr=METRICS_SAMPLE_RATE, metrics=MIX_METRICS)
+            analysis_cache.put(content_id, metrics=metrics)
+        index = get_similarity_index()
+        index.refresh()  # Another worker may have indexed the same content meanwhile
+        if content_id not in index:
+            index_similar_song(content_id)
+    except Exception as e:
+        print(f"Could not add {filename} to the similarity index: {e}")
+    try:
+        if get_spectrogram(content_id) is None:
+            admitted_in_background('spectrogram', save_path, build_spectrogram, content_id, save_path)
+    except Exception as e:
+        print(f"Could not compute the spectrogram of {filename}: {e}")
+    finally:
+        with _postprocess_lock:
+            _postprocessing.discard(content_id)
+
+def process_upload(save_path, ext, content_id, prefix_digest=None, separate=False, mode='accurate'):
+    """
+    Analyze a stored upload, reusing the analysis and separation of identical earlier uploads.
+    A fast request is also answered with an existing accurate analysis.
+    """
+    filename = os.path.basename(save_path)
+    storage.register('upload', save_path)
+    cached = analysis_cache.get(content_id) or {}
+    
+    if ext == 'mid':
+        analysis = cached.get('analysis')
+        if analysis is None:
+            write_precompressed(save_path)
+            analysis = analyze_midi(save_path)
+            analysis['midi_url'] = f"/midi/{filename}"
+            analysis['is_midi'] = True
+            analysis_cache.put(content_id, prefix_digest, analysis=analysis)
+        return analysis
+    
+    analysis = cached.get('analysis') or (cached.get('analysis_fast') if mode == 'fast' else None)
+    if analysis is None:
+        try:
+            analysis = reuse_fingerprint_match(save_path, content_id, prefix_digest)
+            cached = analysis_cache.get(content_id) or {}
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            print(f"Could not fingerprint {filename}: {e}")
+    if analysis is None:
+        analysis = run_analysis(save_path, mode)
+        analysis['audio_url'] = f"/audio/{filename}"
+        analysis_cache.put(content_id, prefix_digest, **{ANALYSIS_CACHE_FIELDS[mode]: json.loads(dumps(analysis))})
+    
+    # Mix metrics for the similarity index and spectrogram tiles for the zoomable view,
+    # computed once per content after the response
+    similarity_index = get_similarity_index()
+    similarity_index.refresh()  # Songs indexed by other workers
+    if ('metrics' not in cached or content_id not in similarity_index
+            or get_spectrogram(content_id) is None):
+        schedule_postprocess(content_id, save_path)
+    
+    # Submit separation job if requested, unless the same content was already separated
+    if separate:
+        separation_job_id = cached.get('separation_job_id')
+        status = check_job_status(separation_job_id)['status'] if separation_job_id else 'not_found'
+        if status in ('error', 'not_found', 'unknown', 'cancelled'):
+            separation_job_id = f"sep_{uuid.uuid4().hex}"
+            status = submit_separation_job(save_path, separation_job_id)['status']
+            analysis_cache.put(content_id, separation_job_id=separation_job_id)
+        analysis['separation_job_id'] = separation_job_id
+        analysis['separation_status'] = status
+    return analysis
+
+@app.teardown_request
+def discard_unstored_uploads(exc):
+    """Remove partial files of uploads that were rejected or failed before being stored"""
+    for writer in getattr(request, 'ingest_writers', []):
+        if os.path.exists(writer.part_path):
+            writer.discard()
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     analysis = None
@@ -446,48 +643,113 @@ def index():
             file = request.files['file']
             if file and file.filename.split('.')[-1].lower() in app.config['ALLOWED_EXTENSIONS']:
                 ext = file.filename.rsplit('.', 1)[1].lower()
-                uid = uuid.uuid4().hex
-                filename = f"{uid}.{ext}"
+                folder = app.config['MIDI_FOLDER'] if ext == 'mid' else app.config['AUDIO_FOLDER']
                 
-                if ext == 'mid':
-                    # Handle MIDI file
-                    save_path = os.path.join(app.config['MIDI_FOLDER'], filename)
-                    try:
-                        file.save(save_path)
-                        analysis = analyze_midi(save_path)
-                        analysis['midi_url'] = f"/midi/{filename}"
-                        analysis['is_midi'] = True
-                        is_midi = True
-                    except Exception as e:
-                        error = f"MIDI processing error: {str(e)}"
-                        if os.path.exists(save_path):
-                            os.remove(save_path)
-                else:
-                    # Handle audio file (existing functionality)
-                    save_path = os.path.join(app.config['AUDIO_FOLDER'], filename)
-                    try:
-                        file.save(save_path)
-                        analysis = analyze_audio(save_path)
-                        analysis['audio_url'] = f"/audio/{filename}"
-                        
-                        # Submit separation job if requested
-                        if request.form.get('separate_tracks') == 'true':
-                            separation_job_id = f"sep_{uid}"
-                            job_info = submit_separation_job(save_path, separation_job_id)
-                            analysis['separation_job_id'] = separation_job_id
-                            analysis['separation_status'] = job_info['status']
-                    except Exception as e:
-                        error = f"Processing error: {str(e)}"
-                        if os.path.exists(save_path):
-                            os.remove(save_path)
+                # The upload was streamed to disk and hashed while it arrived; give it its content-addressed name
+                writer = file.stream
+                content_id, save_path, duplicate = writer.store(folder, ext)
+                try:
+                    analysis = process_upload(save_path, ext, content_id, writer.prefix_digest,
+                                              request.form.get('separate_tracks') == 'true',
+                                              requested_analysis_mode())
+                    is_midi = ext == 'mid'
+                    separation_job_id = analysis.get('separation_job_id')
+                except AdmissionRejected:
+                    raise  # The stored upload is kept, so a retry is a quick duplicate
+                except Exception as e:
+                    error = f"{'MIDI processing' if ext == 'mid' else 'Processing'} error: {str(e)}"
+                    if not duplicate and os.path.exists(save_path):
+                        os.remove(save_path)
             else:
                 error = 'Invalid file format'
+    elif request.args.get('upload'):
+        # Result page of a resumable upload
+        content_id = os.path.splitext(os.path.basename(request.args['upload']))[0]
+        cached = analysis_cache.get(content_id) or {}
+        analysis = cached.get('analysis') or cached.get('analysis_fast')
+        if analysis:
+            is_midi = analysis.get('is_midi', False)
+            separation_job_id = cached.get('separation_job_id')
+            if separation_job_id:
+                analysis['separation_job_id'] = separation_job_id
+                analysis['separation_status'] = check_job_status(separation_job_id)['status']
+        else:
+            error = 'Upload not found'
+
+    # Scripts uploading with fetch() can ask for the analysis as JSON instead of the page
+    if request.method == 'POST' and request.accept_mimetypes.best == 'application/json':
+        if error:
+            return json_response({'error': error}, status=400)
+        return json_response(analysis)
 
     return render_template('index.html', analysis=analysis, error=error, separation_job_id=separation_job_id, is_midi=is_midi)
 
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload: {"filename": ..., "size": ...} -> upload id and offset"""
+    data = request.get_json(silent=True) or request.form
+    filename = data.get('filename', '')
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext not in app.config['ALLOWED_EXTENSIONS']:
+        return jsonify({'error': 'Invalid file format'}), 400
+    try:
+        upload_id = resumable_uploads.create(filename, int(data.get('size', 0)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 413
+    return jsonify({'upload_id': upload_id, 'offset': 0, 'size': int(data.get('size', 0))}), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """Offset to resume a resumable upload from"""
+    status = resumable_uploads.status(upload_id)
+    if status is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(status)
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """Append a chunk (Content-Range: bytes start-end/total); the last chunk triggers the analysis"""
+    content_range = parse_content_range_header(request.headers.get('Content-Range'))
+    start = content_range.start if content_range else 0
+    try:
+        status = resumable_uploads.append(upload_id, start, request.get_data())
+    except KeyError:
+        return jsonify({'error': 'Upload not found'}), 404
+    except ValueError as e:
+        # Chunk does not continue the upload; the client resumes from the returned offset
+        return jsonify({'error': 'Unexpected offset', 'offset': e.args[0]}), 409
+    for path in resumable_uploads.files(upload_id):
+        storage.touch(path)  # Uploads still receiving chunks do not expire
+    
+    if status['offset'] < status['size']:
+        return jsonify(status)
+    
+    filename = resumable_uploads.meta(upload_id)['filename']
+    ext = filename.rsplit('.', 1)[1].lower()
+    folder = app.config['MIDI_FOLDER'] if ext == 'mid' else app.config['AUDIO_FOLDER']
+    writer, content_id, save_path, duplicate = resumable_uploads.complete(upload_id, folder, ext)
+    try:
+        analysis = process_upload(save_path, ext, content_id, writer.prefix_digest,
+                                  request.args.get('separate_tracks') == 'true', requested_analysis_mode())
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        if not duplicate and os.path.exists(save_path):
+            os.remove(save_path)
+        return jsonify({'error': f"Processing error: {str(e)}"}), 500
+    
+    result = {
+        'status': 'complete',
+        'analysis': analysis,
+        'probe': writer.probe,
+        'result_url': f"/?upload={os.path.basename(save_path)}"
+    }
+    return json_response(result)
+
 @app.route('/audio/<filename>')
 def serve_audio(filename):
-    return send_from_directory(app.config['AUDIO_FOLDER'], filename)
+    storage.touch(os.path.join(app.config['AUDIO_FOLDER'], filename))
+    return send_cached_file(app.config['AUDIO_FOLDER'], filename)
 
 @app.route('/separated/<path:filename>')
 def serve_separated(filename):
@@ -495,46 +757,174 @@ def serve_separated(filename):
     parts = filename.split('/')
     directory = os.path.join(app.config['SEPARATED_FOLDER'], *parts[:-1])
     file = parts[-1]
-    return send_from_directory(directory, file)
+    storage.touch(os.path.join(directory, file))
+    # Stems of a running chunked separation are still growing
+    job_id = parts[0]
+    finished = os.path.exists(os.path.join(app.config['SEPARATED_FOLDER'], job_id, f"{job_id}_status.txt"))
+    return send_cached_file(directory, file, immutable=finished)
 
 @app.route('/check_separation/<job_id>')
 def check_separation(job_id):
     status = check_job_status(job_id)
     
+    if status['status'] in ('completed', 'error'):
+        release_separation_job(job_id)
+    
     if status['status'] == 'completed':
-        tracks = get_separated_tracks(job_id)
+        tracks = get_separated_tracks(job_id, client_audio_formats())
+        if tracks:
+            result = {'status': 'completed', 'tracks': tracks}
+            ranking = rank_stems(job_id)
+            if ranking:
+                result['ranking'] = ranking
+                result['best_stem'] = ranking[0]['stem']
+                index_separated_song(job_id)
+            return json_response(result)
+    elif status['status'] == 'running' and 'progress' in status:
+        # The first chunks of every stem can already be played
+        tracks = get_separated_tracks(job_id, client_audio_formats())
         if tracks:
-            return json.dumps({'status': 'completed', 'tracks': tracks}, cls=NumpyEncoder), 200, {'Content-Type': 'application/json'}
+            status['tracks'] = tracks
+            status['seconds_ready'] = status['progress']['seconds_ready']
     
-    return json.dumps(status, cls=NumpyEncoder), 200, {'Content-Type': 'application/json'}
+    return json_response(status)
 
 @app.route('/analyze_track/<job_id>/<track_name>')
 def analyze_track(job_id, track_name):
     """Analyze a specific separated track"""
-    # Get the separated tracks
-    tracks = get_separated_tracks(job_id)
+    # Get the separated tracks, preferring lossless variants for analysis
+    tracks = get_separated_tracks(job_id, ANALYSIS_FORMATS)
     if not tracks or track_name not in tracks:
         return jsonify({'error': 'Track not found'})
     
     # Get the full path to the track
-    track_url = tracks[track_name]
-    track_path = os.path.join(app.config['SEPARATED_FOLDER'], *track_url.split('/')[2:])
+    track_path = separated_track_path(tracks[track_name])
     
     if not os.path.exists(track_path):
         return jsonify({'error': 'Track file not found'})
     
     try:
         # Analyze the track
-        analysis = analyze_audio(track_path)
+        analysis = run_analysis(track_path, requested_analysis_mode())
         analysis['track_name'] = track_name
-        analysis['audio_url'] = track_url
-        return json.dumps(analysis, cls=NumpyEncoder), 200, {'Content-Type': 'application/json'}
+        analysis['audio_url'] = get_separated_tracks(job_id, client_audio_formats())[track_name]
+        return json_response(analysis)
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)})
+
+@app.route('/health')
+def health():
+    """Liveness: the server is serving requests, whether or not the analysis models are loaded yet"""
+    return jsonify({
+        'status': 'serving',
+        'analysis_ready': analysis_warmup.ready.is_set(),
+        'analysis': analysis_warmup.status(),
+        'admission': admission.status(),
+        'uptime': round(time.time() - started_at, 3)
+    })
+
+@app.route('/health/ready')
+def health_ready():
+    """Readiness: 200 once uploads can be analyzed without waiting for the models, 503 before"""
+    status = analysis_warmup.status()
+    if 'error' in status:
+        return jsonify({'status': 'error', 'analysis': status}), 500
+    if not status['ready']:
+        return jsonify({'status': 'loading', 'analysis': status}), 503, {'Retry-After': '2'}
+    return jsonify({'status': 'ready', 'analysis': status})
+
+@app.errorhandler(AdmissionRejected)
+def server_busy(e):
+    """503 with Retry-After when the memory budget is committed; the client retries later"""
+    headers = {'Retry-After': str(e.retry_after)}
+    if request.path == '/' and request.accept_mimetypes.best != 'application/json':
+        return render_template('index.html', analysis=None, error=f"{e}. Please try again in {e.retry_after}s.",
+                               separation_job_id=None, is_midi=False), 503, headers
+    return jsonify({'error': str(e), 'retry_after': e.retry_after}), 503, headers
+
+@app.route('/analyze_best/<job_id>')
+def analyze_best(job_id):
+    """Run the beat tracking only on the stem with the clearest rhythm"""
+    if check_job_status(job_id)['status'] != 'completed':
+        return jsonify({'error': 'Separation not completed'}), 409
+    ranking = rank_stems(job_id)
+    if not ranking:
+        return jsonify({'error': 'Stem ranking not found'}), 404
+    
+    best_stem = ranking[0]['stem']
+    tracks = get_separated_tracks(job_id, ANALYSIS_FORMATS)
+    try:
+        analysis = run_analysis(separated_track_path(tracks[best_stem]), requested_analysis_mode())
+    except AdmissionRejected:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)})
+    analysis['track_name'] = best_stem
+    analysis['audio_url'] = get_separated_tracks(job_id, client_audio_formats())[best_stem]
+    analysis['ranking'] = ranking
+    return json_response(analysis)
+
+@app.route('/similar/<content_id>')
+def similar_songs(content_id):
+    """Most similar analyzed songs to an upload (content id = its file name without extension)"""
+    k = min(max(request.args.get('k', 10, type=int), 1), 100)
+    index = get_similarity_index()
+    index.refresh()  # Songs added by other workers
+    if content_id not in index:
+        return jsonify({'error': 'Song not found'}), 404
+    results = [{'content_id': track_id, 'score': round(score, 4), 'audio_url': meta.get('audio_url')}
+               for track_id, score, meta in index.query_id(content_id, k)]
+    return json_response({'content_id': content_id, 'similar': results})
+
+@app.route('/spectrogram/<key>')
+def spectrogram_manifest(key):
+    """Parameters and zoom levels of the spectrogram tiles of an upload (content id) or a stem (<job id>_<stem>)"""
+    spectrogram = get_spectrogram(key)
+    if spectrogram is None:
+        return jsonify({'error': 'Spectrogram not found'}), 404
+    return json_response(spectrogram[1])
+
+@app.route('/spectrogram/<key>/tiles')
+def spectrogram_tiles(key):
+    """
+    Tiles covering ?start=..&end=.. seconds at the coarsest zoom level that still gives
+    one frame per pixel of ?width=.. (default: the whole song on 1000 pixels)
+    """
+    spectrogram = get_spectrogram(key)
+    if spectrogram is None:
+        return jsonify({'error': 'Spectrogram not found'}), 404
+    from spectrogram_tiles import tiles_for
+    manifest = spectrogram[1]
+    start = request.args.get('start', 0.0, type=float)
+    end = request.args.get('end', manifest['duration'], type=float)
+    width = min(max(request.args.get('width', 1000, type=int), 1), 10000)
+    level, tiles = tiles_for(manifest, start, end, width)
+    return json_response({
+        'level': level['level'],
+        'seconds_per_frame': level['seconds_per_frame'],
+        'n_mels': manifest['n_mels'],
+        'db_range': manifest['db_range'],
+        'tiles': [{'url': f"/spectrogram/{key}/{level['level']}/{tile}",
+                   'first_frame': tile * manifest['tile_frames'],
+                   'frames': min(manifest['tile_frames'], level['frames'] - tile * manifest['tile_frames'])}
+                  for tile in tiles],
+    })
+
+@app.route('/spectrogram/<key>/<int:level>/<int:tile>')
+def spectrogram_tile(key, level, tile):
+    """One tile: n_mels x frames uint8 values, row-major, lowest mel band first"""
+    if not SPECTROGRAM_KEY.match(key):
+        return jsonify({'error': 'Spectrogram not found'}), 404
+    directory = os.path.join(app.config['SPECTROGRAM_FOLDER'], key)
+    storage.touch(directory)
+    return send_cached_file(os.path.join(directory, str(level)), f"{tile}.bin")
 
 @app.route('/midi/<filename>')
 def serve_midi(filename):
-    return send_from_directory(app.config['MIDI_FOLDER'], filename)
+    storage.touch(os.path.join(app.config['MIDI_FOLDER'], filename))
+    return send_cached_file(app.config['MIDI_FOLDER'], filename)
 
 @app.route('/midi_track/<filename>/<int:track_num>')
 def get_midi_track(filename, track_num):
@@ -545,6 +935,7 @@ def get_midi_track(filename, track_num):
         return jsonify({'error': 'MIDI file not found'}), 404
     
     try:
+        import mido  # Imported on first use to keep the server start fast
         midi_data = mido.MidiFile(filepath)
         
         if track_num >= len(midi_data.tracks):
@@ -562,6 +953,8 @@ def get_midi_track(filename, track_num):
         output_filename = f"{track_uid}_track_{track_num}.mid"
         output_path = os.path.join(app.config['MIDI_FOLDER'], output_filename)
         output_midi.save(output_path)
+        write_precompressed(output_path)
+        storage.register('midi_track', output_path)
         
         # Extract note data for browser playback
         # This is a simplified representation of MIDI notes
@@ -640,7 +1033,7 @@ def get_midi_track(filename, track_num):
                         notes.append(note_data)
                         del active_notes[msg.note]
         
-        return jsonify({
+        return json_response({
             'track_num': track_num,
             'track_url': f"/midi/{output_filename}",
             'notes': notes,
@@ -655,4 +1048,6 @@ if __name__ == '__main__':
     parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to run the server on (default: 127.0.0.1)')
     args = parser.parse_args()
     
+    storage.start()
+    analysis_warmup.start()
     app.run(host=args.host, port=args.port)
\ No newline at end of file
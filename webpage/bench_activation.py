@@ -0,0 +1,82 @@
+"""
+Scaling benchmark and consistency check of the windowed parallel beat activations.
+
+The activation function of each file is computed serially (RNNBeatProcessor over the
+whole signal) and with 1..N worker processes. For every worker count it reports the
+time, the speedup over the serial run, and how far the stitched activations deviate
+from the serial ones (largest absolute difference) together with the F-measure of the
+DBN beats decoded from them against the serial beats.
+
+With --check the run fails (exit status 1) when any deviation exceeds --tolerance or
+any beat F-measure is below --min-f-measure.
+
+Usage:
+    python bench_activation.py --workers 1 2 4 8
+    python bench_activation.py "../music_recommendation/input/Coldplay - Clocks.mp3" --check
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+import app as webapp
+from bench_analysis import beat_f_measure
+from utils.beat_activation import ParallelBeatActivation, window_activation
+
+DEFAULT_AUDIO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'music_recommendation', 'input',
+                             'Coldplay - Clocks.mp3')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling of the parallel beat activations over worker counts')
+    parser.add_argument('audio', nargs='*', default=[DEFAULT_AUDIO], help='Audio files')
+    parser.add_argument('--workers', type=int, nargs='+', default=None,
+                        help='Worker counts to run (default: 1, 2, 4, ... up to the CPU count)')
+    parser.add_argument('--window', type=float, default=45, help='Window length in seconds')
+    parser.add_argument('--overlap', type=float, default=5, help='Window overlap in seconds')
+    parser.add_argument('--check', action='store_true', help='Fail if the stitched activations deviate too much')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='Largest allowed absolute deviation')
+    parser.add_argument('--min-f-measure', type=float, default=0.99, help='Smallest allowed beat F-measure')
+    args = parser.parse_args()
+
+    cpus = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({min(2 ** i, cpus) for i in range(cpus.bit_length() + 1)})
+    rnn_processor, beat_processor = webapp.get_beat_processors()
+    failed = False
+
+    for path in args.audio:
+        y, sr = webapp.analysis_warmup.get().load_pcm(path, sr=44100, mono=True)
+        num_frames = int(np.ceil(len(y) / (sr // 100)))
+        start = time.perf_counter()
+        serial = window_activation(path, 0, num_frames)
+        serial_seconds = time.perf_counter() - start
+        serial_beats = beat_processor(serial)
+        print(f"\n{os.path.basename(path)}: {len(y) / sr:.0f}s of audio, serial activations {serial_seconds:.2f}s")
+        print(f"{'workers':>8}{'windows':>9}{'seconds':>10}{'speedup':>9}{'max diff':>10}{'F-measure':>11}")
+
+        for workers in worker_counts:
+            activation = ParallelBeatActivation(rnn_processor, workers, args.window, args.overlap)
+            activation(path)  # Starts the worker processes
+            start = time.perf_counter()
+            stitched = activation(path)
+            seconds = time.perf_counter() - start
+            activation.close()
+
+            difference = float(np.max(np.abs(stitched - serial)))
+            f_measure = beat_f_measure(serial_beats, beat_processor(stitched), skip=0)
+            print(f"{workers:>8}{len(activation.windows(num_frames)):>9}{seconds:>10.2f}"
+                  f"{serial_seconds / seconds:>8.1f}x{difference:>10.4f}{f_measure:>11.3f}")
+            if difference > args.tolerance or f_measure < args.min_f_measure:
+                failed = True
+
+    if args.check:
+        print(f"\nCheck {'FAILED' if failed else 'passed'} (max diff <= {args.tolerance}, "
+              f"F-measure >= {args.min_f_measure})")
+        sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
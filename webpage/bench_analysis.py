@@ -0,0 +1,121 @@
+"""
+Accuracy/latency benchmark of the fast analysis tier against the accurate (madmom) tier.
+
+For every audio file both tiers of analyze_audio() are timed (after one warm-up call, so
+model loading and decoding are not counted; both read the decoded audio from the PCM
+cache) and the fast beats are scored against the accurate ones:
+
+    F-measure   beats matched one-to-one within +-70 ms (the usual beat tracking
+                tolerance), ignoring the first 5 seconds like mir_eval does
+    tempo       whether the fast tempo is within 4% of the accurate one (x1, x2 or /2)
+
+Without madmom only the fast tier is timed.
+
+Usage:
+    python bench_analysis.py
+    python bench_analysis.py ../music_recommendation/input/*.mp3 --repeat 3 --json bench_analysis.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+
+import app as webapp
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUNDLED_AUDIO = os.path.join(HERE, '..', 'music_recommendation', 'input', '*.mp3')
+TOLERANCE = 0.07
+SKIP_SECONDS = 5.0
+
+
+def beat_f_measure(reference, estimated, tolerance=TOLERANCE, skip=SKIP_SECONDS):
+    """F-measure of estimated beat times against reference beat times (greedy one-to-one matching)"""
+    reference = np.asarray([t for t in reference if t >= skip])
+    estimated = np.asarray([t for t in estimated if t >= skip])
+    if len(reference) == 0 or len(estimated) == 0:
+        return 0.0
+    matched = 0
+    i = j = 0
+    while i < len(reference) and j < len(estimated):
+        difference = estimated[j] - reference[i]
+        if abs(difference) <= tolerance:
+            matched += 1
+            i += 1
+            j += 1
+        elif difference < 0:
+            j += 1
+        else:
+            i += 1
+    precision = matched / len(estimated)
+    recall = matched / len(reference)
+    return 0.0 if matched == 0 else 2 * precision * recall / (precision + recall)
+
+
+def tempo_agrees(reference, estimated, tolerance=0.04):
+    return any(abs(estimated - reference * factor) <= tolerance * reference * factor for factor in (1, 2, 0.5))
+
+
+def time_analysis(path, mode, repeat):
+    analysis = webapp.analyze_audio(path, mode)  # Warm up
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        analysis = webapp.analyze_audio(path, mode)
+        seconds.append(time.perf_counter() - start)
+    return analysis, float(np.median(seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the fast and accurate analysis tiers')
+    parser.add_argument('audio', nargs='*', help='Audio files (default: the bundled music_recommendation/input)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per file and tier (median reported)')
+    parser.add_argument('--json', default=None, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    files = args.audio or sorted(glob.glob(BUNDLED_AUDIO))
+    try:
+        webapp.preload_analysis()
+        accurate_available = True
+    except ImportError as e:
+        print(f"Accurate tier unavailable ({e}); timing the fast tier only")
+        accurate_available = False
+
+    rows = []
+    print(f"{'file':<28}{'seconds':>9}{'fast s':>9}{'accurate s':>12}{'speedup':>9}{'F-measure':>11}{'tempo':>14}")
+    for path in files:
+        fast, fast_seconds = time_analysis(path, 'fast', args.repeat)
+        row = {'file': os.path.basename(path), 'duration': fast['duration'], 'fast_seconds': round(fast_seconds, 4),
+               'fast_tempo': fast['tempo']}
+        if accurate_available:
+            accurate, accurate_seconds = time_analysis(path, 'accurate', args.repeat)
+            row.update({
+                'accurate_seconds': round(accurate_seconds, 4),
+                'speedup': round(accurate_seconds / fast_seconds, 1),
+                'f_measure': round(beat_f_measure([b['time'] for b in accurate['beats']],
+                                                  [b['time'] for b in fast['beats']]), 3),
+                'accurate_tempo': accurate['tempo'],
+                'tempo_agrees': tempo_agrees(accurate['tempo'], fast['tempo']),
+            })
+        rows.append(row)
+        print(f"{row['file'][:27]:<28}{row['duration']:>9.1f}{fast_seconds:>9.3f}"
+              + (f"{row['accurate_seconds']:>12.3f}{row['speedup']:>8.1f}x{row['f_measure']:>11.3f}"
+                 f"{row['fast_tempo']:>7}/{row['accurate_tempo']:<6}" if accurate_available else f"{'-':>12}"))
+
+    if accurate_available and rows:
+        print(f"\nMedian speedup {np.median([row['speedup'] for row in rows]):.1f}x, "
+              f"mean F-measure {np.mean([row['f_measure'] for row in rows]):.3f}, "
+              f"tempo agrees on {sum(row['tempo_agrees'] for row in rows)}/{len(rows)} files")
+    elif rows:
+        audio = sum(row['duration'] for row in rows)
+        print(f"\nFast tier: {audio / sum(row['fast_seconds'] for row in rows):.0f}x real time")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Micro-benchmark of the JSON response serialization against the old NumpyEncoder.
+
+Payloads are real analysis outputs: analyze_audio() results for the given audio files
+(with the beat activation function attached as a NumPy array, as in beat-heavy
+responses), and/or the analyses stored in the upload analysis cache.
+
+Usage:
+    python bench_serialization.py --audio ../music_recommendation/input/audio_example.mp3 --repeat 200
+    python bench_serialization.py --cached static/cache/analysis
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import os
+import time
+
+import numpy as np
+
+from utils import serialization
+from utils.serialization import _numpy_default, dumps
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class NumpyEncoder(json.JSONEncoder):
+    """The previous serializer: one default() call per NumPy scalar and array"""
+
+    def default(self, obj):
+        if isinstance(obj, np.integer):
+            return int(obj)
+        elif isinstance(obj, np.floating):
+            return float(obj)
+        elif isinstance(obj, np.ndarray):
+            return obj.tolist()
+        elif isinstance(obj, np.bool_):
+            return bool(obj)
+        return super(NumpyEncoder, self).default(obj)
+
+
+def load_payloads(audio_files, cache_dir):
+    payloads = []
+    if audio_files:
+        import app as webapp
+        rnn_processor, _ = webapp.get_beat_processors()
+        for path in audio_files:
+            analysis = webapp.analyze_audio(path)
+            analysis['activations'] = np.asarray(rnn_processor(path), dtype=np.float32)
+            payloads.append((os.path.basename(path), analysis))
+    if cache_dir:
+        for path in sorted(glob.glob(os.path.join(cache_dir, '*.json'))):
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            if 'analysis' in entry:
+                payloads.append((os.path.basename(path), entry['analysis']))
+    return payloads
+
+
+def time_call(func, repeat):
+    func()  # Warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare response serializers on real analysis outputs')
+    parser.add_argument('--audio', nargs='*', default=[], help='Audio files to analyze for payloads')
+    parser.add_argument('--cached', default=None, help='Directory of cached analyses (static/cache/analysis)')
+    parser.add_argument('--repeat', type=int, default=100)
+    args = parser.parse_args()
+
+    payloads = load_payloads(args.audio, args.cached)
+    if not payloads:
+        parser.error('No payloads: pass --audio files and/or a --cached directory with analyses')
+
+    print(f"orjson: {'yes' if serialization.orjson else 'no'}, brotli: {'yes' if brotli else 'no'}")
+    print(f"{'payload':<40} {'NumpyEncoder':>13} {'dumps':>9} {'fallback':>9} {'speedup':>8} "
+          f"{'bytes':>9} {'gzip':>9} {'gzip ms':>8} {'br':>9} {'br ms':>7}")
+    for name, payload in payloads:
+        old_ms = time_call(lambda: json.dumps(payload, cls=NumpyEncoder), args.repeat)
+        new_ms = time_call(lambda: dumps(payload), args.repeat)
+        fallback_ms = time_call(lambda: json.dumps(payload, default=_numpy_default, separators=(',', ':')), args.repeat)
+
+        body = dumps(payload)
+        gzip_ms = time_call(lambda: gzip.compress(body, compresslevel=serialization.GZIP_LEVEL), 10)
+        gzip_size = len(gzip.compress(body, compresslevel=serialization.GZIP_LEVEL))
+        if brotli:
+            br_ms = time_call(lambda: brotli.compress(body, quality=serialization.BROTLI_QUALITY), 10)
+            br_size = len(brotli.compress(body, quality=serialization.BROTLI_QUALITY))
+        else:
+            br_ms, br_size = float('nan'), 0
+
+        print(f"{name[:40]:<40} {old_ms:>10.3f} ms {new_ms:>6.3f} ms {fallback_ms:>6.3f} ms "
+              f"{old_ms / new_ms:>7.1f}x {len(body):>9} {gzip_size:>9} {gzip_ms:>8.2f} {br_size:>9} {br_ms:>7.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Cold-start benchmark of the web application.
+
+Measures, in fresh processes:
+    import      seconds to `import app` (what tests and serve.py pay before anything else)
+    serving     seconds from launching `python app.py` until /health answers
+    ready       seconds until /health/ready reports the analysis models as loaded
+    first page  latency of the first GET /
+    first upload  latency of the first analysis request (with --file)
+
+Every run is appended to a JSON lines history file together with the git commit,
+so changes in start-up cost can be followed over time. The app runs in a temporary copy
+of the web app (see loadtest.server_tree) with its own PCM cache, so the uploads do not
+end up in the real static/ tree.
+
+Usage:
+    python bench_startup.py --repeat 3 --file ../music_recommendation/input/audio_example.mp3
+"""
+
+import argparse
+import json
+import compileall
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+from bench_workers import free_port, multipart_body
+from loadtest import server_tree
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_HISTORY = os.path.join(HERE, 'startup_history.jsonl')
+
+
+def measure_import(webpage, env):
+    code = 'import time; start = time.perf_counter(); import app; print(time.perf_counter() - start)'
+    output = subprocess.run([sys.executable, '-c', code], cwd=webpage, env=env, capture_output=True, text=True,
+                            check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def wait_for(url, timeout, expect_status=200):
+    """Poll a URL until it answers with the expected status; returns the elapsed seconds or None"""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=2) as response:
+                if response.status == expect_status:
+                    return time.perf_counter() - start
+        except urllib.error.HTTPError:
+            pass  # e.g. 503 while the models are loading
+        except OSError:
+            pass
+        time.sleep(0.05)
+    return None
+
+
+def timed_request(request):
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=600) as response:
+        response.read()
+    return (time.perf_counter() - start) * 1000
+
+
+def measure_server(webpage, env, upload_file, timeout):
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    launched = time.perf_counter()
+    server = subprocess.Popen([sys.executable, os.path.join(webpage, 'app.py'), '--port', str(port)],
+                              cwd=webpage, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    result = {}
+    try:
+        if wait_for(f'{base}/health', timeout) is None:
+            raise RuntimeError('Server did not start')
+        result['serving_seconds'] = time.perf_counter() - launched
+        result['first_page_ms'] = timed_request(urllib.request.Request(f'{base}/'))
+
+        if wait_for(f'{base}/health/ready', timeout) is None:
+            raise RuntimeError('Analysis models did not finish loading')
+        result['ready_seconds'] = time.perf_counter() - launched
+
+        if upload_file:
+            # A random trailer makes the upload new content, so the analysis cache is not hit
+            body, content_type = multipart_body('file', upload_file, trailer=os.urandom(16))
+            result['first_upload_ms'] = timed_request(urllib.request.Request(
+                f'{base}/', data=body, headers={'Content-Type': content_type}))
+    finally:
+        server.terminate()
+        server.wait()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import and first-request latency of the web app')
+    parser.add_argument('--repeat', type=int, default=3, help='Cold starts to measure (median is reported)')
+    parser.add_argument('--file', default=None, help='Audio file for the first-analysis measurement')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--history', default=DEFAULT_HISTORY, help='JSON lines file the results are appended to')
+    args = parser.parse_args()
+    upload_file = os.path.abspath(args.file) if args.file else None
+
+    state_dir = tempfile.mkdtemp(prefix='bench_startup_')
+    runs = []
+    try:
+        webpage = server_tree(state_dir)
+        # Bytecode as in the real tree, so the first import does not measure compilation
+        compileall.compile_dir(webpage, quiet=1)
+        env = dict(os.environ, PCM_CACHE_DIR=os.path.join(state_dir, 'pcm_cache'))
+        for i in range(args.repeat):
+            run = {'import_seconds': measure_import(webpage, env)}
+            run.update(measure_server(webpage, env, upload_file, args.timeout))
+            runs.append(run)
+            print(f"Run {i + 1}: " + ', '.join(f"{key} {value:.3f}" for key, value in run.items()))
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+    entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(), 'repeat': args.repeat,
+             'python': sys.version.split()[0]}
+    for key in runs[0]:
+        entry[key] = round(float(np.median([run[key] for run in runs if key in run])), 4)
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history, 'r') as f:
+            history = [json.loads(line) for line in f if line.strip()]
+    with open(args.history, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+    keys = ['import_seconds', 'serving_seconds', 'ready_seconds', 'first_page_ms', 'first_upload_ms']
+    print(f"\n{'time':<20} {'commit':<9} " + ' '.join(f"{key:>16}" for key in keys))
+    for row in history[-9:] + [entry]:
+        print(f"{row['time']:<20} {str(row.get('commit')):<9} "
+              + ' '.join(f"{row[key]:>16.3f}" if key in row else f"{'-':>16}" for key in keys))
+
+
+if __name__ == '__main__':
+    main()
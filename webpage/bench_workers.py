@@ -0,0 +1,147 @@
+"""
+Load test showing how requests/second scale with the number of serve.py workers.
+
+For every worker count a fresh server is started, warmed up, and hit by concurrent
+clients for a fixed time. Without --file the clients GET the start page; with --file
+they upload that audio file to '/', which runs the full beat analysis per request
+(every upload gets a random trailer, so it is new content and misses the analysis cache).
+Each server runs in a temporary copy of the web app (see loadtest.server_tree) with its
+own PCM cache, so the uploads, caches and indexes of the real static/ tree stay untouched.
+
+Usage:
+    python bench_workers.py --workers 1 2 4 --clients 8 --duration 30 --file ../music_recommendation/input/audio_example.mp3
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def multipart_body(field, path, extra_fields=None, trailer=b''):
+    """Encode a file upload (with `trailer` appended to its data) as multipart/form-data; returns (body, content type)"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in (extra_fields or {}).items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    with open(path, 'rb') as f:
+        data = f.read()
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; '
+                 f'filename="{os.path.basename(path)}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode())
+    parts.append(data + trailer)
+    parts.append(f'\r\n--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def wait_until_up(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=2).read()
+            return True
+        except OSError:
+            time.sleep(0.5)
+    return False
+
+
+def run_clients(url, clients, duration, upload=None):
+    """
+    Send requests from `clients` threads for `duration` seconds; returns latencies and errors.
+    With `upload` (a file path), every request uploads it with a different random trailer.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client():
+        while time.time() < deadline:
+            if upload:
+                body, content_type = multipart_body('file', upload, trailer=os.urandom(16))
+                request = urllib.request.Request(url, data=body, headers={'Content-Type': content_type})
+            else:
+                request = urllib.request.Request(url)
+            start = time.time()
+            try:
+                urllib.request.urlopen(request, timeout=600).read()
+                with lock:
+                    latencies.append(time.time() - start)
+            except OSError:
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure requests/second of serve.py for several worker counts')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=4, help='Threads per worker')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent clients')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of load per worker count')
+    parser.add_argument('--file', default=None, help='Audio file to upload (default: GET the start page)')
+    parser.add_argument('--startup-timeout', type=float, default=120)
+    args = parser.parse_args()
+    upload = os.path.abspath(args.file) if args.file else None
+    # loadtest imports this module
+    from loadtest import server_tree
+
+    results = []
+    for workers in args.workers:
+        state_dir = tempfile.mkdtemp(prefix='bench_workers_')
+        webpage = server_tree(state_dir)
+        env = dict(os.environ, PCM_CACHE_DIR=os.path.join(state_dir, 'pcm_cache'))
+        port = free_port()
+        url = f'http://127.0.0.1:{port}/'
+        server = subprocess.Popen([sys.executable, os.path.join(webpage, 'serve.py'), '--port', str(port),
+                                   '--workers', str(workers), '--threads', str(args.threads)],
+                                  env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not wait_until_up(url, args.startup_timeout):
+                print(f"Server with {workers} workers did not start")
+                continue
+            # Warm up every worker once before measuring
+            run_clients(url, workers, 2, upload)
+            latencies, errors = run_clients(url, args.clients, args.duration, upload)
+        finally:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(state_dir, ignore_errors=True)
+
+        rps = len(latencies) / args.duration
+        p50 = np.percentile(latencies, 50) * 1000 if latencies else float('nan')
+        p95 = np.percentile(latencies, 95) * 1000 if latencies else float('nan')
+        results.append((workers, rps, p50, p95, errors))
+        print(f"{workers} workers: {rps:.2f} req/s, p50 {p50:.0f} ms, p95 {p95:.0f} ms, {errors} errors")
+
+    if results:
+        base = results[0][1] or float('nan')
+        print("\nworkers  req/s    speedup  p50 ms   p95 ms   errors")
+        for workers, rps, p50, p95, errors in results:
+            print(f"{workers:<8} {rps:<8.2f} {rps / base:<8.2f} {p50:<8.0f} {p95:<8.0f} {errors}")
+
+
+if __name__ == '__main__':
+    main()
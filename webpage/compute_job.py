@@ -0,0 +1,68 @@
+"""
+Runs one compute job of the web app from its <job id>_info.json (see utils/compute.py).
+
+The local and SLURM compute backends start this script; the in-process backend calls
+the same run_job() in a thread. The job's entry point is imported from the web app
+directory or music_recommendation/, and the job writes its status, result or error
+next to the info file.
+
+Also holds the entry point of separation jobs, which also rank the stems.
+
+Usage:
+    python compute_job.py static/separated/sep_1234/sep_1234_info.json
+"""
+
+import argparse
+import json
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MUSIC_RECOMMENDATION_DIR = os.path.join(HERE, '..', 'music_recommendation')
+
+
+def separate(audio_path, output_dir, job_id, device=None, spectrogram_folder=None):
+    """
+    Chunked Demucs separation (stems playable while it runs), then the ranking and spectrogram
+    tiles of the stems; without Demucs empty stems are written for testing.
+    """
+    try:
+        import demucs  # noqa: F401
+    except ImportError:
+        print("Demucs not available, creating dummy stems for testing")
+        stem_dir = os.path.join(output_dir, 'htdemucs', 'test')
+        os.makedirs(stem_dir, exist_ok=True)
+        for stem in ['drums', 'bass', 'vocals', 'other']:
+            open(os.path.join(stem_dir, f'{stem}.wav'), 'w').close()
+    else:
+        from separate_tracks import separate_audio_streaming
+        separate_audio_streaming(audio_path, output_dir, 'htdemucs', shifts=1, device=device, job_id=job_id)
+    # Part of the job, so polling requests only read ranking.json
+    from utils.stems import rank_stems
+    rank_stems(output_dir, spectrogram_folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a compute job of the web app')
+    parser.add_argument('info', help='Path of the job\'s <job id>_info.json')
+    args = parser.parse_args()
+
+    info_path = os.path.abspath(args.info)
+    # Entry points such as utils.analysis.analyze_audio use paths relative to the web app directory
+    os.chdir(HERE)
+    sys.path[:0] = [HERE, MUSIC_RECOMMENDATION_DIR]
+    from utils.compute import run_job
+
+    with open(info_path, 'r') as f:
+        job = json.load(f)
+    print(f"Running {job['kind']} job {job['job_id']}: {job['entry']}")
+    try:
+        run_job(job)
+    except Exception as e:
+        print(f"Job {job['job_id']} failed: {e}")
+        sys.exit(1)
+    print(f"Job {job['job_id']} completed")
+
+
+if __name__ == '__main__':
+    main()
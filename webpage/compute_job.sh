@@ -0,0 +1,29 @@
+#!/bin/bash
+#SBATCH --job-name=musicanalysis
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=8
+#SBATCH --mem=16G
+#SBATCH --time=00:30:00
+#SBATCH --output=compute_%j.log
+# Resources per job kind (the GPU partition for separations) are passed as sbatch
+# options by the SLURM compute backend (SLURM_OPTIONS in app.py)
+
+# Load necessary modules for DelftBlue
+module purge
+module load cuda/11.7
+module load conda
+
+# Activate the musicanalysis conda environment
+source activate musicanalysis
+
+# Job description written by the web app, and the runner (webpage/compute_job.py);
+# the runner is passed because SLURM runs a copy of this script from its spool directory
+JOB_INFO=$1
+RUNNER=$2
+
+echo "Starting job: $JOB_INFO"
+
+# The runner writes <job id>_status.txt on success and <job id>_error.log on failure
+python "$RUNNER" "$JOB_INFO" || exit 1
+
+echo "Job completed"
@@ -7,6 +7,23 @@ class Config:
     SEPARATED_FOLDER = 'static/separated'
     ALLOWED_EXTENSIONS = {'wav', 'mp3', 'mid', 'midi'}
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024
+    STORAGE_INDEX = 'static/storage_index.sqlite3'
+    STORAGE_QUOTAS = {
+        'upload': 2 * 1024 ** 3,
+        'stems': 10 * 1024 ** 3,
+        'midi_track': 200 * 1024 ** 2,
+        'script': 10 * 1024 ** 2,
+        'incoming': 1024 ** 3,
+        'cache': 500 * 1024 ** 2,
+    }
+    STORAGE_COMPACTION_INTERVAL = 300
+    INCOMING_FOLDER = 'static/incoming'
+    ANALYSIS_CACHE_FOLDER = 'static/cache/analysis'
+    MAX_RESUMABLE_UPLOAD = 500 * 1024 * 1024
+    RESUMABLE_UPLOAD_MAX_AGE = 24 * 3600
+    SIMILARITY_INDEX_FOLDER = 'static/cache/similarity'
+    SIMILARITY_LOG_MAX_BYTES = 1024 ** 2
+    FINGERPRINT_INDEX_FOLDER = 'static/cache/fingerprints'
 
     @staticmethod
     def init_app(app):
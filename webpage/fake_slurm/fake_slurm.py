@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Fake SLURM commands (sbatch, squeue, sacct, scancel) for load-testing the web app on one machine.
+
+Put this directory first on PATH (the wrappers call this script) and the app's SLURM
+compute backend submits its jobs here instead of to the cluster. A job waits in the
+queue for the configured delay and for a free slot, and then either fails or runs.
+A separation job "runs" for the configured time and leaves what compute_job.sh would:
+stems under <output dir>/htdemucs/<track>/, their ranking.json and spectrogram tiles
+(ranked and built by the web app's own utils.stems.rank_stems) and <job id>_status.txt.
+The stems are noise of a fixed length, so only the ranking costs CPU. Other jobs (offloaded analyses) are really
+run with the job runner passed to sbatch. Every job runs in its own detached process;
+squeue and sacct derive the job states from the state directory.
+
+Environment:
+    FAKE_SLURM_DIR           state directory (default: /tmp/fake_slurm)
+    FAKE_SLURM_QUEUE_DELAY   seconds a job waits in the queue at least (default: 2)
+    FAKE_SLURM_RUNTIME       seconds a job runs (default: 10)
+    FAKE_SLURM_JITTER        relative random variation of delay and runtime (default: 0.2)
+    FAKE_SLURM_FAILURE_RATE  fraction of jobs that fail (default: 0)
+    FAKE_SLURM_SLOTS         jobs running at the same time; later jobs wait (default: 4)
+    FAKE_SLURM_STEM_SECONDS  length of the written stems in seconds (default: 20)
+
+Usage:
+    fake_slurm.py sbatch --partition=gpu compute_job.sh job_info.json compute_job.py
+    fake_slurm.py squeue -j 1001 -h
+    fake_slurm.py sacct -j 1001 --format=State --noheader
+    fake_slurm.py scancel 1001
+    fake_slurm.py reset
+"""
+
+import fcntl
+import getpass
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import time
+import wave
+
+import numpy as np
+
+STATE_DIR = os.environ.get('FAKE_SLURM_DIR', '/tmp/fake_slurm')
+FIRST_JOB_ID = 1001
+STEMS = ['drums', 'bass', 'other', 'vocals']
+SHORT_STATES = {'PENDING': 'PD', 'RUNNING': 'R'}
+
+
+def setting(name, default):
+    return float(os.environ.get(f'FAKE_SLURM_{name}', default))
+
+
+def jittered(value):
+    jitter = setting('JITTER', 0.2)
+    return max(0.0, value * random.uniform(1 - jitter, 1 + jitter))
+
+
+def job_path(job_id):
+    return os.path.join(STATE_DIR, 'jobs', f'{job_id}.json')
+
+
+def read_job(job_id):
+    try:
+        with open(job_path(job_id), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def job_state(job):
+    if os.path.exists(result_path(job['id'])):
+        with open(result_path(job['id']), 'r') as f:
+            return f.read().strip()
+    return 'PENDING' if time.time() < job['start'] else 'RUNNING'
+
+
+def sbatch(args):
+    options = [arg for arg in args if arg.startswith('-')]
+    positional = [arg for arg in args if not arg.startswith('-')]
+    if not positional:
+        print("sbatch: error: no batch script given", file=sys.stderr)
+        return 1
+    script, script_args = positional[0], positional[1:]
+    os.makedirs(os.path.join(STATE_DIR, 'jobs'), exist_ok=True)
+
+    with open(os.path.join(STATE_DIR, 'lock'), 'a+') as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        state_path = os.path.join(STATE_DIR, 'scheduler.json')
+        slots = int(setting('SLOTS', 4))
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {'next_id': FIRST_JOB_ID, 'slot_free': []}
+        slot_free = (state['slot_free'] + [0.0] * slots)[:slots]
+
+        # First come, first served on the slot that frees up first
+        now = time.time()
+        slot = int(np.argmin(slot_free))
+        start = max(now + jittered(setting('QUEUE_DELAY', 2)), slot_free[slot])
+        runtime = jittered(setting('RUNTIME', 10))
+        slot_free[slot] = start + runtime
+        job = {
+            'id': state['next_id'], 'name': os.path.basename(script)[:8], 'user': getpass.getuser(),
+            'script': script, 'args': script_args, 'options': options, 'submit': now, 'start': start,
+            'end': start + runtime, 'fail': random.random() < setting('FAILURE_RATE', 0),
+        }
+        state = {'next_id': state['next_id'] + 1, 'slot_free': slot_free}
+        with open(job_path(job['id']), 'w') as f:
+            json.dump(job, f)
+        with open(state_path, 'w') as f:
+            json.dump(state, f)
+
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'run', str(job['id'])],
+                               start_new_session=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    with open(os.path.join(STATE_DIR, 'lock'), 'a+') as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        job['run_pid'] = process.pid
+        with open(job_path(job['id']), 'w') as f:
+            json.dump(job, f)
+    print(f"Submitted batch job {job['id']}")
+    return 0
+
+
+def write_noise_wav(path, seconds, sample_rate=44100):
+    samples = (np.random.randn(int(seconds * sample_rate), 2) * 3000).astype('<i2')
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+
+
+def result_path(job_id):
+    return os.path.join(STATE_DIR, 'jobs', f'{job_id}.result')
+
+
+def finish(job_id, state):
+    """Record the final state unless the job was cancelled meanwhile"""
+    if not os.path.exists(result_path(job_id)):
+        with open(result_path(job_id), 'w') as f:
+            f.write(state)
+
+
+def run(job_id):
+    """Job process: wait for the start time, then fail or run like compute_job.sh"""
+    job = read_job(job_id)
+    time.sleep(max(0.0, job['start'] - time.time()))
+    if os.path.exists(result_path(job_id)):
+        return 0  # Cancelled while pending
+    if job['fail']:
+        time.sleep(random.uniform(0, job['end'] - job['start']))
+        finish(job_id, 'FAILED')
+        return 0
+
+    info_path, runner = job['args'][:2]
+    with open(info_path, 'r') as f:
+        info = json.load(f)
+    if info['kind'] != 'separation':
+        python = os.environ.get('FAKE_SLURM_PYTHON', sys.executable)
+        returncode = subprocess.run([python, runner, info_path], stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL).returncode
+        finish(job_id, 'COMPLETED' if returncode == 0 else 'FAILED')
+        return 0
+
+    time.sleep(max(0.0, job['end'] - time.time()))
+    if os.path.exists(result_path(job_id)):
+        return 0
+    track = os.path.splitext(os.path.basename(info['audio_path']))[0]
+    stem_dir = os.path.join(info['output_dir'], 'htdemucs', track)
+    os.makedirs(stem_dir, exist_ok=True)
+    for stem in STEMS:
+        write_noise_wav(os.path.join(stem_dir, f'{stem}.wav'), setting('STEM_SECONDS', 20))
+    # Like compute_job.separate, which the runner's directory holds
+    webpage_dir = os.path.dirname(os.path.abspath(runner))
+    sys.path[:0] = [webpage_dir, os.path.join(webpage_dir, '..', 'music_recommendation')]
+    from utils.stems import rank_stems
+    try:
+        rank_stems(info['output_dir'], info.get('kwargs', {}).get('spectrogram_folder'))
+    except Exception:
+        finish(job_id, 'FAILED')
+        return 0
+    with open(os.path.join(info['output_dir'], f"{info['job_id']}_status.txt"), 'w') as f:
+        f.write('completed')
+    finish(job_id, 'COMPLETED')
+    return 0
+
+
+def scancel(args):
+    for job_id in [int(arg) for arg in args if not arg.startswith('-')]:
+        job = read_job(job_id)
+        if job is None or job_state(job) not in SHORT_STATES:
+            continue
+        finish(job_id, 'CANCELLED')
+        try:
+            os.killpg(job['run_pid'], signal.SIGTERM)
+        except (KeyError, OSError):
+            pass
+    return 0
+
+
+def job_ids(args):
+    if '-j' in args and args.index('-j') + 1 < len(args):
+        return [int(job_id) for job_id in args[args.index('-j') + 1].split(',')]
+    jobs_dir = os.path.join(STATE_DIR, 'jobs')
+    if not os.path.isdir(jobs_dir):
+        return []
+    return sorted(int(name[:-5]) for name in os.listdir(jobs_dir) if name.endswith('.json'))
+
+
+def squeue(args):
+    if '-h' not in args and '--noheader' not in args:
+        print(f"{'JOBID':>8} PARTITION     NAME     USER ST       TIME  NODES NODELIST(REASON)")
+    for job_id in job_ids(args):
+        job = read_job(job_id)
+        if job is None:
+            continue
+        state = job_state(job)
+        if state not in SHORT_STATES:
+            continue  # Finished jobs leave the queue
+        elapsed = int(max(0, time.time() - job['start'])) if state == 'RUNNING' else 0
+        reason = 'fakenode01' if state == 'RUNNING' else '(Priority)'
+        print(f"{job_id:>8} {'gpu':>9} {job['name']:>8} {job['user'][:8]:>8} {SHORT_STATES[state]:>2} "
+              f"{elapsed // 60:>7}:{elapsed % 60:02d} {1:>6} {reason}")
+    return 0
+
+
+def sacct(args):
+    for job_id in job_ids(args):
+        job = read_job(job_id)
+        if job is not None:
+            print(f"{job_state(job):>10}")
+    return 0
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return 1
+    command, args = sys.argv[1], sys.argv[2:]
+    if command == 'sbatch':
+        return sbatch(args)
+    if command == 'squeue':
+        return squeue(args)
+    if command == 'sacct':
+        return sacct(args)
+    if command == 'scancel':
+        return scancel(args)
+    if command == 'run':
+        return run(int(args[0]))
+    if command == 'reset':
+        shutil.rmtree(STATE_DIR, ignore_errors=True)
+        return 0
+    print(f"Unknown command: {command}", file=sys.stderr)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,345 @@
+"""
+Load test of the whole web app on one machine, with fake SLURM separation jobs.
+
+Starts serve.py (unless --url points at a running server) with fake_slurm/ first on
+PATH, so separation jobs go through the app's SLURM code path: sbatch, then squeue and
+sacct while the clients poll. The server runs in a temporary copy of webpage/ with its
+own static/ and PCM cache, so the uploads, stems, caches and indexes of a load test never
+mix with those of the real tree. Each simulated user repeatedly:
+
+    1. opens the start page
+    2. uploads an audio file (as JSON request), or with probability --midi-ratio a MIDI
+       file and then fetches one of its tracks
+    3. for audio, with probability --separate-ratio asks for a separation, polls
+       /check_separation every --poll-interval seconds until it is completed or failed,
+       and downloads every stem
+    4. asks for similar songs
+
+Uploads are taken round-robin from the given files. With --unique every upload gets a
+few random bytes appended, so it misses the content-addressed caches (the decoders
+ignore the trailing bytes); without it, repeated files show the cached behaviour.
+
+The report has, per route, the requests, throughput, error rate (HTTP errors, failed
+connections and JSON {"error": ...} answers) and latency percentiles, plus how long
+separations took from upload to playable stems.
+
+Usage:
+    python loadtest.py --users 16 --duration 120 --mode fast --no-preload
+    python loadtest.py --users 8 --audio ../music_recommendation/input --midi static/audio --separate-ratio 1 \\
+        --slurm-queue-delay 5 --slurm-runtime 30 --slurm-failure-rate 0.1 --json loadtest.json
+    python loadtest.py --url http://127.0.0.1:8000 --users 4 --duration 60
+"""
+
+import argparse
+import glob
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+import numpy as np
+
+from bench_workers import free_port, multipart_body, wait_until_up
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKE_SLURM_DIR = os.path.join(HERE, 'fake_slurm')
+MUSIC_RECOMMENDATION_DIR = os.path.abspath(os.path.join(HERE, '..', 'music_recommendation'))
+DEFAULT_AUDIO = os.path.join(HERE, '..', 'music_recommendation', 'input')
+DEFAULT_MIDI = os.path.join(HERE, 'static', 'audio')
+
+# Request paths -> route names in the report
+ROUTES = [
+    (re.compile(r'^/check_separation/'), '/check_separation/<job_id>'),
+    (re.compile(r'^/separated/'), '/separated/<path>'),
+    (re.compile(r'^/midi_track/'), '/midi_track/<file>/<n>'),
+    (re.compile(r'^/similar/'), '/similar/<content_id>'),
+    (re.compile(r'^/audio/'), '/audio/<file>'),
+]
+
+
+def route_name(method, path):
+    path = urllib.parse.urlparse(path).path
+    for pattern, name in ROUTES:
+        if pattern.match(path):
+            return f"{method} {name}"
+    return f"{method} {path}"
+
+
+def find_files(entries, extensions):
+    files = []
+    for entry in entries:
+        if os.path.isdir(entry):
+            files.extend(sorted(path for path in glob.glob(os.path.join(entry, '*'))
+                                if path.lower().endswith(extensions)))
+        elif os.path.exists(entry):
+            files.append(entry)
+    return files
+
+
+class Recorder:
+    """Latencies and errors per route, shared by all users"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.error_examples = {}
+        self.separations = []  # (outcome, seconds from upload to stems)
+
+    def record(self, route, seconds, error=None):
+        with self.lock:
+            self.latencies[route].append(seconds)
+            if error:
+                self.errors[route] += 1
+                self.error_examples.setdefault(route, error)
+
+
+class User:
+    def __init__(self, base_url, recorder, uploads, args, seed):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.uploads = uploads
+        self.args = args
+        self.random = random.Random(seed)
+
+    def request(self, method, path, body=None, content_type=None, accept_json=True):
+        """(status, parsed JSON or None, body size); every request is recorded"""
+        headers = {'Accept': 'application/json'} if accept_json else {}
+        if content_type:
+            headers['Content-Type'] = content_type
+        request = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        route = route_name(method, path)
+        start = time.perf_counter()
+        status, data, error = None, b'', None
+        try:
+            with urllib.request.urlopen(request, timeout=self.args.timeout) as response:
+                status, data = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, data, error = e.code, e.read(), f"HTTP {e.code}"
+        except OSError as e:
+            error = f"{type(e).__name__}: {e}"
+        seconds = time.perf_counter() - start
+
+        parsed = None
+        if data and accept_json:
+            try:
+                parsed = json.loads(data)
+            except ValueError:
+                pass
+        if isinstance(parsed, dict) and 'error' in parsed:
+            error = f"{error or 'error'}: {str(parsed['error'])[:80]}"
+        self.recorder.record(route, seconds, error)
+        return status, parsed, len(data)
+
+    def upload(self, path, fields):
+        body, content_type = multipart_body('file', path, fields)
+        if self.args.unique:
+            # Trailing bytes change the content hash but not the decoded audio
+            boundary = content_type.split('boundary=')[1]
+            tail = f'\r\n--{boundary}--\r\n'.encode()
+            body = body[:-len(tail)] + os.urandom(64) + tail
+        return self.request('POST', '/', body, content_type)
+
+    def session(self):
+        self.request('GET', '/', accept_json=False)
+        path = next(self.uploads['midi']) if self.uploads['midi'] and self.random.random() < self.args.midi_ratio \
+            else next(self.uploads['audio'])
+        if path.lower().endswith('.mid'):
+            _, analysis, _ = self.upload(path, {})
+            if analysis and analysis.get('tracks') and analysis.get('midi_url'):
+                track = self.random.choice(analysis['tracks'])['number']
+                self.request('GET', f"/midi_track/{analysis['midi_url'].split('/')[-1]}/{track}")
+            return
+
+        separate = self.random.random() < self.args.separate_ratio
+        fields = {'mode': self.args.mode}
+        if separate:
+            fields['separate_tracks'] = 'true'
+        started = time.perf_counter()
+        _, analysis, _ = self.upload(path, fields)
+        if not analysis or 'error' in analysis:
+            return
+        if separate and analysis.get('separation_job_id'):
+            self.follow_separation(analysis['separation_job_id'], started)
+        content_id = os.path.splitext(analysis.get('audio_url', '').split('/')[-1])[0]
+        if content_id:
+            self.request('GET', f"/similar/{content_id}?k=5")
+
+    def follow_separation(self, job_id, started):
+        deadline = time.perf_counter() + self.args.separation_timeout
+        while time.perf_counter() < deadline:
+            _, status, _ = self.request('GET', f"/check_separation/{job_id}")
+            state = (status or {}).get('status')
+            if state == 'completed':
+                for url in (status.get('tracks') or {}).values():
+                    self.request('GET', url, accept_json=False)
+                self.record_separation('completed', started)
+                return
+            if state in ('error', 'not_found') or status is None:
+                self.record_separation(state or 'no answer', started)
+                return
+            time.sleep(self.args.poll_interval)
+        self.record_separation('timeout', started)
+
+    def record_separation(self, outcome, started):
+        with self.recorder.lock:
+            self.recorder.separations.append((outcome, time.perf_counter() - started))
+
+    def run(self, deadline):
+        while time.perf_counter() < deadline:
+            self.session()
+
+
+def server_tree(state_dir):
+    """Copy of webpage/ under state_dir with only the page assets of static/ (the code is small)"""
+    webpage = os.path.join(state_dir, 'tree', 'webpage')
+    shutil.copytree(HERE, webpage, ignore=shutil.ignore_patterns('static', 'tests', '__pycache__', '*.log'))
+    for assets in ('css', 'js'):
+        shutil.copytree(os.path.join(HERE, 'static', assets), os.path.join(webpage, 'static', assets))
+    # The app and the jobs find music_recommendation/ next to webpage/
+    os.symlink(MUSIC_RECOMMENDATION_DIR, os.path.join(state_dir, 'tree', 'music_recommendation'))
+    return webpage
+
+
+def start_server(args):
+    """serve.py of a temporary copy of the web app on a free port with the fake SLURM commands first on PATH"""
+    state_dir = tempfile.mkdtemp(prefix='fake_slurm_')
+    webpage = server_tree(state_dir)
+    env = dict(os.environ)
+    env.update({
+        'PCM_CACHE_DIR': os.path.join(state_dir, 'pcm_cache'),
+        'PATH': FAKE_SLURM_DIR + os.pathsep + env.get('PATH', ''),
+        'FAKE_SLURM_PYTHON': sys.executable,
+        'FAKE_SLURM_DIR': state_dir,
+        'FAKE_SLURM_QUEUE_DELAY': str(args.slurm_queue_delay),
+        'FAKE_SLURM_RUNTIME': str(args.slurm_runtime),
+        'FAKE_SLURM_FAILURE_RATE': str(args.slurm_failure_rate),
+        'FAKE_SLURM_SLOTS': str(args.slurm_slots),
+    })
+    port = free_port()
+    command = [sys.executable, os.path.join(webpage, 'serve.py'), '--port', str(port),
+               '--workers', str(args.workers), '--threads', str(args.threads)]
+    if args.no_preload:
+        command.append('--no-preload')
+    log = open(os.path.join(state_dir, 'server.log'), 'w')
+    server = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return server, f'http://127.0.0.1:{port}', state_dir
+
+
+def report(recorder, elapsed):
+    rows = []
+    for route in sorted(recorder.latencies):
+        latencies = np.array(recorder.latencies[route]) * 1000
+        rows.append({
+            'route': route,
+            'requests': len(latencies),
+            'per_second': round(len(latencies) / elapsed, 2),
+            'error_rate': round(recorder.errors[route] / len(latencies), 4),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 1),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 1),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 1),
+            'max_ms': round(float(latencies.max()), 1),
+        })
+    print(f"\n{'route':<36}{'requests':>9}{'req/s':>8}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for row in rows:
+        print(f"{row['route']:<36}{row['requests']:>9}{row['per_second']:>8.2f}{row['error_rate']:>8.1%}"
+              f"{row['p50_ms']:>9.0f}{row['p95_ms']:>9.0f}{row['p99_ms']:>9.0f}{row['max_ms']:>9.0f}")
+    total = sum(row['requests'] for row in rows)
+    errors = sum(recorder.errors.values())
+    print(f"{'total':<36}{total:>9}{total / elapsed:>8.2f}{errors / max(total, 1):>8.1%}")
+    for route, example in sorted(recorder.error_examples.items()):
+        print(f"  first error on {route}: {example}")
+
+    separations = {}
+    if recorder.separations:
+        print("\nSeparations (upload to downloaded stems):")
+        for outcome in sorted({outcome for outcome, _ in recorder.separations}):
+            seconds = [s for o, s in recorder.separations if o == outcome]
+            separations[outcome] = {'count': len(seconds), 'p50_s': round(float(np.median(seconds)), 2),
+                                    'max_s': round(float(np.max(seconds)), 2)}
+            print(f"  {outcome:<12} {len(seconds):>5}  p50 {np.median(seconds):.1f}s  max {np.max(seconds):.1f}s")
+    return {'elapsed': round(elapsed, 1), 'routes': rows, 'separations': separations}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the web app with simulated users and fake SLURM jobs')
+    parser.add_argument('--url', default=None, help='Test a running server instead of starting serve.py')
+    parser.add_argument('--users', type=int, default=8, help='Concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds of load')
+    parser.add_argument('--audio', nargs='+', default=[DEFAULT_AUDIO], help='Audio files or directories to upload')
+    parser.add_argument('--midi', nargs='*', default=[DEFAULT_MIDI], help='MIDI files or directories to upload')
+    parser.add_argument('--midi-ratio', type=float, default=0.2, help='Fraction of uploads that are MIDI')
+    parser.add_argument('--separate-ratio', type=float, default=0.5,
+                        help='Fraction of audio uploads that request a separation')
+    parser.add_argument('--mode', choices=['accurate', 'fast'], default='accurate', help='Analysis mode of uploads')
+    parser.add_argument('--unique', action='store_true', help='Make every upload miss the content caches')
+    parser.add_argument('--poll-interval', type=float, default=2, help='Seconds between separation polls')
+    parser.add_argument('--separation-timeout', type=float, default=600, help='Give up on a separation after this')
+    parser.add_argument('--timeout', type=float, default=600, help='Timeout of a single request')
+    parser.add_argument('--json', default=None, help='Also write the report to this JSON file')
+    server_options = parser.add_argument_group('server started by the load test')
+    server_options.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='serve.py workers')
+    server_options.add_argument('--threads', type=int, default=4, help='serve.py threads per worker')
+    server_options.add_argument('--no-preload', action='store_true', help='Pass --no-preload to serve.py')
+    server_options.add_argument('--startup-timeout', type=float, default=180)
+    server_options.add_argument('--slurm-queue-delay', type=float, default=2, help='Fake SLURM queue delay (s)')
+    server_options.add_argument('--slurm-runtime', type=float, default=10, help='Fake SLURM job runtime (s)')
+    server_options.add_argument('--slurm-failure-rate', type=float, default=0.0, help='Fraction of failing jobs')
+    server_options.add_argument('--slurm-slots', type=int, default=4, help='Fake SLURM jobs running at once')
+    args = parser.parse_args()
+
+    audio = find_files(args.audio, ('.wav', '.mp3'))
+    midi = find_files(args.midi, ('.mid',))
+    if not audio:
+        print("No audio files to upload")
+        return
+    uploads = {'audio': itertools.cycle(audio), 'midi': itertools.cycle(midi) if midi else None}
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        server, base_url, state_dir = start_server(args)
+        print(f"Started serve.py ({args.workers} workers x {args.threads} threads) at {base_url}, "
+              f"its copy of the app, fake SLURM state and server log in {state_dir}")
+        if not wait_until_up(base_url + '/health', args.startup_timeout):
+            print("Server did not start, see server.log")
+            server.terminate()
+            return
+
+    recorder = Recorder()
+    users = [User(base_url, recorder, uploads, args, seed) for seed in range(args.users)]
+    print(f"{args.users} users for {args.duration:.0f}s: {len(audio)} audio and {len(midi)} MIDI files, "
+          f"mode {args.mode}, {args.separate_ratio:.0%} with separation")
+    start = time.perf_counter()
+    deadline = start + args.duration
+    threads = [threading.Thread(target=user.run, args=(deadline,), daemon=True) for user in users]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        elapsed = time.perf_counter() - start
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    result = report(recorder, elapsed)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""
+Production entry point for the music analysis web application.
+
+The master process binds the listening socket, imports the app and preloads the heavy
+analysis modules and madmom models, then forks worker processes. Workers inherit the
+loaded models copy-on-write, so N workers do not hold N copies, and each serves requests
+on a fixed-size thread pool.
+
+Signals sent to the master:
+    HUP        graceful restart: start fresh workers, then let the old ones finish their requests
+    TERM, INT  graceful shutdown
+    TTIN/TTOU  add/remove one worker
+
+Usage:
+    python serve.py --workers 4 --threads 8 --host 0.0.0.0 --port 8000
+"""
+
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+
+class PooledRequestHandler(WSGIRequestHandler):
+    # One request per connection, so idle keep-alive clients cannot hold pool threads
+    protocol_version = 'HTTP/1.0'
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI server on an inherited listening socket, handling requests on a fixed-size thread pool"""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, fd):
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+        super().__init__(host, port, app, handler=PooledRequestHandler, fd=fd)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._handle_request, request, client_address)
+
+    def _handle_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def serve_forever(self, poll_interval=0.5):
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            # Let requests that were already accepted finish
+            self.pool.shutdown(wait=True)
+
+
+def run_worker(app, listen_socket, host, port, threads):
+    """Serve requests until SIGTERM, then finish in-flight requests and exit"""
+    server = PooledWSGIServer(host, port, app, threads, listen_socket.fileno())
+
+    def stop(signum, frame):
+        # shutdown() blocks until serve_forever returns, so call it from another thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+        server.serve_forever(poll_interval=0.5)
+    finally:
+        server.server_close()
+
+
+class Master:
+    """Forks and supervises the worker processes"""
+
+    def __init__(self, app, listen_socket, host, port, workers, threads, graceful_timeout, post_fork=None):
+        self.app = app
+        self.post_fork = post_fork
+        self.listen_socket = listen_socket
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}  # pid -> start time
+        self.retiring = {}  # pid -> time SIGTERM was sent
+        self.signals = []
+        self.last_crash = 0
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                for signum in (signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD):
+                    signal.signal(signum, signal.SIG_DFL)
+                if self.post_fork:
+                    self.post_fork()
+                run_worker(self.app, self.listen_socket, self.host, self.port, self.threads)
+            except Exception as e:
+                print(f"Worker {os.getpid()} failed: {e}", file=sys.stderr)
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        self.workers[pid] = time.time()
+        print(f"Started worker {pid}")
+        return pid
+
+    def retire(self, pids):
+        for pid in pids:
+            self.workers.pop(pid, None)
+            self.retiring[pid] = time.time()
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.retiring.pop(pid, None)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if self.workers.pop(pid, None) is not None:
+                print(f"Worker {pid} exited unexpectedly (status {status})")
+                self.last_crash = time.time()
+            self.retiring.pop(pid, None)
+
+    def handle_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(signum, self.handle_signal)
+
+        for _ in range(self.num_workers):
+            self.spawn_worker()
+
+        stopping = False
+        while True:
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    print("Shutting down gracefully")
+                    stopping = True
+                    self.retire(list(self.workers))
+                elif signum == signal.SIGHUP and not stopping:
+                    print("Graceful restart")
+                    old_workers = list(self.workers)
+                    for _ in range(self.num_workers):
+                        self.spawn_worker()
+                    self.retire(old_workers)
+                elif signum == signal.SIGTTIN and not stopping:
+                    self.num_workers += 1
+                elif signum == signal.SIGTTOU and not stopping and self.num_workers > 1:
+                    self.num_workers -= 1
+                    self.retire(list(self.workers)[:1])
+
+            self.reap()
+
+            # Kill workers that did not finish their requests in time
+            now = time.time()
+            for pid, since in list(self.retiring.items()):
+                if now - since > self.graceful_timeout:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        self.retiring.pop(pid, None)
+
+            if stopping:
+                if not self.retiring:
+                    return
+            else:
+                # Replace missing workers; back off after a crash to avoid fork storms
+                if len(self.workers) < self.num_workers and now - self.last_crash > 1.0:
+                    self.spawn_worker()
+
+            time.sleep(0.2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the music analysis web application with multiple workers')
+    parser.add_argument('--port', type=int, default=8000, help='Port to run the server on (default: 8000)')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to run the server on (default: 127.0.0.1)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--threads', type=int, default=4, help='Request threads per worker (default: 4)')
+    parser.add_argument('--backlog', type=int, default=128, help='Listen backlog of the shared socket')
+    parser.add_argument('--graceful-timeout', type=float, default=120,
+                        help='Seconds a retiring worker may take to finish its requests')
+    parser.add_argument('--no-preload', action='store_true',
+                        help='Load the analysis models in each worker in the background instead of before '
+                             'forking (faster start, no sharing, no parallel beat activations)')
+    parser.add_argument('--activation-workers', type=int, default=None,
+                        help='Processes per worker computing the beat activations of long tracks '
+                             '(default: number of CPUs / workers)')
+    args = parser.parse_args()
+
+    # The app uses paths relative to the webpage directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.getcwd())
+
+    listen_socket = socket.socket(socket.AF_INET6 if ':' in args.host else socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((args.host, args.port))
+    listen_socket.listen(args.backlog)
+    listen_socket.set_inheritable(True)
+
+    start = time.time()
+    import app as webapp
+    # All server workers together start about one activation process per CPU
+    activation_workers = args.activation_workers or max(1, (os.cpu_count() or 1) // args.workers)
+    webapp.app.config['ACTIVATION_WORKERS'] = activation_workers
+    webapp.configure_analysis(activation_workers)
+    if not args.no_preload:
+        webapp.preload_analysis()
+    print(f"Loaded application in {time.time() - start:.1f}s, serving on http://{args.host}:{args.port} "
+          f"with {args.workers} workers x {args.threads} threads")
+
+    # The master starts no threads: workers (and their activation processes) are forked from
+    # it, so they must not inherit a lock held by another thread. Compaction runs in the
+    # workers' storage threads; its lockf lets one of them at a time compact.
+
+    def post_fork():
+        # Forked before the worker starts any thread, so the activation processes cannot inherit a held lock
+        webapp.start_activation_workers()
+        # Workers reconnect to the storage index after fork and write their own touches
+        webapp.storage.start()
+        # Without preloading, every worker serves right away and warms up its own models
+        if args.no_preload:
+            webapp.analysis_warmup.start()
+
+    Master(webapp.app, listen_socket, args.host, args.port, args.workers, args.threads,
+           args.graceful_timeout, post_fork).run()
+
+
+if __name__ == '__main__':
+    main()
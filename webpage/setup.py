@@ -9,5 +9,6 @@ setup(
         'numpy',
         'librosa',
         'madmom',
+        'orjson',
     ],
 ) 
\ No newline at end of file
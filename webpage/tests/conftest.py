@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The tests import utils.* the way app.py does, from inside webpage/, and the
+# music_recommendation modules (pcm_cache, ...) from the path app.py adds
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.append(os.path.join(HERE, '..', '..', 'music_recommendation'))
@@ -0,0 +1,37 @@
+"""Concurrent updates of one analysis cache entry keep every field"""
+
+import multiprocessing
+import threading
+
+from utils.ingest import AnalysisCache
+
+CONTENT_ID = 'a' * 32
+
+
+def put_fields(directory, prefix, count):
+    cache = AnalysisCache(directory)
+    for i in range(count):
+        cache.put(CONTENT_ID, **{f"{prefix}_{i}": i})
+
+
+def test_threads_and_processes_do_not_drop_fields(tmp_path):
+    directory = str(tmp_path / 'analysis')
+    AnalysisCache(directory)
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=put_fields, args=(directory, f"process{n}", 30)) for n in range(3)]
+    threads = [threading.Thread(target=put_fields, args=(directory, f"thread{n}", 30)) for n in range(3)]
+    for worker in processes + threads:
+        worker.start()
+    for worker in processes + threads:
+        worker.join()
+    entry = AnalysisCache(directory).get(CONTENT_ID)
+    assert len(entry) == 6 * 30
+
+
+def test_prefetched_entry_is_not_returned_after_an_update(tmp_path):
+    cache = AnalysisCache(str(tmp_path / 'analysis'))
+    cache.put(CONTENT_ID, prefix_digest='ff' * 32, analysis={'tempo': 120})
+    cache.prefetch('ff' * 32)
+    # Another worker updates the entry after this one prefetched it
+    AnalysisCache(str(tmp_path / 'analysis')).put(CONTENT_ID, separation_job_id='sep_1')
+    assert cache.get(CONTENT_ID) == {'analysis': {'tempo': 120}, 'separation_job_id': 'sep_1'}
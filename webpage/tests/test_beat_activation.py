@@ -0,0 +1,100 @@
+"""Windowed beat activations computed by worker processes match the activation of the whole track"""
+
+import os
+import threading
+import wave
+
+import numpy as np
+import pytest
+
+import pcm_cache
+from utils import beat_activation
+from utils.beat_activation import HOP_SIZE, SAMPLE_RATE, ParallelBeatActivation, split_windows, window_activation
+
+SECONDS = 20
+# Bundled song of several windows, and the largest deviation bench_activation.py --check allows
+SONG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'music_recommendation', 'input',
+                    'Coldplay - Clocks.mp3')
+TOLERANCE = 0.05
+
+
+class StubProcessor:
+    """Mean absolute amplitude of every 10 ms frame: needs no context, so windows stitch exactly"""
+
+    def __call__(self, samples):
+        frames = -(-len(samples) // HOP_SIZE)
+        padded = np.zeros(frames * HOP_SIZE, dtype=np.float32)
+        padded[:len(samples)] = np.abs(samples)
+        return padded.reshape(frames, HOP_SIZE).mean(axis=1)
+
+
+@pytest.fixture
+def stub(monkeypatch, tmp_path):
+    # Forked workers inherit the patched module state
+    monkeypatch.setattr(pcm_cache, 'CACHE_DIR', str(tmp_path / 'pcm_cache'))
+    monkeypatch.setattr(beat_activation, '_as_signal', lambda samples, sr: samples)
+    monkeypatch.setattr(beat_activation, '_processor', None)
+    return StubProcessor()
+
+
+@pytest.fixture
+def wav_path(tmp_path):
+    samples = (np.random.default_rng(0).normal(0, 0.2, SAMPLE_RATE * SECONDS)
+               * np.linspace(0, 1, SAMPLE_RATE * SECONDS))
+    with wave.open(str(tmp_path / 'track.wav'), 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes((np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+    return str(tmp_path / 'track.wav')
+
+
+def test_windows_overlap_and_cover_every_frame():
+    windows = split_windows(10000, 4500, 500)
+    assert windows[0][0] == 0 and windows[-1][1] == 10000
+    assert all(end - start <= 4500 for start, end in windows)
+    assert all(previous[1] - following[0] == 500 for previous, following in zip(windows, windows[1:]))
+
+
+def test_worker_processes_match_the_whole_track(stub, wav_path):
+    activation = ParallelBeatActivation(stub, workers=2, window_seconds=4, overlap_seconds=1)
+    activation.start()
+    try:
+        assert activation._pool is not None
+        result = activation(wav_path)
+    finally:
+        activation.close()
+    expected = window_activation(wav_path, 0, SECONDS * 100)
+    assert len(activation.windows(len(expected))) > 2
+    assert result.shape == expected.shape
+    np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-7)
+
+
+def test_threaded_process_without_started_workers_does_not_fork(stub, wav_path):
+    activation = ParallelBeatActivation(stub, workers=2, window_seconds=4, overlap_seconds=1)
+    stop = threading.Event()
+    other = threading.Thread(target=stop.wait)
+    other.start()
+    try:
+        result = activation(wav_path)
+    finally:
+        stop.set()
+        other.join()
+    assert activation._pool is None
+    np.testing.assert_allclose(result, window_activation(wav_path, 0, SECONDS * 100), rtol=1e-5)
+
+
+def test_rnn_activations_of_windows_match_the_whole_track(monkeypatch, tmp_path):
+    pytest.importorskip('madmom')
+    from madmom.features import RNNBeatProcessor
+    monkeypatch.setattr(pcm_cache, 'CACHE_DIR', str(tmp_path / 'pcm_cache'))
+    monkeypatch.setattr(beat_activation, '_processor', None)
+    activation = ParallelBeatActivation(RNNBeatProcessor(), workers=2)
+    activation.start()
+    try:
+        stitched = activation(SONG)
+    finally:
+        activation.close()
+    serial = window_activation(SONG, 0, len(stitched))
+    assert len(activation.windows(len(serial))) > 1
+    assert float(np.max(np.abs(stitched - serial))) < TOLERANCE
@@ -0,0 +1,80 @@
+"""Byte ranges and revalidation of send_cached_file on a large WAV file"""
+
+import os
+import wave
+
+import numpy as np
+import pytest
+from flask import Flask
+
+from utils.http_cache import send_cached_file
+
+SAMPLE_RATE = 44100
+SECONDS = 120  # About 21 MB of 16-bit stereo
+
+
+@pytest.fixture
+def wav_path(tmp_path):
+    samples = (np.random.default_rng(0).integers(-2 ** 15, 2 ** 15, (SAMPLE_RATE * SECONDS, 2))
+               .astype('<i2'))
+    with wave.open(str(tmp_path / 'stem.wav'), 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(samples.tobytes())
+    return tmp_path / 'stem.wav'
+
+
+@pytest.fixture
+def client(wav_path):
+    app = Flask(__name__)
+
+    @app.route('/files/<filename>')
+    def serve(filename):
+        return send_cached_file(str(wav_path.parent), filename)
+
+    return app.test_client()
+
+
+def test_seek_sends_only_the_requested_range(client, wav_path):
+    size = os.path.getsize(wav_path)
+    # Seek to 90 s: 4 bytes per frame after the 44-byte header
+    start = 44 + 90 * SAMPLE_RATE * 4
+    end = start + 64 * 1024 - 1
+
+    response = client.get('/files/stem.wav', headers={'Range': f'bytes={start}-{end}'})
+
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes {start}-{end}/{size}'
+    assert int(response.headers['Content-Length']) == end - start + 1
+    with open(wav_path, 'rb') as f:
+        f.seek(start)
+        assert response.data == f.read(end - start + 1)
+
+
+def test_open_ended_range_runs_to_the_end(client, wav_path):
+    size = os.path.getsize(wav_path)
+    response = client.get('/files/stem.wav', headers={'Range': f'bytes={size - 1000}-'})
+
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes {size - 1000}-{size - 1}/{size}'
+    assert len(response.data) == 1000
+
+
+def test_revalidation_with_etag_is_not_modified(client):
+    first = client.get('/files/stem.wav', headers={'Range': 'bytes=0-99'})
+    etag = first.headers['ETag']
+
+    response = client.get('/files/stem.wav', headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+    assert 'immutable' in response.headers['Cache-Control']
+
+
+def test_unsatisfiable_range(client, wav_path):
+    size = os.path.getsize(wav_path)
+    response = client.get('/files/stem.wav', headers={'Range': f'bytes={size + 10}-'})
+
+    assert response.status_code == 416
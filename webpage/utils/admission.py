@@ -0,0 +1,324 @@
+"""
+Memory-aware admission control for analyses, fingerprints, mix metrics, spectrogram
+tiles and local separations.
+
+Every heavy job is admitted against a memory budget shared by all server worker
+processes. Its memory is estimated from the audio duration with a linear model per job
+kind (base + MB per second of audio), scaled by a calibration factor learned from the
+measured peaks of earlier jobs. Peaks of jobs in their own process can lower the factor;
+those measured inside a long-lived server worker can only raise it. A job that does not fit waits in a first-come,
+first-served queue for up to max_wait seconds; when the queue is full or the wait runs
+out it is rejected with AdmissionRejected, which carries a Retry-After estimate (when
+the earliest running job is expected to finish).
+
+The reservations and the queue live in a small JSON file under a lockf lock, so all
+processes see the same committed memory; entries of processes that died are dropped.
+While a job runs, the RSS of the process tree that runs it is sampled, and the peak
+above the RSS at the start is recorded to calibrate the estimates.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+from utils.ingest import PROBE_BYTES, probe_header
+
+# (base MB, MB per second of audio) of each job kind before calibration
+MEMORY_MODELS = {
+    # 44.1 kHz decode plus madmom's spectrograms at three frame sizes and the RNN activations
+    'analysis_accurate': (300, 6.0),
+    # 11 kHz decode, onset envelope and tempogram
+    'analysis_fast': (80, 1.0),
+    # Demucs (htdemucs) in a local process, then the ranking and spectrogram tiles of the stems
+    'separation': (1500, 4.0),
+    # 22 kHz decode, STFT and harmonic/percussive separation of the mix metrics
+    'mix_metrics': (150, 3.0),
+    # 8 kHz decode and its spectrogram for the landmark hashes
+    'fingerprint': (60, 0.5),
+    # 22 kHz decode and log-mel levels; the STFT is taken in fixed-size blocks
+    'spectrogram': (100, 0.4),
+}
+# Expected wall-clock seconds per second of audio, until measured
+SECONDS_MODELS = {'analysis_accurate': 0.3, 'analysis_fast': 0.01, 'separation': 1.0, 'mix_metrics': 0.03,
+                  'fingerprint': 0.005, 'spectrogram': 0.01}
+
+CALIBRATION_WINDOW = 50  # Measurements kept per kind
+CALIBRATION_PERCENTILE = 90
+CALIBRATION_MARGIN = 1.1
+CALIBRATION_LIMITS = (0.25, 4.0)
+SAMPLE_INTERVAL = 0.1
+POLL_INTERVAL = 0.2
+FALLBACK_BITRATE = 128000  # bit/s assumed when the header gives no duration
+
+
+def audio_duration(path):
+    """Duration in seconds from the file header (no decoding); estimated from the size if unknown"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        probe = probe_header(f.read(PROBE_BYTES), size)
+    return probe.get('duration') or size * 8 / FALLBACK_BITRATE
+
+
+def physical_memory_mb():
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def process_tree_rss(pid):
+    """Resident memory in MB of a process and all its descendants"""
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/statm', 'r') as f:
+                total += int(f.read().split()[1]) * page_size
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children', 'r') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            continue  # Exited while we looked
+    return total / 2 ** 20
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AdmissionRejected(Exception):
+    """The memory budget is committed and the wait queue is full or the wait ran out"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PeakSampler:
+    """Samples the RSS of a process tree in a background thread; peak is the largest rise over the start"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.start_rss = process_tree_rss(pid)
+        self.peak_rss = self.start_rss
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"rss-{pid}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            self.peak_rss = max(self.peak_rss, process_tree_rss(self.pid))
+            self.samples += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.peak_rss - self.start_rss
+
+
+class AdmissionController:
+    """
+    Admits memory-heavy jobs against a budget shared by the processes using `directory`.
+
+    Args:
+        directory (str): Holds the reservation table and the calibration measurements
+        budget_mb (float): Memory all admitted jobs together may use
+        max_wait (float): Seconds a job waits for memory before it is rejected
+        max_queue (int): Jobs waiting at once (over all processes); more are rejected at once
+    """
+
+    def __init__(self, directory, budget_mb, max_wait=20, max_queue=8):
+        self.directory = directory
+        self.budget_mb = budget_mb
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self._local_jobs = 0  # Admitted jobs running in this process
+        self._local_lock = threading.Lock()
+        self._thread_lock = threading.Lock()  # lockf does not exclude threads of the same process
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def _exclusive(self):
+        with self._thread_lock, open(self._path('admission.lock'), 'a+') as lock_file:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _read_state(self):
+        try:
+            with open(self._path('reservations.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'running': {}, 'waiting': []}
+
+    @contextmanager
+    def _locked_state(self):
+        """Reservation table under the lock, without entries of dead processes; saved on exit"""
+        with self._exclusive():
+            state = self._read_state()
+            state['running'] = {key: job for key, job in state['running'].items() if _alive(job['pid'])}
+            now = time.time()
+            state['waiting'] = [ticket for ticket in state['waiting']
+                                if _alive(ticket['pid']) and ticket['deadline'] > now]
+            yield state
+            with open(self._path('reservations.tmp.json'), 'w') as f:
+                json.dump(state, f)
+            os.replace(self._path('reservations.tmp.json'), self._path('reservations.json'))
+
+    # Estimates and calibration
+
+    def _calibration(self):
+        try:
+            with open(self._path('calibration.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def estimate(self, kind, duration):
+        """Expected peak memory in MB of a job of this kind on `duration` seconds of audio"""
+        base, per_second = MEMORY_MODELS[kind]
+        model = base + per_second * duration
+        # In-process jobs are measured as the RSS rise of a long-lived server worker, which keeps
+        # its heap and mapped PCM caches resident, so their peaks only ever raise the estimate
+        # (measurements without the flag predate it and are treated as in-process)
+        ratios = []
+        for estimate, peak, _, *in_process in self._calibration().get(kind, []):
+            ratio = peak / estimate
+            ratios.append(ratio if in_process == [False] else max(ratio, 1.0))
+        if not ratios:
+            return model
+        factor = np.percentile(ratios, CALIBRATION_PERCENTILE) * CALIBRATION_MARGIN
+        return model * float(np.clip(factor, *CALIBRATION_LIMITS))
+
+    def expected_seconds(self, kind, duration):
+        rates = [seconds / max(audio, 1.0) for _, _, (seconds, audio), *_ in self._calibration().get(kind, [])]
+        rate = float(np.median(rates)) if rates else SECONDS_MODELS[kind]
+        return max(1.0, rate * duration)
+
+    def record(self, kind, duration, peak_mb, seconds, in_process=False):
+        """Add a measured job to the calibration of its kind (in_process: measured inside a server worker)"""
+        base, per_second = MEMORY_MODELS[kind]
+        with self._exclusive():
+            calibration = self._calibration()
+            measurements = calibration.setdefault(kind, [])
+            measurements.append([base + per_second * duration, max(peak_mb, 1.0), [seconds, duration], in_process])
+            calibration[kind] = measurements[-CALIBRATION_WINDOW:]
+            with open(self._path('calibration.tmp.json'), 'w') as f:
+                json.dump(calibration, f)
+            os.replace(self._path('calibration.tmp.json'), self._path('calibration.json'))
+        print(f"Admission: {kind} on {duration:.0f}s of audio peaked at {peak_mb:.0f} MB in {seconds:.1f}s")
+
+    # Reservations
+
+    def _retry_after(self, state):
+        now = time.time()
+        ends = [job['expected_end'] for job in state['running'].values()]
+        return int(np.clip(min(ends) - now if ends else POLL_INTERVAL, 1, 300))
+
+    def reserve(self, kind, duration, wait=None):
+        """
+        Reserve memory for a job, waiting in the queue if the budget is committed.
+        Returns the reservation id; raises AdmissionRejected.
+        """
+        memory_mb = min(self.estimate(kind, duration), self.budget_mb)  # An oversized job runs alone
+        wait = self.max_wait if wait is None else wait
+        ticket = uuid.uuid4().hex
+        deadline = time.time() + wait
+        while True:
+            with self._locked_state() as state:
+                committed = sum(job['mb'] for job in state['running'].values())
+                queued = [waiting['ticket'] for waiting in state['waiting']]
+                first_in_line = not queued or queued[0] == ticket
+                if first_in_line and committed + memory_mb <= self.budget_mb:
+                    state['waiting'] = [waiting for waiting in state['waiting'] if waiting['ticket'] != ticket]
+                    state['running'][ticket] = {
+                        'pid': os.getpid(), 'kind': kind, 'mb': round(memory_mb, 1), 'start': time.time(),
+                        'expected_end': time.time() + self.expected_seconds(kind, duration)}
+                    return ticket
+                if ticket not in queued:
+                    # Not queued yet, or the ticket expired and was dropped by the read above
+                    if len(queued) >= self.max_queue or time.time() >= deadline:
+                        raise AdmissionRejected(f"Server busy: {committed:.0f} of {self.budget_mb:.0f} MB "
+                                                f"committed, {len(queued)} jobs waiting",
+                                                self._retry_after(state))
+                    state['waiting'].append({'ticket': ticket, 'pid': os.getpid(), 'mb': round(memory_mb, 1),
+                                             'deadline': deadline})
+            time.sleep(POLL_INTERVAL)
+
+    def transfer(self, reservation, pid):
+        """Tie a reservation to another process (e.g. a spawned job) so it outlives this one"""
+        with self._locked_state() as state:
+            if reservation in state['running']:
+                state['running'][reservation]['pid'] = pid
+
+    def release(self, reservation):
+        with self._locked_state() as state:
+            state['running'].pop(reservation, None)
+
+    @contextmanager
+    def admit(self, kind, path):
+        """Run the body as an admitted job on the audio file `path`, measuring its memory"""
+        duration = audio_duration(path)
+        with self.running(kind, duration, self.reserve(kind, duration)):
+            yield
+
+    @contextmanager
+    def running(self, kind, duration, reservation):
+        """Run the body in this process as the job holding `reservation`; released (and measured) at the end"""
+        with self._local_lock:
+            self._local_jobs += 1
+            alone = self._local_jobs == 1
+        sampler = PeakSampler(os.getpid())
+        start = time.time()
+        try:
+            yield
+        finally:
+            peak_mb = sampler.stop()
+            with self._local_lock:
+                # Other jobs in this process inflate the RSS; only calibrate on jobs that ran alone
+                alone = alone and self._local_jobs == 1
+                self._local_jobs -= 1
+            self.release(reservation)
+            if alone and sampler.samples:
+                self.record(kind, duration, peak_mb, time.time() - start, in_process=True)
+
+    def monitor(self, process, kind, duration, reservation):
+        """Watch a spawned job process: measure its memory, and release its reservation when it exits"""
+        self.transfer(reservation, process.pid)
+        sampler = PeakSampler(process.pid)
+        start = time.time()
+
+        def watch():
+            process.wait()
+            peak_mb = sampler.stop()
+            self.release(reservation)
+            if process.returncode == 0 and sampler.samples:
+                self.record(kind, duration, peak_mb, time.time() - start)
+
+        threading.Thread(target=watch, name=f"admission-{process.pid}", daemon=True).start()
+
+    def status(self):
+        """Committed memory and queue, read without the lock (health checks must not contend with admissions)"""
+        state = self._read_state()  # Replaced atomically, so always complete
+        running = [job for job in state['running'].values() if _alive(job['pid'])]
+        now = time.time()
+        return {
+            'budget_mb': round(self.budget_mb),
+            'committed_mb': round(sum(job['mb'] for job in running)),
+            'running': sorted(job['kind'] for job in running),
+            'waiting': len([ticket for ticket in state['waiting'] if _alive(ticket['pid']) and ticket['deadline'] > now]),
+        }
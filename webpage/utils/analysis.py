@@ -0,0 +1,187 @@
+"""
+Beat, tempo and measure analysis of audio files.
+
+Kept apart from the Flask app so compute jobs (compute_job.py, or a thread of the
+inprocess backend) can run analyze_audio() without importing the app and with it a
+second storage index, admission controller and set of models.
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+
+from utils.warmup import Warmup
+
+FAST_SAMPLE_RATE = 11025
+FAST_HOP_LENGTH = 256  # 23 ms onset frames
+
+# Processes computing the beat activations of one long track in parallel windows
+activation_workers = 1
+
+
+def configure(workers):
+    """Set the activation worker processes; call before the models are loaded"""
+    global activation_workers
+    activation_workers = max(1, int(workers))
+
+
+# madmom and librosa take seconds to import and the RNN ensemble is loaded from disk, so
+# they are loaded by a warm-up thread (or on first use) while the server already serves
+# pages and static files. The production server loads them before forking, so the
+# workers share the model memory copy-on-write.
+def load_analysis_modules():
+    from madmom.features import DBNBeatTrackingProcessor, RNNBeatProcessor
+    from madmom.features.tempo import TempoEstimationProcessor
+    import librosa
+    from pcm_cache import load as load_pcm
+    from utils.beat_activation import ParallelBeatActivation
+    # librosa loads its submodules lazily; import the ones used for analysis now
+    import librosa.core
+    import librosa.beat
+    import librosa.onset
+    rnn_processor = RNNBeatProcessor()
+    return SimpleNamespace(librosa=librosa, load_pcm=load_pcm,
+                           TempoEstimationProcessor=TempoEstimationProcessor,
+                           beat_processors=(rnn_processor, DBNBeatTrackingProcessor(fps=100)),
+                           beat_activation=ParallelBeatActivation(rnn_processor, activation_workers))
+
+
+analysis_warmup = Warmup(load_analysis_modules, 'analysis')
+
+
+def start_activation_workers():
+    """
+    Fork the beat activation workers of the loaded models; call while this process runs no
+    other threads (serve.py: right after forking a server worker). Without loaded models
+    (no preloading) the activations are computed in the analyzing thread.
+    """
+    if analysis_warmup.ready.is_set():
+        analysis_warmup.get().beat_activation.start()
+
+
+def get_beat_processors():
+    return analysis_warmup.get().beat_processors
+
+
+def preload_analysis():
+    """Load the models and heavy modules used for analysis (called by serve.py before forking workers)"""
+    analysis_warmup.get()
+
+
+def analyze_audio(filepath, mode='accurate'):
+    """
+    Beats, tempo, time signature and measures of an audio file.
+    mode 'accurate' runs the madmom RNN ensemble and DBN; mode 'fast' tracks beats on the
+    onset envelope of a downsampled signal with librosa and needs no models.
+    """
+    if mode == 'fast':
+        beats, beat_activations, tempo, duration = track_beats_fast(filepath)
+    else:
+        beats, beat_activations, tempo, duration = track_beats_madmom(filepath)
+    analysis = build_measures(beats, beat_activations, tempo, duration)
+    analysis['mode'] = mode
+    return analysis
+
+
+def track_beats_madmom(filepath):
+    """Beat times, beat activations, tempo and duration with madmom"""
+    # Decode once (or map the cached decode of an earlier analysis); the activation workers share it
+    modules = analysis_warmup.get()
+    y, sr = modules.load_pcm(filepath, sr=44100, mono=True)
+
+    # Process audio with Madmom; long tracks are split into windows computed on several cores
+    _, beat_processor = modules.beat_processors
+    act_processor = modules.beat_activation(filepath)
+    beats = beat_processor(act_processor)
+
+    # Convert beat times to integer indices (multiply by fps to get frame indices)
+    beat_indices = (beats * 100).astype(int)  # fps is 100
+
+    # Get beat activation values for strength
+    beat_activations = act_processor[beat_indices]
+
+    # Estimate tempo
+    tempo_processor = modules.TempoEstimationProcessor(fps=100)(act_processor)
+    tempo = int(round(tempo_processor[np.argmax(tempo_processor[:, 1])][0]))
+
+    # Get duration from librosa
+    duration = round(float(modules.librosa.get_duration(y=y, sr=sr)), 2)
+    return beats, beat_activations, tempo, duration
+
+
+def track_beats_fast(filepath):
+    """Beat times, onset strengths at the beats, tempo and duration with librosa's tempogram/dynamic programming tracker"""
+    import librosa
+    from pcm_cache import load as load_pcm
+    y, sr = load_pcm(filepath, sr=FAST_SAMPLE_RATE, mono=True)
+    onset_envelope = librosa.onset.onset_strength(y=y, sr=sr, hop_length=FAST_HOP_LENGTH)
+    tempo = float(librosa.feature.tempo(onset_envelope=onset_envelope, sr=sr, hop_length=FAST_HOP_LENGTH)[0])
+    _, beat_frames = librosa.beat.beat_track(onset_envelope=onset_envelope, sr=sr, hop_length=FAST_HOP_LENGTH,
+                                             bpm=tempo)
+    beats = librosa.frames_to_time(beat_frames, sr=sr, hop_length=FAST_HOP_LENGTH)
+    return beats, onset_envelope[beat_frames], int(round(tempo)), round(len(y) / sr, 2)
+
+
+def build_measures(beats, beat_activations, tempo, duration):
+    """Analysis result (time signature, measures and beats) from beat times and their strengths"""
+    # Normalize activations to 0-1 range
+    beat_activations = np.asarray(beat_activations, dtype=float)
+    if len(beat_activations):
+        spread = np.max(beat_activations) - np.min(beat_activations)
+        beat_activations = (beat_activations - np.min(beat_activations)) / (spread or 1.0)
+
+    # Detect time signature
+    intervals = np.diff(beats)
+    best_denominator = 4
+    if len(intervals) > 3:
+        median_interval = np.median(intervals)
+        scores = []
+        for denom in [2, 3, 4, 6, 8]:
+            scores.append(np.sum(np.abs(intervals - (median_interval * denom))))
+        best_denominator = [2, 3, 4, 6, 8][np.argmin(scores)]
+
+    # Create measures and beats
+    measures = []
+    current_measure = 1
+    beat_count = 0
+    current_measure_beats = []
+
+    for i, beat in enumerate(beats):
+        # Add beat information
+        beat_info = {
+            'time': round(float(beat), 2),
+            'strength': round(float(beat_activations[i]), 2),
+            'is_strong': bool(beat_activations[i] > 0.7)  # Convert NumPy bool_ to Python bool
+        }
+
+        # Start a new measure if we've reached the beat count for the current measure
+        if beat_count % best_denominator == 0:
+            if current_measure_beats:  # If we have beats from the previous measure
+                measures.append({
+                    'number': current_measure,
+                    'start': current_measure_beats[0]['time'],
+                    'end': round(float(beat), 2),
+                    'beats': current_measure_beats.copy()  # Make a copy of the beats for this measure
+                })
+                current_measure += 1
+            current_measure_beats = []  # Reset beats for next measure
+
+        current_measure_beats.append(beat_info)
+        beat_count += 1
+
+    # Add the last measure if it has any beats
+    if current_measure_beats:
+        measures.append({
+            'number': current_measure,
+            'start': current_measure_beats[0]['time'],
+            'end': duration,
+            'beats': current_measure_beats
+        })
+
+    return {
+        'tempo': tempo,
+        'time_sig': f"4/{best_denominator}",
+        'measures': measures,
+        'duration': duration,
+        'beats': [beat for measure in measures for beat in measure['beats']]  # Flatten beats for overall list
+    }
@@ -0,0 +1,145 @@
+"""
+Beat activations of long tracks computed on several cores.
+
+madmom's RNNBeatProcessor runs its networks over the whole signal in one process, so a
+long upload keeps one core busy. Here the signal is cut into overlapping windows that
+worker processes compute in parallel, and the window activations are stitched into one
+activation function: across every overlap the earlier window fades out linearly while
+the next one fades in, so the frames next to a window edge, where the recurrent
+networks lack context, get little weight. The DBN decoding afterwards is cheap and
+stays with the caller.
+
+Workers read their window from the PCM cache (the memory-mapped decode every process
+shares), so only the file path and frame numbers are sent to them. The processor of the
+parent process is inherited by the forked workers instead of being loaded again.
+
+Forking a process that runs other threads can deadlock the children (a lock another
+thread held at the fork stays locked in them), so the workers are started with start()
+while the process has a single thread: serve.py does so right after forking each server
+worker. A threaded process without started workers computes the activation itself.
+"""
+
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+FPS = 100
+SAMPLE_RATE = 44100
+HOP_SIZE = SAMPLE_RATE // FPS
+
+_processor = None  # RNNBeatProcessor of this process
+
+
+def _get_processor():
+    global _processor
+    if _processor is None:
+        from madmom.features import RNNBeatProcessor
+        _processor = RNNBeatProcessor()
+    return _processor
+
+
+def _as_signal(samples, sr):
+    from madmom.audio.signal import Signal
+    return Signal(samples, sample_rate=sr)
+
+
+def window_activation(path, start, end):
+    """Activation of frames start..end of an audio file, computed on that window alone"""
+    from pcm_cache import load as load_pcm
+    y, sr = load_pcm(path, sr=SAMPLE_RATE, mono=True)
+    window = y[start * HOP_SIZE:end * HOP_SIZE]
+    return np.asarray(_get_processor()(_as_signal(window, sr)))[:end - start]
+
+
+def split_windows(num_frames, window_frames, overlap_frames):
+    """
+    (start, end) frame ranges of equally long windows covering num_frames, each
+    overlapping the next by overlap_frames and none longer than window_frames.
+    """
+    if num_frames <= window_frames:
+        return [(0, num_frames)]
+    step = window_frames - overlap_frames
+    count = math.ceil((num_frames - overlap_frames) / step)
+    length = math.ceil((num_frames + (count - 1) * overlap_frames) / count)
+    return [(i * (length - overlap_frames), min(i * (length - overlap_frames) + length, num_frames))
+            for i in range(count)]
+
+
+def stitch(activations, windows, num_frames):
+    """One activation function from overlapping window activations, crossfaded linearly in the overlaps"""
+    total = np.zeros(num_frames)
+    weight = np.zeros(num_frames)
+    for i, (activation, (start, end)) in enumerate(zip(activations, windows)):
+        fade = np.ones(end - start)
+        if i > 0:
+            overlap = windows[i - 1][1] - start
+            fade[:overlap] = np.linspace(0, 1, overlap + 2)[1:-1]
+        if i < len(windows) - 1:
+            overlap = end - windows[i + 1][0]
+            fade[-overlap:] = np.linspace(1, 0, overlap + 2)[1:-1]
+        n = min(len(activation), end - start)
+        total[start:start + n] += activation[:n] * fade[:n]
+        weight[start:start + n] += fade[:n]
+    return (total / np.maximum(weight, 1e-9)).astype(np.float32)
+
+
+class ParallelBeatActivation:
+    """
+    Callable returning the beat activation function (100 fps) of an audio file.
+
+    Args:
+        processor: RNNBeatProcessor to use in this process (and, forked, in the workers)
+        workers (int): Worker processes; 1 computes everything in this process
+        window_seconds (float): Longest window a worker computes
+        overlap_seconds (float): Overlap of consecutive windows
+    """
+
+    def __init__(self, processor=None, workers=1, window_seconds=45, overlap_seconds=5):
+        global _processor
+        if processor is not None:
+            _processor = processor
+        self.workers = max(1, workers)
+        self.window_frames = int(window_seconds * FPS)
+        self.overlap_frames = int(overlap_seconds * FPS)
+        self._pool = None
+        self._lock = threading.Lock()
+        # A pool started before a fork belongs to the parent
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Fork the worker processes now; call while this process runs no other threads"""
+        with self._lock:
+            if self._pool is None and self.workers > 1:
+                # Forked explicitly (not the platform default), so the workers inherit the processor
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork'))
+                self._pool.submit(int).result()  # Forks all workers at once, before any other thread exists
+
+    def windows(self, num_frames):
+        return split_windows(num_frames, self.window_frames, self.overlap_frames)
+
+    def __call__(self, path):
+        from pcm_cache import load as load_pcm
+        # Decoded here first, so the workers only map the cached signal
+        y, _ = load_pcm(path, sr=SAMPLE_RATE, mono=True)
+        num_frames = math.ceil(len(y) / HOP_SIZE)
+        windows = self.windows(num_frames)
+        if self._pool is None and self.workers > 1 and threading.active_count() == 1:
+            self.start()  # Single-threaded (e.g. a compute job or a benchmark), so forking is safe
+        if len(windows) == 1 or self._pool is None:
+            return window_activation(path, 0, num_frames)
+        activations = list(self._pool.map(window_activation, [path] * len(windows),
+                                          [start for start, _ in windows], [end for _, end in windows]))
+        return stitch(activations, windows, num_frames)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
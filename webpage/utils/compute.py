@@ -0,0 +1,392 @@
+"""
+Compute backends that run analysis and separation jobs.
+
+A job is a Python entry point ("module:function" with arguments) and an output
+directory. Whichever backend runs it, the job leaves the same files in that directory,
+and the web app only looks at those:
+
+    <job id>_info.json      job description and backend bookkeeping
+    <job id>_status.txt     "completed" (or "cancelled") once it ended
+    <job id>_error.log      why it failed
+    <job id>_progress.json  progress the job publishes itself (chunked separation)
+    <job id>_result.json    return value of the entry point, if any
+
+Backends:
+    inprocess  a thread pool of the web process
+    local      child processes (python compute_job.py <info>) limited to a pool size
+    slurm      sbatch compute_job.sh <info> with sbatch options per job kind
+
+inprocess and local jobs are admitted against the memory budget of the web node (a
+rejected submit raises AdmissionRejected); SLURM jobs use the cluster's resources.
+"""
+
+import importlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+WEBPAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JOB_RUNNER = os.path.join(WEBPAGE_DIR, 'compute_job.py')
+SLURM_SCRIPT = os.path.join(WEBPAGE_DIR, 'compute_job.sh')
+BOOKKEEPING_SUFFIXES = ('_info.json', '_status.txt', '_error.log', '_progress.json', '_result.json', '.log', '.sh')
+FINAL_STATES = ('completed', 'cancelled', 'error')
+
+
+def job_file(job, suffix):
+    return os.path.join(job['output_dir'], f"{job['job_id']}{suffix}")
+
+
+def new_job(job_id, kind, output_dir, entry, args=(), kwargs=None, **fields):
+    """Description of a job; extra fields (audio_path, duration, memory_kind, ...) are kept with it"""
+    job = {'job_id': job_id, 'kind': kind, 'output_dir': os.path.abspath(output_dir), 'entry': entry,
+           'args': list(args), 'kwargs': kwargs or {}, 'status': 'submitted', 'submit_time': time.time()}
+    job.update(fields)
+    return job
+
+
+def save_job(job):
+    os.makedirs(job['output_dir'], exist_ok=True)
+    tmp_path = job_file(job, '_info.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp_path, job_file(job, '_info.json'))
+
+
+def load_job(output_dir, job_id):
+    try:
+        with open(os.path.join(output_dir, f"{job_id}_info.json"), 'r') as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if 'backend' not in job:
+        # Written before the compute backends existed
+        job['backend'] = 'slurm' if job.get('use_slurm') else 'local'
+    job.setdefault('output_dir', os.path.abspath(output_dir))
+    return job
+
+
+def file_status(output_dir, job_id):
+    """Status the job files give (completed, error, progress), or None if they say nothing yet"""
+    status_file = os.path.join(output_dir, f"{job_id}_status.txt")
+    error_log = os.path.join(output_dir, f"{job_id}_error.log")
+    progress_file = os.path.join(output_dir, f"{job_id}_progress.json")
+
+    if os.path.exists(status_file):
+        with open(status_file, 'r') as f:
+            return {'status': f.read().strip()}
+    if os.path.exists(error_log):
+        with open(error_log, 'r') as f:
+            return {'status': 'error', 'error_details': f.read()}
+    # Chunked separation publishes progress while the stems are growing
+    if os.path.exists(progress_file):
+        with open(progress_file, 'r') as f:
+            progress = json.load(f)
+        if progress.get('status') == 'error':
+            return {'status': 'error', 'error_details': progress.get('error', 'Unknown error')}
+        if progress.get('seconds_ready', 0) > 0:
+            return {'status': 'running', 'progress': progress}
+    return None
+
+
+def run_job(job):
+    """Call the job's entry point and leave its result, status or error in the output directory"""
+    try:
+        module_name, function_name = job['entry'].split(':')
+        function = getattr(importlib.import_module(module_name), function_name)
+        result = function(*job['args'], **job['kwargs'])
+        if result is not None:
+            with open(job_file(job, '_result.tmp'), 'w') as f:
+                json.dump(result, f, default=str)
+            os.replace(job_file(job, '_result.tmp'), job_file(job, '_result.json'))
+        with open(job_file(job, '_status.txt'), 'w') as f:
+            f.write('completed')
+        return result
+    except Exception:
+        with open(job_file(job, '_error.log'), 'w') as f:
+            f.write(traceback.format_exc())
+        raise
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ComputeBackend:
+    """
+    Runs jobs described by new_job(). submit() saves the job with the backend's
+    bookkeeping; status() is asked once the job files say nothing yet, and works from any
+    server worker process since it only needs the saved job.
+    """
+
+    name = None
+
+    def submit(self, job):
+        raise NotImplementedError
+
+    def status(self, job):
+        return {'status': job.get('status', 'unknown')}
+
+    def cancel(self, job):
+        """Stop a queued or running job; returns whether it was stopped"""
+        return False
+
+    def artifacts(self, job):
+        """Paths (relative to the output directory) of the files the job produced"""
+        found = []
+        for root, _, files in os.walk(job['output_dir']):
+            for name in files:
+                path = os.path.relpath(os.path.join(root, name), job['output_dir'])
+                if not (root == job['output_dir'] and name.startswith(job['job_id'])
+                        and name.endswith(BOOKKEEPING_SUFFIXES)):
+                    found.append(path)
+        return sorted(found)
+
+    def result(self, job):
+        """Return value of the entry point"""
+        with open(job_file(job, '_result.json'), 'r') as f:
+            return json.load(f)
+
+    def _mark_cancelled(self, job):
+        with open(job_file(job, '_status.txt'), 'w') as f:
+            f.write('cancelled')
+
+
+class InProcessBackend(ComputeBackend):
+    """Runs jobs on a thread pool of this process"""
+
+    name = 'inprocess'
+
+    def __init__(self, threads=2, admission=None):
+        self.admission = admission
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='compute')
+        self._futures = {}
+        self._reservations = {}
+
+    def submit(self, job):
+        reservation = self.admission.reserve(job['memory_kind'], job['duration']) if self.admission else None
+        job.update(backend=self.name, status='queued', pid=os.getpid())
+        save_job(job)
+        self._reservations[job['job_id']] = reservation
+        self._futures[job['job_id']] = self._pool.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        reservation = self._reservations.pop(job['job_id'], None)
+        job['status'] = 'running'
+        save_job(job)
+        try:
+            if self.admission:
+                with self.admission.running(job['memory_kind'], job['duration'], reservation):
+                    run_job(job)
+            else:
+                run_job(job)
+        except Exception as e:
+            print(f"Job {job['job_id']} failed: {e}")
+        finally:
+            self._futures.pop(job['job_id'], None)
+
+    def status(self, job):
+        if not _alive(job['pid']):
+            return {'status': 'error', 'error_details': 'The server process running the job exited'}
+        return super().status(job)
+
+    def cancel(self, job):
+        # A running thread cannot be stopped, only a queued job
+        future = self._futures.get(job['job_id'])
+        if future is None or not future.cancel():
+            return False
+        self._futures.pop(job['job_id'], None)
+        reservation = self._reservations.pop(job['job_id'], None)
+        if self.admission and reservation:
+            self.admission.release(reservation)
+        self._mark_cancelled(job)
+        return True
+
+
+class LocalProcessBackend(ComputeBackend):
+    """Runs every job in a child process (compute_job.py); at most `workers` run at once, later ones queue"""
+
+    name = 'local'
+
+    def __init__(self, workers=2, admission=None, python=None):
+        self.admission = admission
+        self.python = python or sys.executable
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='local-job')
+        self._futures = {}
+        self._reservations = {}
+
+    def submit(self, job):
+        reservation = self.admission.reserve(job['memory_kind'], job['duration']) if self.admission else None
+        job.update(backend=self.name, status='queued', pid=None, worker_pid=os.getpid())
+        save_job(job)
+        self._reservations[job['job_id']] = reservation
+        self._futures[job['job_id']] = self._pool.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        reservation = self._reservations.pop(job['job_id'], None)
+        try:
+            with open(job_file(job, '_local.log'), 'w') as log:
+                process = subprocess.Popen([self.python, JOB_RUNNER, job_file(job, '_info.json')], cwd=WEBPAGE_DIR,
+                                           stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        except OSError as e:
+            # Otherwise the job would stay queued forever
+            print(f"Could not start job {job['job_id']}: {e}")
+            self._futures.pop(job['job_id'], None)
+            if self.admission and reservation:
+                self.admission.release(reservation)
+            with open(job_file(job, '_error.log'), 'w') as f:
+                f.write(f"Could not start the job process: {e}")
+            job.update(status='error', error_message=f"Could not start the job process: {e}")
+            save_job(job)
+            return
+        job.update(status='running', pid=process.pid)
+        save_job(job)
+        if self.admission:
+            # Released, and the peak memory recorded, when the process exits
+            self.admission.monitor(process, job['memory_kind'], job['duration'], reservation)
+        process.wait()
+        self._futures.pop(job['job_id'], None)
+        if process.returncode != 0 and file_status(job['output_dir'], job['job_id']) is None:
+            with open(job_file(job, '_error.log'), 'w') as f:
+                f.write(f"Job process exited with code {process.returncode}, see {job['job_id']}_local.log")
+
+    def status(self, job):
+        if job.get('pid') is None:
+            if job.get('status') == 'error':
+                return file_status(job['output_dir'], job['job_id']) or {'status': 'error'}
+            if not _alive(job['worker_pid']):
+                return {'status': 'error', 'error_details': 'The server process queueing the job exited'}
+            return {'status': 'queued'}
+        if not _alive(job['pid']):
+            # Exited between the file check and now, or killed before it could write an error
+            return file_status(job['output_dir'], job['job_id']) or {
+                'status': 'error', 'error_details': 'Job process exited without a result'}
+        return {'status': 'running'}
+
+    def cancel(self, job):
+        future = self._futures.get(job['job_id'])
+        if future is not None and future.cancel():
+            self._futures.pop(job['job_id'], None)
+            reservation = self._reservations.pop(job['job_id'], None)
+            if self.admission and reservation:
+                self.admission.release(reservation)
+        elif job.get('pid') and _alive(job['pid']):
+            os.killpg(job['pid'], signal.SIGTERM)
+        else:
+            return False
+        self._mark_cancelled(job)
+        return True
+
+
+class SlurmBackend(ComputeBackend):
+    """Submits jobs with sbatch; the job files are on the cluster's shared file system"""
+
+    name = 'slurm'
+
+    def __init__(self, options=None):
+        self.options = options or {}  # Job kind -> extra sbatch options (partition, GPUs, memory, ...)
+
+    def submit(self, job):
+        job.update(backend=self.name)
+        save_job(job)
+        os.chmod(SLURM_SCRIPT, 0o755)
+        cmd = ['sbatch', *self.options.get(job['kind'], []), SLURM_SCRIPT, job_file(job, '_info.json'), JOB_RUNNER]
+        try:
+            result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+            # Extract job ID from SLURM output (usually "Submitted batch job 12345")
+            job['slurm_job_id'] = result.stdout.strip().split()[-1]
+            job['status'] = 'submitted'
+            print(f"Successfully submitted job {job['slurm_job_id']} for {job['job_id']}")
+        except subprocess.CalledProcessError as e:
+            print(f"Error submitting job: {e}")
+            print(f"STDOUT: {e.stdout}")
+            print(f"STDERR: {e.stderr}")
+            job['status'] = 'error'
+            job['error_message'] = f"STDOUT: {e.stdout}, STDERR: {e.stderr}"
+
+            # Create an error log file for debugging
+            with open(job_file(job, '_error.log'), 'w') as f:
+                f.write(f"Command: {' '.join(cmd)}\n")
+                f.write(f"Error: {str(e)}\n")
+                f.write(f"STDOUT: {e.stdout}\n")
+                f.write(f"STDERR: {e.stderr}\n")
+        save_job(job)
+        return job
+
+    def status(self, job):
+        if 'slurm_job_id' not in job:
+            return super().status(job)
+        slurm_job_id = job['slurm_job_id']
+        try:
+            result = subprocess.run(['squeue', '-j', slurm_job_id, '-h'], check=True, capture_output=True, text=True)
+        except (OSError, subprocess.CalledProcessError):
+            return {'status': 'unknown', 'details': 'Error checking SLURM job status'}
+        if result.stdout.strip():
+            # Job is in the queue, check its state
+            fields = result.stdout.strip().split()
+            state = fields[4] if len(fields) > 4 else "UNKNOWN"
+            if state == "PD":
+                return {'status': 'pending', 'details': 'Job is pending in the queue'}
+            if state == "R":
+                return {'status': 'running', 'details': 'Job is running'}
+            return {'status': 'queued', 'details': f'Job state: {state}'}
+
+        # Job not in queue, check if it completed without creating a status file
+        try:
+            result = subprocess.run(['sacct', '-j', slurm_job_id, '--format=State', '--noheader'],
+                                    check=True, capture_output=True, text=True)
+        except (OSError, subprocess.CalledProcessError):
+            return {'status': 'unknown', 'details': 'Job not in queue and state unknown'}
+        state = result.stdout.strip().split()[0] if result.stdout.strip() else "UNKNOWN"
+        if state == "COMPLETED":
+            # Job completed but status file wasn't created, create it now
+            with open(job_file(job, '_status.txt'), 'w') as f:
+                f.write("completed")
+            return {'status': 'completed'}
+        if state in ["FAILED", "TIMEOUT", "CANCELLED", "OUT_OF_MEMORY"]:
+            return {'status': 'error', 'error_details': f'SLURM job {slurm_job_id} ended with state {state}'}
+        return {'status': 'unknown', 'details': f'SLURM job state: {state}'}
+
+    def cancel(self, job):
+        if 'slurm_job_id' not in job:
+            return False
+        try:
+            subprocess.run(['scancel', job['slurm_job_id']], check=True, capture_output=True, text=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Could not cancel SLURM job {job['slurm_job_id']}: {e}")
+            return False
+        self._mark_cancelled(job)
+        return True
+
+
+def slurm_available():
+    try:
+        subprocess.run(['which', 'sbatch'], check=True, capture_output=True, text=True)
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+
+def create_backend(name, workers=2, admission=None, slurm_options=None):
+    """Backend by name; 'auto' is SLURM where sbatch is available and local processes elsewhere"""
+    if name == 'auto':
+        name = 'slurm' if slurm_available() else 'local'
+    if name == 'inprocess':
+        return InProcessBackend(workers, admission)
+    if name == 'local':
+        return LocalProcessBackend(workers, admission)
+    if name == 'slurm':
+        return SlurmBackend(slurm_options)
+    raise ValueError(f"Unknown compute backend: {name} (use inprocess, local, slurm or auto)")
@@ -0,0 +1,66 @@
+import gzip
+import mimetypes
+import os
+import shutil
+
+from flask import abort, request, send_file
+from werkzeug.security import safe_join
+
+# Transcoded stem formats are not in every platform's mimetypes table
+mimetypes.add_type('audio/ogg', '.opus')
+mimetypes.add_type('audio/flac', '.flac')
+mimetypes.add_type('audio/midi', '.mid')
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+
+def strong_etag(path, suffix=''):
+    """ETag from the file identity; files are uuid/hash named and replaced, never modified in place"""
+    stat = os.stat(path)
+    name = os.path.basename(path)
+    return f"{name}-{stat.st_size:x}-{stat.st_mtime_ns:x}{suffix}"
+
+
+def write_precompressed(path):
+    """Write a gzip variant next to a file that compresses well (e.g. MIDI)"""
+    tmp_path = f"{path}.gz.tmp"
+    with open(path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=9) as dst:
+        shutil.copyfileobj(src, dst)
+    # Keep the original's mtime so both variants describe the same version
+    stat = os.stat(path)
+    os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(tmp_path, f"{path}.gz")
+
+
+def send_cached_file(directory, filename, immutable=True):
+    """
+    Serve a file with byte-range support, a strong ETag and long-lived caching.
+
+    Range, If-Range and If-None-Match requests are answered by Werkzeug's conditional
+    responses (206 with only the requested bytes, or 304). Files that may still change,
+    such as stems of a running separation, are sent with immutable=False so clients
+    revalidate them. A precompressed <file>.gz is used for clients accepting gzip,
+    except for range requests, whose offsets refer to the uncompressed file.
+    """
+    path = safe_join(os.path.abspath(directory), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    gzip_path = f"{path}.gz"
+    use_gzip = (immutable and 'Range' not in request.headers and os.path.isfile(gzip_path)
+                and 'gzip' in request.accept_encodings)
+
+    if use_gzip:
+        response = send_file(gzip_path, mimetype=mimetype, conditional=True,
+                             etag=strong_etag(path, '-gzip'), max_age=None)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=True, etag=strong_etag(path), max_age=None)
+
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+    if os.path.isfile(gzip_path):
+        response.vary.add('Accept-Encoding')
+    return response
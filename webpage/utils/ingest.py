@@ -0,0 +1,390 @@
+import fcntl
+import hashlib
+import json
+import os
+import struct
+import threading
+import uuid
+
+from flask import Request, current_app
+
+PROBE_BYTES = 64 * 1024  # Enough for WAV/MP3 headers, ID3 tags and a Xing frame
+PREFIX_BYTES = 1024 * 1024  # Digest of the first MB identifies cache candidates before the upload ends
+
+MP3_BITRATES = {
+    # (MPEG version 1, layer III) and (version 2/2.5, layer III) in kbit/s
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0],
+}
+MP3_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG 1
+    2: [22050, 24000, 16000],  # MPEG 2
+    0: [11025, 12000, 8000],  # MPEG 2.5
+}
+
+
+def _probe_wav(head, total_size):
+    info = {'format': 'wav'}
+    offset = 12
+    byte_rate = None
+    while offset + 8 <= len(head):
+        chunk_id, chunk_size = struct.unpack('<4sI', head[offset:offset + 8])
+        body = offset + 8
+        if chunk_id == b'fmt ' and body + 16 <= len(head):
+            _, channels, sample_rate, byte_rate = struct.unpack('<HHII', head[body:body + 12])
+            info.update(channels=channels, sample_rate=sample_rate)
+        elif chunk_id == b'data':
+            if byte_rate:
+                data_size = chunk_size
+                if total_size and (chunk_size in (0, 0xFFFFFFFF) or body + chunk_size > total_size):
+                    data_size = total_size - body  # Streaming writers leave the size unset
+                info['duration'] = round(data_size / byte_rate, 2)
+            break
+        offset = body + chunk_size + (chunk_size & 1)
+    return info
+
+
+def _probe_mp3(head, total_size):
+    offset = 0
+    if head[:3] == b'ID3' and len(head) >= 10:
+        # Skip the ID3v2 tag (syncsafe size)
+        size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+        offset = 10 + size
+    while offset + 4 <= len(head):
+        if head[offset] == 0xFF and (head[offset + 1] & 0xE0) == 0xE0:
+            break
+        offset += 1
+    else:
+        return None
+
+    b1, b2, b3 = head[offset + 1], head[offset + 2], head[offset + 3]
+    version_bits = (b1 >> 3) & 0x03
+    layer_bits = (b1 >> 1) & 0x03
+    if version_bits == 1 or layer_bits != 1 or (b2 >> 4) == 0x0F or ((b2 >> 2) & 0x03) == 3:
+        return None  # Not an MPEG layer III frame header
+
+    version = 1 if version_bits == 3 else 2
+    bitrate = MP3_BITRATES[version][b2 >> 4] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version_bits][(b2 >> 2) & 0x03]
+    channels = 1 if (b3 >> 6) == 3 else 2
+    samples_per_frame = 1152 if version == 1 else 576
+    info = {'format': 'mp3', 'sample_rate': sample_rate, 'channels': channels}
+
+    # VBR files carry the frame count in a Xing/Info header inside the first frame
+    side_info = (32 if channels == 2 else 17) if version == 1 else (17 if channels == 2 else 9)
+    xing = offset + 4 + side_info
+    if head[xing:xing + 4] in (b'Xing', b'Info') and len(head) >= xing + 12:
+        flags = struct.unpack('>I', head[xing + 4:xing + 8])[0]
+        if flags & 0x1:
+            frames = struct.unpack('>I', head[xing + 8:xing + 12])[0]
+            info['duration'] = round(frames * samples_per_frame / sample_rate, 2)
+            return info
+
+    if bitrate and total_size:
+        info['duration'] = round((total_size - offset) * 8 / bitrate, 2)
+    return info
+
+
+def probe_header(head, total_size=None):
+    """
+    Detect the format and, where the header allows it, the duration of an upload
+    from its first bytes. total_size may be an estimate (e.g. the request's Content-Length).
+    """
+    head = bytes(head)
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        return _probe_wav(head, total_size)
+    if head[:4] == b'MThd':
+        return {'format': 'mid'}
+    return _probe_mp3(head, total_size) or {'format': None}
+
+
+class IngestWriter:
+    """
+    Writable upload stream that lands on disk chunk by chunk while the content hash,
+    the format/duration probe and a digest of the first megabyte are computed on the fly.
+
+    Werkzeug's form parser writes the uploaded file into it as the request body arrives,
+    so nothing is buffered in memory or copied again after the upload.
+    """
+
+    def __init__(self, directory, expected_size=None, on_prefix=None, part_path=None):
+        os.makedirs(directory, exist_ok=True)
+        self.part_path = part_path or os.path.join(directory, f"{uuid.uuid4().hex}.part")
+        self.expected_size = expected_size
+        self.on_prefix = on_prefix
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.probe = None
+        self.prefix_digest = None
+        self._head = bytearray()
+        self._file = open(self.part_path, 'ab+')
+
+    def write(self, data):
+        self._file.write(data)
+        self.track(data)
+        return len(data)
+
+    def track(self, data):
+        """Update hash, probe and prefix digest with data that is already on disk"""
+        self.sha256.update(data)
+        self.size += len(data)
+
+        if len(self._head) < PREFIX_BYTES:
+            self._head += data[:PREFIX_BYTES - len(self._head)]
+            if self.probe is None and len(self._head) >= PROBE_BYTES:
+                self.probe = probe_header(self._head, self.expected_size)
+            if len(self._head) >= PREFIX_BYTES:
+                self._finish_prefix()
+
+    def _finish_prefix(self):
+        if self.prefix_digest is None:
+            self.prefix_digest = hashlib.sha256(self._head).hexdigest()
+            if self.on_prefix:
+                self.on_prefix(self.prefix_digest)
+
+    def finish(self):
+        """Called once the last byte arrived; completes the probe for small files"""
+        self._file.flush()
+        if self.probe is None:
+            self.probe = probe_header(self._head, self.size)
+        self._finish_prefix()
+        return self.sha256.hexdigest()
+
+    def store(self, directory, ext):
+        """
+        Move the upload to its content-addressed name <content id>.<ext> in `directory`,
+        where the content id is the first 32 hex digits of the SHA-256.
+        Returns (content id, path, duplicate), where duplicate means identical content was already stored.
+        """
+        content_id = self.finish()[:32]
+        self._file.close()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{content_id}.{ext}")
+        duplicate = os.path.exists(path)
+        if duplicate:
+            os.remove(self.part_path)
+        else:
+            os.replace(self.part_path, path)
+        return content_id, path, duplicate
+
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    # File protocol used by werkzeug's FileStorage
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+
+class IngestRequest(Request):
+    """Request class that streams uploaded files through an IngestWriter instead of a temporary file"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        cache = current_app.extensions.get('analysis_cache')
+        writer = IngestWriter(current_app.config['INCOMING_FOLDER'], expected_size=total_content_length,
+                              on_prefix=cache.prefetch if cache else None)
+        self.ingest_writers = getattr(self, 'ingest_writers', []) + [writer]
+        return writer
+
+
+class AnalysisCache:
+    """
+    Analysis results keyed by content id (see IngestWriter.store), with a secondary index from the digest of a file's
+    first megabyte, so likely cache hits are loaded while the rest of the upload is still arriving.
+
+    Request threads, background post-processing and other server workers update fields of the same entry, so
+    put() reads, updates and replaces an entry under a lockf lock of that entry.
+    """
+
+    # lockf does not exclude threads of the same process (whichever instance they use)
+    _put_lock = threading.Lock()
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.prefix_directory = os.path.join(directory, 'prefix')
+        self.lock_directory = os.path.join(directory, 'locks')
+        os.makedirs(self.prefix_directory, exist_ok=True)
+        os.makedirs(self.lock_directory, exist_ok=True)
+        self._prefetched = {}  # content id -> (mtime of the file, entry)
+        self._lock = threading.Lock()
+
+    def _path(self, content_id):
+        return os.path.join(self.directory, f"{content_id}.json")
+
+    def prefetch(self, prefix_digest):
+        """Load the entries of files starting with the same megabyte into memory"""
+        prefix_path = os.path.join(self.prefix_directory, prefix_digest)
+        if not os.path.exists(prefix_path):
+            return
+        with open(prefix_path, 'r') as f:
+            candidates = f.read().split()
+        for content_id in candidates:
+            mtime = self._mtime(content_id)
+            entry = self._read(content_id)
+            if entry:
+                with self._lock:
+                    self._prefetched[content_id] = (mtime, entry)
+
+    def _mtime(self, content_id):
+        try:
+            return os.stat(self._path(content_id)).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read(self, content_id):
+        try:
+            with open(self._path(content_id), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, content_id):
+        with self._lock:
+            prefetched = self._prefetched.pop(content_id, None)
+        # A prefetched entry is only used while nobody has updated the file since
+        if prefetched and prefetched[0] is not None and prefetched[0] == self._mtime(content_id):
+            return prefetched[1]
+        return self._read(content_id)
+
+    def put(self, content_id, prefix_digest=None, **fields):
+        """Create or update the entry of a file (e.g. analysis=..., separation_job_id=...), keeping its other fields"""
+        with AnalysisCache._put_lock, open(os.path.join(self.lock_directory, f"{content_id}.lock"), 'a') as lock_file:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX)
+            entry = self._read(content_id) or {}
+            entry.update(fields)
+            tmp_path = f"{self._path(content_id)}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._path(content_id))
+        with self._lock:
+            self._prefetched.pop(content_id, None)
+
+        if prefix_digest:
+            with open(os.path.join(self.prefix_directory, prefix_digest), 'a+') as f:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+                f.seek(0)
+                if content_id not in f.read().split():
+                    f.write(f"{content_id}\n")
+
+
+def _reset_put_lock():
+    AnalysisCache._put_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_put_lock)
+
+
+class ResumableUploads:
+    """
+    Chunked uploads that survive dropped connections: chunks are appended in order with
+    Content-Range offsets, and a client resumes from the offset it gets back from status().
+    Hash and probe state is kept in memory per upload and rebuilt from the partial file
+    when a chunk arrives at a different process or after a restart.
+    """
+
+    def __init__(self, directory, max_size, on_prefix=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.on_prefix = on_prefix
+        self._writers = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.directory, f"{upload_id}.json")
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.directory, f"{upload_id}.part")
+
+    def files(self, upload_id):
+        """Metadata and partial file of an upload"""
+        return [self._meta_path(upload_id), self._part_path(upload_id)]
+
+    def create(self, filename, size):
+        if size > self.max_size:
+            raise ValueError(f"Upload of {size} bytes exceeds the limit of {self.max_size} bytes")
+        upload_id = uuid.uuid4().hex
+        with open(self._meta_path(upload_id), 'w') as f:
+            json.dump({'filename': filename, 'size': size}, f)
+        open(self._part_path(upload_id), 'wb').close()
+        return upload_id
+
+    def meta(self, upload_id):
+        if not all(c in '0123456789abcdef' for c in upload_id) or not os.path.exists(self._meta_path(upload_id)):
+            return None
+        with open(self._meta_path(upload_id), 'r') as f:
+            return json.load(f)
+
+    def status(self, upload_id):
+        meta = self.meta(upload_id)
+        if meta is None:
+            return None
+        return {'upload_id': upload_id, 'offset': os.path.getsize(self._part_path(upload_id)), 'size': meta['size']}
+
+    def _writer(self, upload_id, meta):
+        part_path = self._part_path(upload_id)
+        writer = self._writers.get(upload_id)
+        if writer is None or writer.size != os.path.getsize(part_path):
+            # Rebuild the hash state from what is already on disk
+            if writer:
+                writer.close()
+            writer = IngestWriter(self.directory, meta['size'], self.on_prefix, part_path=part_path)
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(PREFIX_BYTES), b''):
+                    writer.track(chunk)
+            self._writers[upload_id] = writer
+        return writer
+
+    def append(self, upload_id, start, data):
+        """
+        Append a chunk that starts at byte `start`. Returns the new status; raises ValueError
+        (with the expected offset in the status) when the chunk does not continue the upload.
+        """
+        meta = self.meta(upload_id)
+        if meta is None:
+            raise KeyError(upload_id)
+        with open(self._meta_path(upload_id), 'r+') as lock_file, self._lock:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX)  # Serialize appends across worker processes
+            offset = os.path.getsize(self._part_path(upload_id))
+            if start != offset:
+                raise ValueError(offset)
+            if offset + len(data) > meta['size']:
+                raise ValueError(offset)
+            writer = self._writer(upload_id, meta)
+            writer.write(data)
+            writer.flush()
+        return self.status(upload_id)
+
+    def is_complete(self, upload_id):
+        status = self.status(upload_id)
+        return status is not None and status['offset'] == status['size']
+
+    def complete(self, upload_id, destination, ext):
+        """Store a fully received upload content-addressed; returns (writer, content id, path, duplicate)"""
+        meta = self.meta(upload_id)
+        with self._lock:
+            writer = self._writer(upload_id, meta)
+            self._writers.pop(upload_id, None)
+        content_id, path, duplicate = writer.store(destination, ext)
+        os.remove(self._meta_path(upload_id))
+        return writer, content_id, path, duplicate
@@ -0,0 +1,62 @@
+import gzip
+import json
+
+import numpy as np
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_COMPRESS_SIZE = 1024  # Smaller bodies are not worth the compression overhead
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # Fast enough for per-request compression of dynamic responses
+
+
+def _numpy_default(obj):
+    # orjson only gets here for arrays it cannot read directly (non-contiguous or unusual dtypes)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    """Serialize to JSON bytes; NumPy arrays and scalars are encoded natively by orjson if it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_numpy_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    # Without orjson, arrays still take one tolist() call each instead of one call per element
+    return json.dumps(obj, default=_numpy_default, separators=(',', ':')).encode('utf-8')
+
+
+def compress(body, accept_encoding):
+    """Compress a response body for the best encoding the client accepts; returns (body, encoding or None)"""
+    if len(body) < MIN_COMPRESS_SIZE:
+        return body, None
+    if brotli is not None and 'br' in accept_encoding:
+        return brotli.compress(body, quality=BROTLI_QUALITY), 'br'
+    if 'gzip' in accept_encoding:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), 'gzip'
+    return body, None
+
+
+def json_response(obj, status=200, compression=True):
+    """JSON response for data that may contain NumPy values, compressed with brotli or gzip when accepted"""
+    body = dumps(obj)
+    encoding = None
+    if compression:
+        body, encoding = compress(body, request.accept_encodings)
+    response = Response(body, status=status, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if compression:
+        response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,96 @@
+"""
+Stem sets written by separation jobs, and their ranking by rhythmic clarity.
+
+The ranking and the spectrogram tiles of the stems are computed by the separation job
+itself (compute_job.separate) once Demucs finished, so the routes polling a job only read
+ranking.json. Nothing here imports the web app.
+"""
+
+import json
+import os
+import uuid
+
+# Stem formats in order of preference for analysis (lossless first)
+ANALYSIS_FORMATS = ['wav', 'flac', 'mp3', 'opus']
+
+
+def stem_files(output_dir, formats):
+    """
+    {stem: path relative to output_dir} of a job's stems, picking for each stem the first
+    available format in `formats`; None while Demucs has not created its output directory.
+    """
+    model_dir = os.path.join(output_dir, 'htdemucs')
+    if not os.path.exists(model_dir):
+        return None
+    # The audio file directory is named after the input file
+    audio_dirs = [d for d in os.listdir(model_dir) if os.path.isdir(os.path.join(model_dir, d))]
+    if not audio_dirs:
+        return None
+    audio_dir = os.path.join(model_dir, audio_dirs[0])
+
+    files = {}
+    manifest_path = os.path.join(audio_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        # Transcoded stems: choose the variant
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        for stem, variants in manifest['stems'].items():
+            for fmt in formats:
+                if fmt in variants:
+                    files[stem] = os.path.join('htdemucs', audio_dirs[0], variants[fmt]['file'])
+                    break
+    else:
+        for name in os.listdir(audio_dir):
+            if name.endswith('.wav'):
+                files[os.path.splitext(name)[0]] = os.path.join('htdemucs', audio_dirs[0], name)
+    return files
+
+
+def load_ranking(output_dir):
+    """Ranking written by the separation job, or None"""
+    try:
+        with open(os.path.join(output_dir, 'ranking.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def rank_stems(output_dir, spectrogram_folder=None):
+    """
+    Rank the stems of a finished separation by rhythmic clarity, best first (see
+    trackEvaluation.rank_by_clarity), and store the ranking in output_dir/ranking.json. With spectrogram_folder, the spectrogram tiles of every stem
+    are written there as "<job id>_<stem>".
+    """
+    files = stem_files(output_dir, ANALYSIS_FORMATS)
+    if not files:
+        return None
+    job_id = os.path.basename(os.path.normpath(output_dir))
+
+    from trackEvaluation import RANKING_METRICS, RANKING_SAMPLE_RATE, evaluate_file, rank_by_clarity
+    ranking = []
+    for stem, path in files.items():
+        row = {'stem': stem}
+        try:
+            row.update(evaluate_file(os.path.join(output_dir, path), sr=RANKING_SAMPLE_RATE,
+                                     metrics=RANKING_METRICS))
+        except Exception as e:
+            print(f"Could not evaluate stem {stem} of job {job_id}: {e}")
+            row.update({metric: 0.0 for metric in RANKING_METRICS})
+        ranking.append(row)
+
+    ranking = rank_by_clarity(ranking)
+
+    ranking_path = os.path.join(output_dir, 'ranking.json')
+    tmp_path = f"{ranking_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(ranking, f)
+    os.replace(tmp_path, ranking_path)
+
+    if spectrogram_folder:
+        from spectrogram_tiles import build
+        for stem, path in files.items():
+            try:
+                build(os.path.join(output_dir, path), os.path.join(spectrogram_folder, f"{job_id}_{stem}"))
+            except Exception as e:
+                print(f"Could not compute the spectrogram of stem {stem} of job {job_id}: {e}")
+    return ranking
@@ -0,0 +1,277 @@
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+
+
+def path_size(path):
+    """Size in bytes of a file (with its precompressed .gz variant), or of all files below a directory"""
+    if os.path.isfile(path):
+        size = os.path.getsize(path)
+        if os.path.isfile(f"{path}.gz"):
+            size += os.path.getsize(f"{path}.gz")
+        return size
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass  # File removed while walking
+    return total
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+        os.rmdir(path)
+    elif os.path.exists(path):
+        os.remove(path)
+        if os.path.exists(f"{path}.gz"):
+            os.remove(f"{path}.gz")
+
+
+class StorageManager:
+    """
+    Index of stored artifacts (uploads, stem sets, extracted MIDI tracks, job scripts, caches)
+    with their size and last access, enforcing per-kind quotas by least-recently-used eviction.
+
+    Request handlers only register, touch and pin artifacts, which are cheap index updates.
+    Directory scans, size reconciliation and eviction run in a background compaction thread,
+    which also writes the batched touches every few seconds. Every process that serves
+    requests must run it (start() after fork); only one process at a time compacts.
+    Artifacts pinned as in-flight (e.g. the input and output of a running separation job)
+    are never evicted.
+    """
+
+    def __init__(self, index_path, quotas, compaction_interval=300, max_in_flight_age=6 * 3600,
+                 touch_flush_interval=10):
+        self.index_path = index_path
+        self.quotas = quotas
+        self.compaction_interval = compaction_interval
+        self.touch_flush_interval = touch_flush_interval
+        self.max_in_flight_age = max_in_flight_age
+        self.locations = []  # (kind, folder, directories, match, max_age)
+        self.maintenance = []  # Further tasks of the compaction pass
+        self._touches = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_event = threading.Event()
+
+        os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+        self._connect()
+        # SQLite connections and held locks must not be shared with forked server workers
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _connect(self):
+        self._db = sqlite3.connect(self.index_path, check_same_thread=False, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS artifacts (
+            key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            last_access REAL NOT NULL,
+            in_flight_since REAL
+        )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS artifacts_lru ON artifacts (kind, last_access)')
+        self._db.commit()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._touches = {}
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._connect()
+
+    def watch(self, kind, folder, directories=False, match=None, max_age=None):
+        """
+        Classify entries of a folder as artifacts of `kind` (directories=True: each subdirectory
+        is one artifact). With max_age, entries not accessed for that many seconds are removed
+        even when the kind is within its quota (e.g. abandoned partial uploads).
+        """
+        self.locations.append((kind, os.path.normpath(folder), directories, match, max_age))
+
+    def add_maintenance(self, task):
+        """Run task() in every compaction pass (in one process at a time), e.g. to compact another index"""
+        self.maintenance.append(task)
+
+    def key_for(self, path):
+        """Artifact key for a path; files inside a stem-set directory map to the directory"""
+        path = os.path.normpath(path)
+        for _, folder, directories, _, _ in self.locations:
+            if directories and path.startswith(folder + os.sep):
+                return os.path.join(folder, os.path.relpath(path, folder).split(os.sep)[0])
+        return path
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            self._db.commit()
+            return cursor.fetchall()
+
+    def register(self, kind, path, in_flight=False):
+        """Add or refresh an artifact after it was written"""
+        key = self.key_for(path)
+        now = time.time()
+        size = path_size(key) if os.path.exists(key) else 0
+        self._execute(
+            '''INSERT INTO artifacts (key, kind, size, created, last_access, in_flight_since)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT(key) DO UPDATE SET size=excluded.size, last_access=excluded.last_access,
+               in_flight_since=COALESCE(excluded.in_flight_since, artifacts.in_flight_since)''',
+            (key, kind, size, now, now, now if in_flight else None))
+
+    def touch(self, path):
+        """Record an access; batched in memory and written by the background thread"""
+        self._touches[self.key_for(path)] = time.time()
+
+    def pin(self, path):
+        """Mark an artifact as used by an in-flight job so it is not evicted"""
+        self._execute('UPDATE artifacts SET in_flight_since=? WHERE key=?', (time.time(), self.key_for(path)))
+
+    def unpin(self, path):
+        self._execute('UPDATE artifacts SET in_flight_since=NULL WHERE key=?', (self.key_for(path),))
+
+    def usage(self):
+        """Total bytes per artifact kind"""
+        rows = self._execute('SELECT kind, SUM(size), COUNT(*) FROM artifacts GROUP BY kind')
+        return {kind: {'bytes': size, 'count': count, 'quota': self.quotas.get(kind)}
+                for kind, size, count in rows}
+
+    def flush_touches(self):
+        touches, self._touches = self._touches, {}
+        if touches:
+            with self._lock:
+                self._db.executemany('UPDATE artifacts SET last_access=MAX(last_access, ?) WHERE key=?',
+                                     [(when, key) for key, when in touches.items()])
+                self._db.commit()
+
+    def reconcile(self):
+        """Discover untracked artifacts, drop vanished ones and refresh sizes"""
+        known = {key: (kind, size) for key, kind, size in
+                 self._execute('SELECT key, kind, size FROM artifacts')}
+        seen = set()
+        now = time.time()
+        for kind, folder, directories, match, _ in self.locations:
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                if (directories != os.path.isdir(path) or (match and match not in name) or path in seen
+                        or name.endswith('.gz')):
+                    continue
+                seen.add(path)
+                size = path_size(path)
+                if path not in known:
+                    mtime = os.path.getmtime(path)
+                    self._execute('''INSERT OR IGNORE INTO artifacts (key, kind, size, created, last_access)
+                                     VALUES (?, ?, ?, ?, ?)''', (path, kind, size, mtime, mtime))
+                elif known[path][1] != size:
+                    self._execute('UPDATE artifacts SET size=? WHERE key=?', (size, path))
+
+        for key in known:
+            if key not in seen and not os.path.exists(key):
+                self._execute('DELETE FROM artifacts WHERE key=?', (key,))
+
+        # Jobs that never reported back do not keep their artifacts forever
+        self._execute('UPDATE artifacts SET in_flight_since=NULL WHERE in_flight_since < ?',
+                      (now - self.max_in_flight_age,))
+
+    def enforce_quotas(self):
+        """Evict least recently used artifacts of every kind that is over quota; returns the evicted keys"""
+        evicted = []
+        for kind, quota in self.quotas.items():
+            total = self._execute('SELECT COALESCE(SUM(size), 0) FROM artifacts WHERE kind=?', (kind,))[0][0]
+            if total <= quota:
+                continue
+            candidates = self._execute('''SELECT key, size FROM artifacts
+                                          WHERE kind=? AND in_flight_since IS NULL
+                                          ORDER BY last_access ASC''', (kind,))
+            for key, size in candidates:
+                if total <= quota:
+                    break
+                try:
+                    remove_path(key)
+                except OSError as e:
+                    print(f"Storage: could not evict {key}: {e}")
+                    continue
+                self._execute('DELETE FROM artifacts WHERE key=?', (key,))
+                total -= size
+                evicted.append(key)
+        if evicted:
+            print(f"Storage: evicted {len(evicted)} artifacts: {', '.join(evicted)}")
+        return evicted
+
+    def expire(self):
+        """Remove artifacts of locations with a max_age that were not accessed for that long"""
+        expired = []
+        now = time.time()
+        for _, folder, _, _, max_age in self.locations:
+            if max_age is None:
+                continue
+            candidates = self._execute('''SELECT key FROM artifacts
+                                          WHERE key LIKE ? AND last_access < ? AND in_flight_since IS NULL''',
+                                       (os.path.join(folder, '%'), now - max_age))
+            for (key,) in candidates:
+                if os.path.dirname(key) != folder:
+                    continue  # Not directly in this folder
+                try:
+                    remove_path(key)
+                except OSError as e:
+                    print(f"Storage: could not expire {key}: {e}")
+                    continue
+                self._execute('DELETE FROM artifacts WHERE key=?', (key,))
+                expired.append(key)
+        if expired:
+            print(f"Storage: expired {len(expired)} artifacts: {', '.join(expired)}")
+        return expired
+
+    def compact(self):
+        """One background maintenance pass; only one process sharing the index runs it at a time"""
+        with open(f"{self.index_path}.lock", 'w') as lock_file:
+            try:
+                # POSIX record locks are not inherited by forked workers, unlike flock
+                fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.flush_touches()
+                return []
+            self.reconcile()
+            self.flush_touches()  # After reconcile, so touches of newly discovered artifacts count
+            removed = self.expire() + self.enforce_quotas()
+            for task in self.maintenance:
+                try:
+                    task()
+                except Exception as e:
+                    print(f"Storage: maintenance task {getattr(task, '__name__', task)} failed: {e}")
+            return removed
+
+    def start(self):
+        """Start the background thread writing touches and compacting (call in every serving process)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='storage-compaction', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self.flush_touches()
+
+    def _run(self):
+        next_compaction = 0
+        while not self._stop_event.is_set():
+            try:
+                if time.time() >= next_compaction:
+                    next_compaction = time.time() + self.compaction_interval
+                    self.compact()
+                else:
+                    self.flush_touches()
+            except Exception as e:
+                print(f"Storage compaction error: {e}")
+            self._stop_event.wait(min(self.touch_flush_interval, self.compaction_interval))
@@ -0,0 +1,60 @@
+import threading
+import time
+
+
+class Warmup:
+    """
+    Runs an expensive loader (heavy imports, model construction) once, either on first
+    use or ahead of time in a background thread, so the server can serve pages and
+    static files while it is still loading.
+    """
+
+    def __init__(self, loader, name):
+        self.loader = loader
+        self.name = name
+        self.ready = threading.Event()
+        self.error = None
+        self.started = None
+        self.finished = None
+        self._result = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def get(self):
+        """The loader's result; blocks until loading finished (loading now if nobody started it)"""
+        if not self.ready.is_set():
+            with self._lock:
+                if not self.ready.is_set():
+                    self.started = self.started or time.time()
+                    try:
+                        self._result = self.loader()
+                        self.error = None
+                    except Exception as e:
+                        self.error = str(e)
+                        raise
+                    self.finished = time.time()
+                    self.ready.set()
+        return self._result
+
+    def start(self):
+        """Load in a background thread"""
+        if self.ready.is_set() or (self._thread and self._thread.is_alive()):
+            return
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run, name=f"warmup-{self.name}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self.get()
+            print(f"Warm-up of {self.name} finished in {self.finished - self.started:.1f}s")
+        except Exception as e:
+            print(f"Warm-up of {self.name} failed: {e}")
+
+    def status(self):
+        status = {'ready': self.ready.is_set(), 'loading': bool(self._lock.locked())}
+        if self.finished:
+            status['load_seconds'] = round(self.finished - self.started, 3)
+        if self.error:
+            status['error'] = self.error
+        return status